@@ -0,0 +1,199 @@
+#! /usr/bin/env python3
+""" Script to run the PID step response analysis for many logs (e.g. all logs
+of a vehicle or an airframe) and store the response metrics in the DB
+(PIDAnalysis table). Logs that already have results are skipped, so the script
+can be interrupted and started again. """
+
+import argparse
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from pyulog import ULog
+from pyulog.px4 import PX4ULog
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
+from plot_app.config import get_db_filename
+from plot_app.helper import get_log_filename
+from plot_app.pid_analysis import (
+    PID_ANALYSIS_TOPICS, PID_ANALYSIS_CACHE_VERSION, get_pid_analysis_inputs,
+    run_pid_analysis, get_step_response_metrics, load_pid_analysis_results,
+    save_pid_analysis_results
+    )
+
+
+ANALYSIS_KEYS = ['rate_roll', 'rate_pitch', 'rate_yaw', 'angle_roll', 'angle_pitch']
+
+
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = argparse.ArgumentParser(description='Run the PID step response analysis for '
+                                                 'many logs and store the metrics (rise time, '
+                                                 'overshoot, settling time) in the DB.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--uuid', default=None, type=str, nargs='+',
+                        help='Only analyze logs of these vehicle UUIDs')
+    parser.add_argument('--autostart', default=None, type=int, nargs='+',
+                        help='Only analyze logs of these airframes (autostart ID, SYS_AUTOSTART)')
+    parser.add_argument('--log-id', default=None, type=str, nargs='+',
+                        help='Only analyze these log ids')
+    parser.add_argument('--num-workers', '-j', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--rerun', action='store_true', default=False,
+                        help='Update the metrics of all selected logs, even if they have results')
+    parser.add_argument('--print', action='store_true', dest='print_only', default=False,
+                        help='Only print the stored results of the selected logs')
+    return parser.parse_args()
+
+
+def get_selected_log_ids(cur, args):
+    """ get the ids of the logs that match the CLI filters, oldest first """
+    query = 'SELECT LogsGenerated.Id FROM LogsGenerated ' \
+            'JOIN Logs ON Logs.Id = LogsGenerated.Id'
+    conditions = []
+    query_args = []
+    for column, values in [('LogsGenerated.UUID', args.uuid),
+                           ('LogsGenerated.AutostartId', args.autostart),
+                           ('LogsGenerated.Id', args.log_id)]:
+        if values is not None:
+            conditions.append(column+' IN ('+','.join('?' * len(values))+')')
+            query_args.extend(values)
+    if len(conditions) > 0:
+        query += ' WHERE '+' AND '.join(conditions)
+    cur.execute(query+' ORDER BY Logs.Date', query_args)
+    return [db_tuple[0] for db_tuple in cur.fetchall()]
+
+
+def analyze_log(log_id):
+    """ run the PID analysis for all axes of a log and get the step response
+    metrics. This is executed in a worker process. The analysis results are
+    shared with the PID analysis page cache.
+
+    :return: list of (analysis key, rise time, overshoot, settling time, error)
+    """
+    results = load_pid_analysis_results(log_id)
+    errors = {}
+    if results is None:
+        try:
+            ulog = ULog(get_log_filename(log_id), PID_ANALYSIS_TOPICS)
+            PX4ULog(ulog).add_roll_pitch_yaw()
+            analysis_inputs = get_pid_analysis_inputs(ulog)
+        except Exception as error:
+            return [(key, None, None, None, 'failed to load data: '+str(error))
+                    for key in ANALYSIS_KEYS]
+
+        results = {}
+        for key, analysis_input in analysis_inputs.items():
+            results[key] = None
+            if analysis_input is None:
+                continue
+            try:
+                results[key] = run_pid_analysis(*analysis_input)
+            except Exception as error:
+                errors[key] = str(error)
+        save_pid_analysis_results(log_id, results)
+
+    metrics = []
+    for key in ANALYSIS_KEYS:
+        trace_result = results.get(key, None)
+        if trace_result is None:
+            metrics.append((key, None, None, None, errors.get(key, 'analysis failed')))
+        else:
+            metrics.append((key, *get_step_response_metrics(
+                trace_result.time_resp, trace_result.resp_low[0]), ''))
+    return metrics
+
+
+def store_metrics(con, log_id, metrics):
+    """ replace the stored metrics of a log """
+    cur = con.cursor()
+    cur.execute('DELETE FROM PIDAnalysis WHERE Id = ?', (log_id,))
+    cur.executemany('INSERT INTO PIDAnalysis (Id, Analysis, Version, RiseTime, '
+                    'Overshoot, SettlingTime, Error) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    [(log_id, key, PID_ANALYSIS_CACHE_VERSION, rise_time, overshoot,
+                      settling_time, error)
+                     for key, rise_time, overshoot, settling_time, error in metrics])
+    con.commit()
+    cur.close()
+
+
+def print_metrics(cur, log_ids):
+    """ print the stored metrics of the given logs """
+    def _format(value, scale, fmt):
+        return '-' if value is None else fmt.format(value * scale)
+
+    print('{:<38} {:<12} {:>10} {:>10} {:>13}  {:}'.format(
+        'Log Id', 'Analysis', 'Rise [ms]', 'Overshoot', 'Settling [ms]', 'Error'))
+    for log_id in log_ids:
+        cur.execute('SELECT Analysis, RiseTime, Overshoot, SettlingTime, Error '
+                    'FROM PIDAnalysis WHERE Id = ?', (log_id,))
+        rows = {db_tuple[0]: db_tuple[1:] for db_tuple in cur.fetchall()}
+        for key in ANALYSIS_KEYS:
+            if key not in rows:
+                continue
+            rise_time, overshoot, settling_time, error = rows[key]
+            print('{:<38} {:<12} {:>10} {:>10} {:>13}  {:}'.format(
+                log_id, key, _format(rise_time, 1000, '{:.1f}'),
+                _format(overshoot, 1, '{:.1f}%'),
+                _format(settling_time, 1000, '{:.1f}'), error))
+
+
+def main():
+    """ main script entry point """
+    args = get_arguments()
+
+    con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+    cur = con.cursor()
+    log_ids = get_selected_log_ids(cur, args)
+
+    if args.print_only:
+        print_metrics(cur, log_ids)
+        cur.close()
+        con.close()
+        return
+
+    # resume: skip the logs that already have results of the current version
+    if not args.rerun:
+        cur.execute('SELECT DISTINCT Id FROM PIDAnalysis WHERE Version = ?',
+                    (PID_ANALYSIS_CACHE_VERSION,))
+        done_log_ids = set(db_tuple[0] for db_tuple in cur.fetchall())
+        log_ids_to_analyze = [log_id for log_id in log_ids if log_id not in done_log_ids]
+    else:
+        log_ids_to_analyze = log_ids
+    print('Analyzing {:} logs ({:} selected, {:} already done)'.format(
+        len(log_ids_to_analyze), len(log_ids), len(log_ids)-len(log_ids_to_analyze)))
+
+    executor = ProcessPoolExecutor(max_workers=max(1, args.num_workers))
+    futures = {executor.submit(analyze_log, log_id): log_id for log_id in log_ids_to_analyze}
+    try:
+        for num_done, future in enumerate(as_completed(futures), 1):
+            log_id = futures[future]
+            try:
+                metrics = future.result()
+            except Exception as error:
+                print('[{:}/{:}] {:}: failed ({:})'.format(
+                    num_done, len(futures), log_id, error))
+                continue
+            store_metrics(con, log_id, metrics)
+            num_ok = sum(1 for metric in metrics if metric[4] == '')
+            print('[{:}/{:}] {:}: {:}/{:} axes analyzed'.format(
+                num_done, len(futures), log_id, num_ok, len(metrics)))
+    except KeyboardInterrupt:
+        print('Interrupted. Run the script again to continue.')
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        cur.close()
+        con.close()
+        sys.exit(1)
+    executor.shutdown()
+
+    print_metrics(cur, log_ids)
+    cur.close()
+    con.close()
+
+
+if __name__ == '__main__':
+    main()
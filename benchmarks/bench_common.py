@@ -0,0 +1,40 @@
+""" Helpers shared by the benchmark scripts """
+
+import argparse
+import tracemalloc
+from timeit import default_timer as timer
+
+
+def get_argument_parser(description):
+    """ get an argument parser with the options common to all benchmarks """
+    parser = argparse.ArgumentParser(description=description,
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--runs', '-n', type=int, default=5,
+                        help='Number of runs (the best one is reported)')
+    return parser
+
+
+def get_best_time(function, num_runs):
+    """ call function() num_runs times
+    :return: tuple of (best time [s], return value of the last call)
+    """
+    best_time = None
+    result = None
+    for _ in range(num_runs):
+        start_time = timer()
+        result = function()
+        elapsed = timer() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time, result
+
+
+def get_peak_memory(function):
+    """ call function() once
+    :return: peak memory allocated during the call [B] (traced by tracemalloc)
+    """
+    tracemalloc.start()
+    function()
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak_memory
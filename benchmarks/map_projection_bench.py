@@ -0,0 +1,122 @@
+#! /usr/bin/env python3
+""" Micro-benchmark of helper.map_projection on a synthetic 1 hour, 10 Hz GPS
+track (36000 samples). The result is checked against the previous scalar
+implementation (loop over all samples). """
+
+import os
+import sys
+
+import numpy as np
+
+from bench_common import get_argument_parser, get_best_time, get_peak_memory
+
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))),
+                             'plot_app'))
+from helper import map_projection # pylint: disable=import-error,wrong-import-position
+
+
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = get_argument_parser('Benchmark helper.map_projection')
+    parser.add_argument('--num-samples', type=int, default=36000,
+                        help='Number of GPS samples (default: 1 hour at 10 Hz)')
+    parser.add_argument('--repeat', type=int, default=10,
+                        help='Number of calls per run')
+    return parser.parse_args()
+
+
+def map_projection_loop(lat, lon, anchor_lat, anchor_lon):
+    """ the previous implementation of map_projection (with a Python loop to
+    compute k), used as reference """
+    sin_lat = np.sin(lat)
+    cos_lat = np.cos(lat)
+    cos_d_lon = np.cos(lon - anchor_lon)
+    sin_anchor_lat = np.sin(anchor_lat)
+    cos_anchor_lat = np.cos(anchor_lat)
+
+    arg = sin_anchor_lat * sin_lat + cos_anchor_lat * cos_lat * cos_d_lon
+    arg[arg > 1] = 1
+    arg[arg < -1] = -1
+
+    angle = np.arccos(arg)
+    k = np.copy(lat)
+    for i in range(len(lat)):
+        if np.abs(angle[i]) < np.finfo(float).eps:
+            k[i] = 1
+        else:
+            k[i] = angle[i] / np.sin(angle[i])
+
+    radius_of_earth = 6371000
+    x = k * (cos_anchor_lat * sin_lat - sin_anchor_lat * cos_lat * cos_d_lon) * \
+        radius_of_earth
+    y = k * cos_lat * np.sin(lon - anchor_lon) * radius_of_earth
+    return x, y
+
+
+def get_gps_track(num_samples):
+    """ synthetic GPS track in [rad]: a random walk (a few km) around Zurich,
+    starting at the anchor position """
+    rng = np.random.RandomState(0)
+    anchor_lat = np.deg2rad(47.3977)
+    anchor_lon = np.deg2rad(8.5456)
+    # 10 Hz, up to ~15 m/s
+    steps = rng.normal(0, 1.5, (num_samples, 2)) / 6371000
+    steps[0, :] = 0
+    lat = anchor_lat + np.cumsum(steps[:, 0])
+    lon = anchor_lon + np.cumsum(steps[:, 1]) / np.cos(anchor_lat)
+    return lat, lon, anchor_lat, anchor_lon
+
+
+def run_benchmark(function, args, num_runs, repeat):
+    """ time function(*args)
+    :return: tuple of (best time per call [s], peak memory [B], result)
+    """
+    def call_repeatedly():
+        for _ in range(repeat):
+            result = function(*args)
+        return result
+    best_time, result = get_best_time(call_repeatedly, num_runs)
+    peak_memory = get_peak_memory(lambda: function(*args))
+    return best_time / repeat, peak_memory, result
+
+
+def main():
+    """ main method """
+    args = get_arguments()
+    lat, lon, anchor_lat, anchor_lon = get_gps_track(args.num_samples)
+    track_args = (lat, lon, anchor_lat, anchor_lon)
+
+    benchmarks = [
+        ('scalar loop (reference)', map_projection_loop, None),
+        ('vectorized float64', map_projection, 1e-6),
+        ('vectorized float32',
+         lambda *a: map_projection(*a, dtype=np.float32), 2.0),
+        ]
+
+    print('{:} samples, best of {:}x{:} calls'.format(args.num_samples, args.runs,
+                                                     args.repeat))
+    reference = None
+    success = True
+    for name, function, tolerance in benchmarks:
+        best_time, peak_memory, (x, y) = run_benchmark(function, track_args, args.runs,
+                                                       args.repeat)
+        line = '{:<25} {:8.2f} ms  peak memory {:5.1f} MB'.format(
+            name, best_time * 1000, peak_memory / 1e6)
+        if reference is None:
+            reference = (x, y)
+        else:
+            max_error = max(np.max(np.abs(x - reference[0])),
+                            np.max(np.abs(y - reference[1])))
+            is_ok = max_error <= tolerance
+            success = success and is_ok
+            line += '  max deviation {:.2e} m ({:})'.format(max_error,
+                                                         'ok' if is_ok else 'FAILED')
+        print(line)
+
+    if not success:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
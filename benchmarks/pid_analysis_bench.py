@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+""" Benchmark of the PID step response analysis (pid_analysis.Trace) on the
+bundled sample logs and on a synthetic long log.
+
+Only Trace is used, so the script can also be run against older versions of
+plot_app (e.g. to compare before/after a change):
+    python3 benchmarks/pid_analysis_bench.py --plot-app /path/to/old/plot_app
+"""
+
+import glob
+import os
+import sys
+
+import numpy as np
+from scipy.interpolate import interp1d
+from pyulog import ULog
+
+from bench_common import get_argument_parser, get_best_time, get_peak_memory
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = get_argument_parser('Benchmark the PID analysis (Trace)')
+    parser.add_argument('log_files', nargs='*', default=None,
+                        help='ULog files (default: the sample logs in the repository)')
+    parser.add_argument('--synthetic-minutes', type=float, default=20,
+                        help='Length of the synthetic 250 Hz log (0 to disable)')
+    parser.add_argument('--memory', action='store_true', default=False,
+                        help='Also measure the peak memory (slower)')
+    parser.add_argument('--plot-app', default=os.path.join(REPO_DIR, 'plot_app'),
+                        help='plot_app directory to benchmark')
+    return parser.parse_args()
+
+
+def _resample(time_array, data, desired_time):
+    """ resample data at a given time to a vector of desired_time """
+    data_f = interp1d(time_array, data, fill_value='extrapolate')
+    return data_f(desired_time)
+
+
+def get_rate_inputs(ulog):
+    """ get the Trace arguments of the roll, pitch & yaw rate of a log
+    (the same inputs as on the PID analysis page) """
+    rate_ctrl_status = ulog.get_dataset('rate_ctrl_status')
+    gyro_time = rate_ctrl_status.data['timestamp']
+    vehicle_rates_setpoint = ulog.get_dataset('vehicle_rates_setpoint')
+    actuator_controls_0 = ulog.get_dataset('actuator_controls_0')
+    throttle = _resample(actuator_controls_0.data['timestamp'],
+                         actuator_controls_0.data['control[3]'] * 100, gyro_time)
+    inputs = []
+    for axis in ['roll', 'pitch', 'yaw']:
+        gyro_rate = np.rad2deg(rate_ctrl_status.data[axis+'speed'])
+        setpoint = _resample(vehicle_rates_setpoint.data['timestamp'],
+                             np.rad2deg(vehicle_rates_setpoint.data[axis]), gyro_time)
+        inputs.append((axis, gyro_time / 1e6, gyro_rate, setpoint, throttle))
+    return inputs
+
+
+def get_synthetic_inputs(minutes, rate=250.):
+    """ get the Trace arguments of a synthetic roll axis: random setpoint steps
+    and a delayed first order response with noise """
+    rng = np.random.RandomState(0)
+    num_samples = int(minutes * 60 * rate)
+    time = np.arange(num_samples) / rate
+    step_lengths = rng.randint(int(0.2 * rate), int(2 * rate), num_samples // int(0.2 * rate))
+    step_values = rng.uniform(-600, 600, len(step_lengths))
+    setpoint = np.repeat(step_values, step_lengths)[:num_samples]
+    setpoint = np.pad(setpoint, (0, num_samples - len(setpoint)), 'edge')
+    delay = int(0.01 * rate)
+    alpha = 1. / (0.03 * rate)
+    gyro_rate = np.zeros(num_samples)
+    for i in range(delay + 1, num_samples):
+        gyro_rate[i] = gyro_rate[i-1] + alpha * (setpoint[i-delay] - gyro_rate[i-1])
+    gyro_rate += rng.normal(0, 5, num_samples)
+    throttle = 50 + 10 * np.sin(time / 10)
+    return [('roll', time, gyro_rate, setpoint, throttle)]
+
+
+def run_benchmark(trace_class, inputs, num_runs, measure_memory):
+    """ run the analysis of all inputs num_runs times
+    :return: tuple of (best time [s], peak memory [B] or None)
+    """
+    def analyze_all():
+        for args in inputs:
+            trace_class(*args)
+    best_time, _ = get_best_time(analyze_all, num_runs)
+    peak_memory = get_peak_memory(analyze_all) if measure_memory else None
+    return best_time, peak_memory
+
+
+def main():
+    """ main method """
+    args = get_arguments()
+    sys.path.insert(0, os.path.realpath(args.plot_app))
+    from pid_analysis import Trace # pylint: disable=import-error,import-outside-toplevel
+
+    log_files = args.log_files
+    if not log_files:
+        log_files = sorted(glob.glob(os.path.join(REPO_DIR, '*.ulg')))
+
+    benchmarks = []
+    for log_file in log_files:
+        ulog = ULog(log_file, ['rate_ctrl_status', 'vehicle_rates_setpoint',
+                               'actuator_controls_0'])
+        benchmarks.append((os.path.basename(log_file)+' (roll/pitch/yaw rate)',
+                           get_rate_inputs(ulog)))
+    if args.synthetic_minutes > 0:
+        benchmarks.append(('synthetic {:g} min 250 Hz (roll rate)'.format(args.synthetic_minutes),
+                           get_synthetic_inputs(args.synthetic_minutes)))
+
+    print('plot_app: {:}, best of {:} runs'.format(os.path.realpath(args.plot_app), args.runs))
+    total_time = 0
+    for name, inputs in benchmarks:
+        best_time, peak_memory = run_benchmark(Trace, inputs, args.runs, args.memory)
+        total_time += best_time
+        line = '{:<45} {:7.3f} s'.format(name, best_time)
+        if peak_memory is not None:
+            line += '  peak memory {:7.1f} MB'.format(peak_memory / 1e6)
+        print(line)
+    print('{:<45} {:7.3f} s'.format('total', total_time))
+
+
+if __name__ == '__main__':
+    main()
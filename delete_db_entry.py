@@ -7,7 +7,11 @@ import sys
 import os
 import argparse
 
+# this is needed for the following imports
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename
+from plot_app.helper import clear_db_info_snapshot, remove_pid_analysis_results
+from plot_app.search_index import remove_from_search_index
 
 
 parser = argparse.ArgumentParser(description='Remove a DB entry (but not the log file)')
@@ -22,6 +26,8 @@ with con:
     cur = con.cursor()
     for log_id in args.log_id:
         print('Removing '+log_id)
+        remove_from_search_index(cur, log_id)
+        remove_pid_analysis_results(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         num_deleted = cur.rowcount
@@ -31,3 +37,5 @@ with con:
 
 con.close()
 
+# the public log list is regenerated on the next request
+clear_db_info_snapshot()
@@ -6,8 +6,11 @@ import glob
 import argparse
 import json
 import datetime
+import random
 import sys
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
 
@@ -53,6 +56,15 @@ def get_arguments():
                         help='Filter logs by a particular airframe name. e.g. Generic Quadrotor X')
     parser.add_argument('--airframe-type', default=None, type=str,
                         help='Filter logs by a particular airframe type. e.g. Quadrotor X')
+    parser.add_argument('--num-workers', '-j', type=int, default=4,
+                        help='Number of parallel downloads.')
+    parser.add_argument('--chunk-size', type=int, default=1024,
+                        help='Download chunk size in KB.')
+    parser.add_argument('--max-retries', type=int, default=10,
+                        help='Maximum number of retries per log file.')
+    parser.add_argument('--retry-delay', type=float, default=2,
+                        help='Delay before the first retry in seconds. It is doubled '
+                             'on each retry (up to 5 minutes).')
     return parser.parse_args()
 
 
@@ -76,13 +88,80 @@ def error_labels_to_ids(error_labels):
     return error_ids
 
 
+__session = threading.local()
+def get_session():
+    """ get the requests session of the current thread (to reuse connections) """
+    if not hasattr(__session, 'session'):
+        __session.session = requests.Session()
+    return __session.session
+
+
+def download_log(entry_id, args):
+    """
+    download a log file. The data is written to a temporary file (<file>.part),
+    which is renamed when complete. A partial file from an interrupted download
+    is resumed with a Range request.
+    :return: number of downloaded bytes
+    """
+    file_path = os.path.join(args.download_folder, entry_id + ".ulg")
+    temp_file_path = file_path + '.part'
+
+    for num_tries in range(args.max_retries + 1):
+        try:
+            headers = {}
+            offset = 0
+            if os.path.exists(temp_file_path):
+                offset = os.path.getsize(temp_file_path)
+                headers['Range'] = 'bytes={:}-'.format(offset)
+            with get_session().get(url=args.download_api, params={'log': entry_id},
+                                   headers=headers, stream=True, timeout=60) as request:
+                if request.status_code == 416: # the partial file is complete
+                    os.replace(temp_file_path, file_path)
+                    return 0
+                request.raise_for_status()
+                if request.status_code != 206: # no resume: start from the beginning
+                    offset = 0
+                expected_size = request.headers.get('Content-Length')
+                num_bytes = 0
+                with open(temp_file_path, 'r+b' if offset > 0 else 'wb') as log_file:
+                    log_file.seek(offset)
+                    log_file.truncate()
+                    for chunk in request.iter_content(chunk_size=args.chunk_size * 1024):
+                        log_file.write(chunk)
+                        num_bytes += len(chunk)
+            if expected_size is not None and num_bytes != int(expected_size):
+                raise IOError('incomplete download ({:} of {:} bytes)'.format(
+                    num_bytes, expected_size))
+            os.replace(temp_file_path, file_path)
+            return num_bytes
+        except Exception as ex:
+            # client errors (e.g. log not found) will not go away by retrying
+            response = getattr(ex, 'response', None)
+            if num_tries == args.max_retries or (
+                    response is not None and 400 <= response.status_code < 500 and
+                    response.status_code not in (408, 429)):
+                raise
+            delay = min(args.retry_delay * 2**num_tries, 300) * random.uniform(0.5, 1)
+            print('{:}: {:}. Retrying in {:.0f} seconds'.format(entry_id, ex, delay))
+            time.sleep(delay)
+    return 0
+
+
 def main():
     """ main script entry point """
     args = get_arguments()
 
     try:
-        # the db_info_api sends a json file with a list of all public database entries
-        db_entries_list = requests.get(url=args.db_info_api).json()
+        # the db_info_api sends a json file with a list of all public database entries.
+        # The filters are also applied by the server (if supported), so that only
+        # the matching entries are transferred.
+        db_info_params = {'mav_type': args.mav_type, 'rating': args.rating,
+                          'error_labels': args.error_labels, 'flight_modes': args.flight_modes,
+                          'uuid': args.uuid, 'vehicle_name': args.vehicle_name,
+                          'airframe_name': args.airframe_name,
+                          'airframe_type': args.airframe_type}
+        db_entries_list = requests.get(url=args.db_info_api, params={
+            key: value for key, value in db_info_params.items() if value is not None}).json()
     except:
         print("Server request failed.")
         raise
@@ -166,41 +245,45 @@ def main():
             key=lambda x: datetime.datetime.strptime(x['log_date'], '%Y-%m-%d'),
             reverse=True)
 
-        n_downloaded = 0
+        entry_ids = [db_entries_list[i]['log_id'] for i in range(n_en)]
         n_skipped = 0
+        if not args.overwrite:
+            n_skipped = len([entry_id for entry_id in entry_ids if entry_id in logids])
+            entry_ids = [entry_id for entry_id in entry_ids if entry_id not in logids]
 
-        for i in range(n_en):
-            entry_id = db_entries_list[i]['log_id']
-
-            num_tries = 0
-            for num_tries in range(100):
+        n_downloaded = 0
+        n_failed = 0
+        n_bytes = 0
+        start_time = time.time()
+        executor = ThreadPoolExecutor(max_workers=max(1, args.num_workers))
+        futures = {executor.submit(download_log, entry_id, args): entry_id
+                   for entry_id in entry_ids}
+        try:
+            for i, future in enumerate(as_completed(futures), 1):
+                entry_id = futures[future]
                 try:
-                    if args.overwrite or entry_id not in logids:
-
-                        file_path = os.path.join(args.download_folder, entry_id + ".ulg")
-
-                        print('downloading {:}/{:} ({:})'.format(i + 1, n_en, entry_id))
-                        request = requests.get(url=args.download_api +
-                                               "?log=" + entry_id, stream=True)
-                        with open(file_path, 'wb') as log_file:
-                            for chunk in request.iter_content(chunk_size=1024):
-                                if chunk:  # filter out keep-alive new chunks
-                                    log_file.write(chunk)
-                        n_downloaded += 1
-                    else:
-                        n_skipped += 1
-                    break
+                    n_bytes += future.result()
+                    n_downloaded += 1
+                    result = 'done'
                 except Exception as ex:
-                    print(ex)
-                    print('Waiting for 30 seconds to retry')
-                    time.sleep(30)
-            if num_tries == 99:
-                print('Retried', str(num_tries + 1), 'times without success, exiting.')
-                sys.exit(1)
-
+                    n_failed += 1
+                    result = 'failed ({:})'.format(ex)
+                print('downloaded {:}/{:} ({:}): {:} ({:.1f} MB/s)'.format(
+                    i, len(futures), entry_id, result,
+                    n_bytes / 1e6 / (time.time() - start_time)))
+        except KeyboardInterrupt:
+            print('Interrupted. Run the script again to resume.')
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=False)
+            sys.exit(1)
+        executor.shutdown()
 
         print('{:} logs downloaded to {:}, {:} logs skipped (already downloaded)'.format(
             n_downloaded, args.download_folder, n_skipped))
+        if n_failed > 0:
+            print('{:} logs failed. Run the script again to retry them.'.format(n_failed))
+            sys.exit(1)
 
 
 if __name__ == '__main__':
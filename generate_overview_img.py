@@ -1,25 +1,122 @@
 #! /usr/bin/env python3
+""" Script to generate the overview images (map with the flight path) of all
+public logs. Existing images are skipped, as well as logs that are known to
+have no GPS data (Logs.OverviewImage = 0 in the DB), so the script can be
+interrupted and started again. """
 
+import argparse
 import os
 import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import sqlite3
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
-from plot_app.overview_generator import generate_overview_img_from_id
-from plot_app.config import get_db_filename
+from plot_app.overview_generator import generate_overview_img_job, set_overview_img_flag
+from plot_app.config import get_db_filename, get_overview_img_filepath
 
-# get the logs (but only the public ones)
-con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
-cur = con.cursor()
-cur.execute('SELECT Id FROM Logs WHERE Public = 1 ORDER BY Date DESC')
-db_tuples = cur.fetchall()
 
-for db_row in db_tuples:    
-    log_id=db_row[0]
-    generate_overview_img_from_id(log_id)
+def get_arguments():
+    """ Get parsed CLI arguments """
+    parser = argparse.ArgumentParser(description='Generate the overview images of all '
+                                                 'public logs that do not have one yet.',
+                                     formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--num-workers', '-j', type=int, default=os.cpu_count(),
+                        help='Number of worker processes')
+    parser.add_argument('--timeout', type=int, default=120,
+                        help='Maximum time in seconds for a single log')
+    parser.add_argument('--no-tiles', action='store_false', dest='with_tiles', default=True,
+                        help='Only draw the flight path, without map tiles')
+    parser.add_argument('--retry-no-gps', action='store_true', default=False,
+                        help='Also process logs that had no GPS data in a previous run')
+    return parser.parse_args()
 
-cur.close()
-con.close()
 
+def format_duration(seconds):
+    """ format a duration in seconds as h:mm:ss """
+    seconds = int(seconds)
+    return '{:}:{:02}:{:02}'.format(seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+
+def main():
+    """ main script entry point """
+    args = get_arguments()
+
+    # get the logs (but only the public ones)
+    con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+    cur = con.cursor()
+    cur.execute('SELECT Id, OverviewImage FROM Logs WHERE Public = 1 ORDER BY Date DESC')
+    db_tuples = cur.fetchall()
+
+    # skip logs with an existing image (listing the directory is much faster
+    # than checking each file) and logs that are known to have no GPS data
+    existing_images = set(os.listdir(get_overview_img_filepath()))
+    log_ids_to_process = []
+    log_ids_to_flag = []
+    num_existing = 0
+    num_no_gps = 0
+    for log_id, overview_image in db_tuples:
+        if log_id+'.png' in existing_images:
+            num_existing += 1
+            if overview_image != 1:
+                log_ids_to_flag.append((log_id,))
+        elif overview_image == 0 and not args.retry_no_gps:
+            num_no_gps += 1
+        else:
+            log_ids_to_process.append(log_id)
+    # images generated without updating the DB (e.g. by an older version)
+    if len(log_ids_to_flag) > 0:
+        with con:
+            cur.executemany('UPDATE Logs SET OverviewImage = 1 WHERE Id = ?', log_ids_to_flag)
+    cur.close()
+    con.close()
+
+    print('Generating {:} overview images ({:} public logs, {:} already done, '
+          '{:} without GPS)'.format(len(log_ids_to_process), len(db_tuples),
+                                    num_existing, num_no_gps))
+    if len(log_ids_to_process) == 0:
+        return
+
+    executor = ProcessPoolExecutor(max_workers=max(1, args.num_workers))
+    futures = {executor.submit(generate_overview_img_job, log_id, args.timeout,
+                               args.with_tiles): log_id
+               for log_id in log_ids_to_process}
+    start_time = time.time()
+    num_failed = 0
+    try:
+        for num_done, future in enumerate(as_completed(futures), 1):
+            log_id = futures[future]
+            try:
+                has_gps, render_time = future.result()
+                if has_gps:
+                    result = 'generated in {:.1f} s'.format(render_time)
+                else:
+                    result = 'no GPS'
+                # the flag is also used by the browse page
+                set_overview_img_flag(log_id, has_gps)
+            except Exception as error:
+                num_failed += 1
+                result = 'failed ({:})'.format(error)
+
+            elapsed = time.time() - start_time
+            rate = num_done / elapsed
+            eta = (len(futures) - num_done) / rate
+            print('[{:}/{:}] {:}: {:} ({:.1f} logs/s, elapsed {:}, ETA {:})'.format(
+                num_done, len(futures), log_id, result, rate,
+                format_duration(elapsed), format_duration(eta)))
+    except KeyboardInterrupt:
+        print('Interrupted. Run the script again to continue.')
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=False)
+        sys.exit(1)
+    executor.shutdown()
+
+    if num_failed > 0:
+        print('{:} logs failed. Run the script again to retry them.'.format(num_failed))
+
+
+if __name__ == '__main__':
+    main()
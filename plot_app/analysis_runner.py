@@ -0,0 +1,101 @@
+""" Run the (slow) PID & noise analyses in the background process pool and fill
+in the plots of the analysis pages progressively """
+
+from concurrent.futures.process import BrokenProcessPool
+from functools import partial
+
+from bokeh.layouts import column, widgetbox
+from bokeh.models.widgets import Div
+from bokeh.io import curdoc
+
+from config import plot_width
+from pid_analysis import submit_pid_analysis_job
+
+
+def get_analysis_message(html):
+    """ get a widget with a (error) message shown instead of a plot """
+    div = Div(text=html, width=int(plot_width*0.9))
+    return widgetbox(div, width=int(plot_width*0.9))
+
+
+def get_analysis_placeholder(text):
+    """ get a placeholder layout for a plot that is still being computed. Its
+    children are replaced by run_analysis_in_background() """
+    return column(get_analysis_message("<p><i>"+text+"</i></p>"))
+
+
+def run_analysis_in_background(analysis_function, analysis_inputs, placeholders,
+                               get_plot, plots, save_results, analysis_name):
+    """
+    run an analysis (PID or noise) in the process pool and replace each
+    placeholder with the plot as soon as its analysis completes. A progress
+    indicator is inserted at the top of the plots.
+    :param analysis_function: function executed in the pool, e.g. run_pid_analysis
+    :param analysis_inputs: dict of analysis key: analysis_function() arguments
+    :param placeholders: dict of analysis key: (placeholder layout, label)
+    :param get_plot: function(result, label) returning a plot
+    :param save_results: if not None, function(results) called to store all
+                         results when completed (unless the process pool broke)
+    :param analysis_name: name shown in the progress indicator
+    """
+    doc = curdoc()
+    results = {}
+    pool_failures = [] # analysis keys that failed because the process pool broke
+    num_analyses = len(placeholders)
+    progress_div = Div(text='', width=int(plot_width*0.9))
+    progress = widgetbox(progress_div, width=int(plot_width*0.9))
+    plots.insert(0, progress)
+
+    def _update_progress():
+        num_done = len(results)
+        if num_done < num_analyses:
+            progress_div.text = ('<p>Running {name}... {done}/{total} done '
+                                 '<progress value="{done}" max="{total}"></progress></p>'
+                                 .format(name=analysis_name, done=num_done,
+                                         total=num_analyses))
+        else:
+            progress_div.text = ''
+
+    def _show_result(key, result):
+        """ replace the placeholder (called from the document's IOLoop) """
+        results[key] = result
+        placeholder, label = placeholders[key]
+        placeholder.children = [get_plot(result, label)]
+        _update_progress()
+        if len(results) == num_analyses and save_results is not None \
+                and len(pool_failures) == 0:
+            save_results(results)
+
+    def _on_done(key, future):
+        """ called from the executor's thread: hand the result over to the
+        document, which must not be modified directly from another thread """
+        if future.cancelled():
+            return
+        try:
+            result = future.result()
+        except BrokenProcessPool as e:
+            # not a failure of the analysis itself: do not cache it
+            print(type(e), key, ":", e)
+            pool_failures.append(key)
+            result = None
+        except Exception as e:
+            print(type(e), key, ":", e)
+            result = None
+        doc.add_next_tick_callback(partial(_show_result, key, result))
+
+    _update_progress()
+    futures = []
+    for key in placeholders:
+        analysis_input = analysis_inputs.get(key, None)
+        if analysis_input is None:
+            _show_result(key, None)
+        else:
+            future = submit_pid_analysis_job(analysis_function, *analysis_input)
+            futures.append(future)
+            future.add_done_callback(partial(_on_done, key))
+
+    def _cancel_analysis(_session_context):
+        """ the page got closed: no need to run the remaining analyses """
+        for future in futures:
+            future.cancel()
+    doc.on_session_destroyed(_cancel_analysis)
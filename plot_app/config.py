@@ -30,6 +30,12 @@ __MAPBOX_API_ACCESS_TOKEN = _conf.get('general', 'mapbox_api_access_token')
 __BING_API_KEY = _conf.get('general', 'bing_maps_api_key')
 __CESIUM_API_KEY = _conf.get('general', 'cesium_api_key')
 __LOG_CACHE_SIZE = int(_conf.get('general', 'log_cache_size'))
+__MAP_POLYLINE_TOLERANCE = float(_conf.get('general', 'map_polyline_tolerance'))
+__OVERVIEW_TILE_SERVER = _conf.get('general', 'overview_tile_server')
+__TILE_CACHE_SIZE = int(_conf.get('general', 'tile_cache_size'))
+__OVERVIEW_TILES_OFFLINE = int(_conf.get('general', 'overview_tiles_offline'))
+__OVERVIEW_TILE_DIRECTORY = _conf.get('general', 'overview_tile_directory')
+__KML_CACHE_SIZE = int(_conf.get('general', 'kml_cache_size'))
 
 __STORAGE_PATH = _conf.get('general', 'storage_path')
 if not os.path.isabs(__STORAGE_PATH):
@@ -93,6 +99,26 @@ def get_overview_img_filepath():
     """ get configured overview image directory """
     return os.path.join(get_cache_filepath(), 'img')
 
+def get_overview_sprite_filepath():
+    """ get configured directory for the overview image sprites (browse page) """
+    return os.path.join(get_cache_filepath(), 'img_sprites')
+
+def get_pid_analysis_filepath():
+    """ get configured directory for cached PID analysis results """
+    return os.path.join(get_cache_filepath(), 'pid_analysis')
+
+def get_3d_filepath():
+    """ get configured directory for cached 3D view data """
+    return os.path.join(get_cache_filepath(), '3d')
+
+def get_tile_cache_filepath():
+    """ get configured directory for cached map tiles """
+    return os.path.join(get_cache_filepath(), 'tiles')
+
+def get_db_info_filepath():
+    """ get configured directory for the /dbinfo snapshot (public log list) """
+    return os.path.join(get_cache_filepath(), 'dbinfo')
+
 def get_db_filename():
     """ get configured DB file name """
     return __DB_FILENAME
@@ -133,6 +159,30 @@ def get_log_cache_size():
     """ get maximum number of cached logs in RAM """
     return __LOG_CACHE_SIZE
 
+def get_map_polyline_tolerance():
+    """ get the simplification tolerance of the map flight path in [m] """
+    return __MAP_POLYLINE_TOLERANCE
+
+def get_overview_tile_server():
+    """ get the tile server URL for the overview images """
+    return __OVERVIEW_TILE_SERVER
+
+def get_tile_cache_size():
+    """ get maximum size of the map tile cache in bytes """
+    return __TILE_CACHE_SIZE * 1024 * 1024
+
+def get_kml_cache_size():
+    """ get maximum size of the KML track cache in bytes """
+    return __KML_CACHE_SIZE * 1024 * 1024
+
+def get_overview_tiles_offline():
+    """ do not download map tiles for the overview images? """
+    return __OVERVIEW_TILES_OFFLINE == 1
+
+def get_overview_tile_directory():
+    """ get the local map tile directory (empty if not set) """
+    return __OVERVIEW_TILE_DIRECTORY
+
 def debug_print_timing():
     """ print timing information? """
     return __PRINT_TIMING == 1
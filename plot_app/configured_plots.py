@@ -1,18 +1,26 @@
 """ This contains the list of all drawn plots on the log plotting page """
 
+from functools import partial
 from html import escape
+import json
 
 from bokeh.layouts import widgetbox
 from bokeh.models import Range1d
-from bokeh.models.widgets import Div, Button
+from bokeh.models.widgets import Button
 from bokeh.io import curdoc
-from scipy.interpolate import interp1d
 
+from analysis_runner import (
+    get_analysis_message, get_analysis_placeholder, run_analysis_in_background
+    )
 from config import *
 from helper import *
 from leaflet import ulog_to_polyline
-from pid_analysis import Trace, plot_pid_response
+from pid_analysis import (
+    PID_ANALYSIS_TOPICS, plot_pid_response, run_pid_analysis,
+    get_pid_analysis_inputs, load_pid_analysis_results, save_pid_analysis_results
+    )
 from plotting import *
+from spectrum import DataPlotFFT
 from plotted_tables import (
     get_logged_messages, get_changed_parameters,
     get_info_table_html, get_heading_html, get_error_labels_html,
@@ -22,16 +30,11 @@ from plotted_tables import (
 #pylint: disable=cell-var-from-loop, undefined-loop-variable,
 #pylint: disable=consider-using-enumerate,too-many-statements
 
-def get_pid_analysis_plots(ulog, px4_ulog, db_data, link_to_main_plots):
+def get_pid_analysis_plots(ulog, px4_ulog, db_data, link_to_main_plots, log_id):
     """
     get all bokeh plots shown on the PID analysis page
     :return: list of bokeh plots
     """
-    def _resample(time_array, data, desired_time):
-        """ resample data at a given time to a vector of desired_time """
-        data_f = interp1d(time_array, data, fill_value='extrapolate')
-        return data_f(desired_time)
-
     page_intro = """
 <p>
 This page shows step response plots for the PID controller. The step
@@ -67,27 +70,52 @@ The analysis may take a while...
 
     # required PID response data
     pid_analysis_error = False
-    try:
-        rate_ctrl_status = ulog.get_dataset('rate_ctrl_status')
-        gyro_time = rate_ctrl_status.data['timestamp']
-        vehicle_attitude = ulog.get_dataset('vehicle_attitude')
-        attitude_time = vehicle_attitude.data['timestamp']
-        vehicle_rates_setpoint = ulog.get_dataset('vehicle_rates_setpoint')
-        vehicle_attitude_setpoint = ulog.get_dataset('vehicle_attitude_setpoint')
-        actuator_controls_0 = ulog.get_dataset('actuator_controls_0')
-        throttle = _resample(actuator_controls_0.data['timestamp'],
-                             actuator_controls_0.data['control[3]'] * 100, gyro_time)
-        time_seconds = gyro_time / 1e6
-    except (KeyError, IndexError, ValueError) as error:
-        print(type(error), ":", error)
+    missing_topics = [topic for topic in PID_ANALYSIS_TOPICS
+                      if not any(elem.name == topic for elem in data)]
+    if len(missing_topics) > 0:
+        print('PID analysis: missing topics', missing_topics)
         pid_analysis_error = True
-        div = Div(text="<p><b>Error</b>: missing topics or data for PID analysis "
-                  "(required topics: rate_ctrl_status, vehicle_rates_setpoint, "
-                  "vehicle_attitude, vehicle_attitude_setpoint and "
-                  "actuator_controls_0).</p>", width=int(plot_width*0.9))
-        plots.append(widgetbox(div, width=int(plot_width*0.9)))
+        plots.append(get_analysis_message(
+            "<p><b>Error</b>: missing topics or data for PID analysis "
+            "(required topics: rate_ctrl_status, vehicle_rates_setpoint, "
+            "vehicle_attitude, vehicle_attitude_setpoint and "
+            "actuator_controls_0).</p>"))
+
+    # use the cached analysis results if available. Otherwise the response
+    # plots are added as placeholders and filled in once the analysis of the
+    # axis (running in the background) completes
+    use_cache = not is_running_locally()
+    pid_results = None
+    if not pid_analysis_error and use_cache:
+        pid_results = load_pid_analysis_results(log_id)
+    placeholders = {} # analysis key: (placeholder layout, label)
+
+    def _get_pid_response_plot(trace_result, label):
+        """ get the PID response plot (or an error) for an analysis result """
+        if trace_result is not None:
+            try:
+                return plot_pid_response(trace_result, data, plot_config, label).bokeh_plot
+            except Exception as e:
+                print(type(e), label, ":", e)
+        return get_analysis_message(
+            "<p><b>Error</b>: PID analysis failed. Possible "
+            "error causes are: logged data rate is too low, there "
+            "is not enough motion for the analysis or simply a bug "
+            "in the code.</p>")
+
+    def _add_pid_response_plot(key, label):
+        """ add the PID response plot for an analysis key (or a placeholder) """
+        if pid_analysis_error:
+            return
+        if pid_results is not None:
+            plots.append(_get_pid_response_plot(pid_results.get(key, None), label))
+        else:
+            placeholder = get_analysis_placeholder(
+                "Computing the "+key.split('_')[1].capitalize()+" "+label+" step response...")
+            placeholders[key] = (placeholder, label)
+            plots.append(placeholder)
 
-    for index, axis in enumerate(['roll', 'pitch', 'yaw']):
+    for axis in ['roll', 'pitch', 'yaw']:
         axis_name = axis.capitalize()
         # rate
         data_plot = DataPlot(data, plot_config, 'actuator_controls_0',
@@ -139,56 +167,32 @@ The analysis may take a while...
         if data_plot.finalize() is not None: plots.append(data_plot.bokeh_plot)
 
         # PID response
-        if not pid_analysis_error:
-            try:
-                gyro_rate = np.rad2deg(rate_ctrl_status.data[axis+'speed'])
-                setpoint = _resample(vehicle_rates_setpoint.data['timestamp'],
-                                     np.rad2deg(vehicle_rates_setpoint.data[axis]),
-                                     gyro_time)
-                trace = Trace(axis, time_seconds, gyro_rate, setpoint, throttle)
-                plots.append(plot_pid_response(trace, ulog.data_list, plot_config).bokeh_plot)
-            except Exception as e:
-                print(type(e), axis, ":", e)
-                div = Div(text="<p><b>Error</b>: PID analysis failed. Possible "
-                          "error causes are: logged data rate is too low, there "
-                          "is not enough motion for the analysis or simply a bug "
-                          "in the code.</p>", width=int(plot_width*0.9))
-                plots.insert(0, widgetbox(div, width=int(plot_width*0.9)))
-                pid_analysis_error = True
+        _add_pid_response_plot('rate_'+axis, 'Rate')
 
     # attitude
-    if not pid_analysis_error:
-        throttle = _resample(actuator_controls_0.data['timestamp'],
-                             actuator_controls_0.data['control[3]'] * 100, attitude_time)
-        time_seconds = attitude_time / 1e6
     # don't plot yaw, as yaw is mostly controlled directly by rate
-    for index, axis in enumerate(['roll', 'pitch']):
-        axis_name = axis.capitalize()
-
+    for axis in ['roll', 'pitch']:
         # PID response
-        if not pid_analysis_error:
-            try:
-                attitude_estimated = np.rad2deg(vehicle_attitude.data[axis])
-                setpoint = _resample(vehicle_attitude_setpoint.data['timestamp'],
-                                     np.rad2deg(vehicle_attitude_setpoint.data[axis+'_d']),
-                                     attitude_time)
-                trace = Trace(axis, time_seconds, attitude_estimated, setpoint, throttle)
-                plots.append(plot_pid_response(trace, ulog.data_list, plot_config,
-                                               'Angle').bokeh_plot)
-            except Exception as e:
-                print(type(e), axis, ":", e)
-                div = Div(text="<p><b>Error</b>: PID analysis failed. Possible "
-                          "error causes are: logged data rate is too low, there "
-                          "is not enough motion for the analysis or simply a bug "
-                          "in the code.</p>", width=int(plot_width*0.9))
-                plots.insert(0, widgetbox(div, width=int(plot_width*0.9)))
-                pid_analysis_error = True
+        _add_pid_response_plot('angle_'+axis, 'Angle')
+
+    if len(placeholders) > 0:
+        try:
+            analysis_inputs = get_pid_analysis_inputs(ulog)
+        except (KeyError, IndexError, ValueError) as error:
+            print(type(error), ":", error)
+            analysis_inputs = {}
+        save_results = None
+        if use_cache:
+            save_results = partial(save_pid_analysis_results, log_id)
+        run_analysis_in_background(run_pid_analysis, analysis_inputs, placeholders,
+                                   _get_pid_response_plot, plots, save_results,
+                                   'PID analysis')
 
     return plots
 
 
 def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
-                   link_to_pid_analysis_page):
+                   link_to_pid_analysis_page, link_to_noise_analysis_page):
     """ create a list of bokeh plots (and widgets) to show """
 
     plots = []
@@ -242,7 +246,8 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
     # Heading
     curdoc().template_variables['title_html'] = get_heading_html(
         ulog, px4_ulog, db_data, link_to_3d_page,
-        additional_links=[("Open PID Analysis", link_to_pid_analysis_page)])
+        additional_links=[("Open PID Analysis", link_to_pid_analysis_page),
+                          ("Open Noise Analysis", link_to_noise_analysis_page)])
 
     # info text on top (logging duration, max speed, ...)
     curdoc().template_variables['info_table_html'] = \
@@ -277,12 +282,12 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
 
             # Leaflet Map
             try:
-                pos_datas, flight_modes = ulog_to_polyline(ulog, flight_mode_changes)
-                curdoc().template_variables['pos_datas'] = pos_datas
-                curdoc().template_variables['pos_flight_modes'] = flight_modes
+                pos_polylines = ulog_to_polyline(ulog, flight_mode_changes)
+                if len(pos_polylines) > 0:
+                    curdoc().template_variables['pos_polylines'] = json.dumps(pos_polylines)
+                    curdoc().template_variables['has_position_data'] = True
             except:
                 pass
-            curdoc().template_variables['has_position_data'] = True
 
     # initialize parameter changes
     changed_params = None
@@ -549,11 +554,15 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
     data_plot.add_graph(['control[0]', 'control[1]', 'control[2]', 'control[3]'],
                         colors8[0:4], ['Roll', 'Pitch', 'Yaw', 'Thrust'], mark_nan=True)
     plot_flight_modes_background(data_plot, flight_mode_changes, vtol_states)
+    actuator_controls_0_x_range = data_plot.bokeh_plot.x_range
     if data_plot.finalize() is not None: plots.append(data_plot)
 
     # actuator controls (Main) FFT (for filter & output noise analysis)
+    # (optionally recomputed for the visible time range of the actuator controls
+    # 0 plot above, see the button below)
     data_plot = DataPlotFFT(data, plot_config, 'actuator_controls_0',
-                            title='Actuator Controls FFT')
+                            title='Actuator Controls FFT', dropouts=ulog.dropouts,
+                            time_range=actuator_controls_0_x_range)
     data_plot.add_graph(['control[0]', 'control[1]', 'control[2]'],
                         colors3, ['Roll', 'Pitch', 'Yaw'])
     if not data_plot.had_error:
@@ -566,7 +575,21 @@ def generate_plots(ulog, px4_ulog, db_data, vehicle_data, link_to_3d_page,
                 ulog.initial_parameters['IMU_GYRO_CUTOFF'],
                 'IMU_GYRO_CUTOFF', 20)
 
-    if data_plot.finalize() is not None: plots.append(data_plot)
+    if data_plot.finalize() is not None:
+        plots.append(data_plot)
+        fft_time_range_button = Button(label="Use Visible Time Range for the FFT", width=250)
+        fft_data_plot = data_plot
+        def fft_time_range_button_clicked():
+            """ callback to switch between the FFT of the whole log and of the
+            visible time range """
+            follow_time_range = not fft_data_plot.follow_time_range
+            fft_data_plot.set_follow_time_range(follow_time_range)
+            if follow_time_range:
+                fft_time_range_button.label = 'Use Whole Log for the FFT'
+            else:
+                fft_time_range_button.label = 'Use Visible Time Range for the FFT'
+        fft_time_range_button.on_click(fft_time_range_button_clicked)
+        plots.append(widgetbox(fft_time_range_button, width=int(plot_width * 0.99)))
 
 
     # actuator controls 1
@@ -5,13 +5,22 @@ from html import escape
 from pyulog import *
 from pyulog.px4 import *
 
-from helper import get_log_filename, load_ulog_file
+from config_tables import flight_modes_table
+from helper import get_log_filename, load_ulog_file, get_airframe_data
 
 #pylint: disable=missing-docstring, too-few-public-methods
 
 class DBData:
     """ simple class that contains information from the DB entry of a single
     log file """
+
+    # displayed strings of the ratings
+    RATING_STRINGS = {'crash_pilot': 'Crashed (Pilot error)',
+                      'crash_sw_hw': 'Crashed (Software or Hardware issue)',
+                      'unsatisfactory': 'Unsatisfactory',
+                      'good': 'Good',
+                      'great': 'Great!'}
+
     def __init__(self):
         self.description = ''
         self.feedback = ''
@@ -36,11 +45,7 @@ class DBData:
 
     @staticmethod
     def rating_str_static(rating):
-        return {'crash_pilot': 'Crashed (Pilot error)',
-                'crash_sw_hw': 'Crashed (Software or Hardware issue)',
-                'unsatisfactory': 'Unsatisfactory',
-                'good': 'Good',
-                'great': 'Great!'}.get(rating, '')
+        return DBData.RATING_STRINGS.get(rating, '')
 
     def to_json_dict(self):
         jsondict = dict()
@@ -80,6 +85,30 @@ class DBDataGenerated:
             ret.append(str(duration[0])+':'+str(duration[1]))
         return ','.join(ret)
 
+    # the following are for displaying (and stored in the DB, so that they
+    # can be sorted and do not need to be computed for every request)
+
+    def airframe_name_and_type(self):
+        """ get the airframe name and type ('' if unknown) """
+        airframe_data = get_airframe_data(self.sys_autostart_id)
+        if airframe_data is None:
+            return '', ''
+        return airframe_data.get('name', ''), airframe_data.get('type', '')
+
+    def release_tag(self):
+        """ get the release version (e.g. 'v1.9.0') or '' if not a release """
+        try:
+            release_split = self.ver_sw_release.split()
+            if int(release_split[1]) == 255: # it's a release
+                return release_split[0]
+        except (IndexError, ValueError):
+            pass
+        return ''
+
+    def flight_mode_names_str(self):
+        return ', '.join([flight_modes_table[x][0] for x in sorted(self.flight_modes)
+                          if x in flight_modes_table])
+
     @classmethod
     def from_log_file(cls, log_id):
         """ initialize from a log file """
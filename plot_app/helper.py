@@ -11,6 +11,7 @@ from urllib.request import urlretrieve
 import xml.etree.ElementTree # airframe parsing
 import shutil
 import uuid
+from contextlib import contextmanager
 import numpy as np
 
 from pyulog import *
@@ -20,7 +21,14 @@ from config_tables import *
 from config import get_log_filepath, get_airframes_filename, get_airframes_url, \
                    get_parameters_filename, get_parameters_url, \
                    get_log_cache_size, debug_print_timing, \
-                   get_releases_filename
+                   get_releases_filename, get_pid_analysis_filepath, \
+                   get_3d_filepath, get_kml_filepath, get_db_info_filepath
+
+# file locking is optional (not available on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 #pylint: disable=line-too-long, global-variable-not-assigned,invalid-name,global-statement
 
@@ -74,6 +82,56 @@ def get_log_filename(log_id):
 
 __last_failed_downloads = {} # dict with key=file name and a timestamp of last failed download
 
+def get_analysis_cache_filename(log_id, analysis):
+    """ get the file name of the cached analysis results for a log id
+    :param analysis: 'pid' or 'noise'
+    """
+    return os.path.join(get_pid_analysis_filepath(),
+                        log_id.replace('/', '.')+'.'+analysis+'.pickle')
+
+def get_3d_cache_filename(log_id):
+    """ get the file name of the cached 3D view data for a log id """
+    return os.path.join(get_3d_filepath(), log_id.replace('/', '.')+'.json.gz')
+
+def get_kml_cache_filename(log_id):
+    """ get the file name of the cached KML track (as KMZ) for a log id """
+    return os.path.join(get_kml_filepath(), log_id.replace('/', '.')+'.kmz')
+
+def get_db_info_snapshot_filename():
+    """ get the file name of the /dbinfo snapshot (gzipped JSON list) """
+    return os.path.join(get_db_info_filepath(), 'dbinfo.json.gz')
+
+def get_db_info_entries_filename():
+    """ get the file name of the serialized /dbinfo entries (one log per line),
+    from which the snapshot is updated incrementally """
+    return os.path.join(get_db_info_filepath(), 'dbinfo_entries.txt')
+
+@contextmanager
+def db_info_snapshot_lock():
+    """ exclusive lock (also across processes) for modifying the /dbinfo
+    snapshot files """
+    with open(os.path.join(get_db_info_filepath(), 'lock'), 'w') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX) # released when closing the file
+        yield
+
+def clear_db_info_snapshot():
+    """ remove the /dbinfo snapshot, so that it is regenerated from the DB on
+    the next request (e.g. after modifying the DB outside of the server) """
+    if not os.path.exists(get_db_info_filepath()):
+        return
+    with db_info_snapshot_lock():
+        for file_name in [get_db_info_snapshot_filename(), get_db_info_entries_filename()]:
+            if os.path.exists(file_name):
+                os.unlink(file_name)
+
+def remove_pid_analysis_results(cur, log_id):
+    """ remove the stored PID analysis metrics of a log (the PIDAnalysis table
+    only exists once setup_db.py was run after updating) """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'PIDAnalysis'")
+    if cur.fetchone() is not None:
+        cur.execute('DELETE FROM PIDAnalysis WHERE Id = ?', (log_id,))
+
 def download_file_maybe(filename, url):
     """ download an url to filename if it does not exist or it's older than a day.
         returns True if the file can be used
@@ -216,31 +274,33 @@ def WGS84_to_mercator(lon, lat):
 
     return easting, northing
 
-def map_projection(lat, lon, anchor_lat, anchor_lon):
-    """ convert lat, lon in [rad] to x, y in [m] with an anchor position """
+def map_projection(lat, lon, anchor_lat, anchor_lon, dtype=np.float64):
+    """ convert lat, lon in [rad] to x, y in [m] with an anchor position
+    :param dtype: floating point type used for the computation and the result.
+                  np.float32 halves the memory and is faster, with an error in
+                  the order of a meter.
+    """
+    # compute the longitude difference before converting to keep its precision
+    d_lon = np.asarray(lon - anchor_lon, dtype=dtype)
+    lat = np.asarray(lat, dtype=dtype)
     sin_lat = np.sin(lat)
     cos_lat = np.cos(lat)
-    cos_d_lon = np.cos(lon - anchor_lon)
-    sin_anchor_lat = np.sin(anchor_lat)
-    cos_anchor_lat = np.cos(anchor_lat)
+    cos_d_lon = np.cos(d_lon)
+    sin_anchor_lat = dtype(np.sin(anchor_lat))
+    cos_anchor_lat = dtype(np.cos(anchor_lat))
 
     arg = sin_anchor_lat * sin_lat + cos_anchor_lat * cos_lat * cos_d_lon
-    arg[arg > 1] = 1
-    arg[arg < -1] = -1
+    np.clip(arg, -1, 1, out=arg)
 
-    np.set_printoptions(threshold=sys.maxsize)
+    # k = c / sin(c), which is 1 for c -> 0
     c = np.arccos(arg)
-    k = np.copy(lat)
-    for i in range(len(lat)):
-        if np.abs(c[i]) < np.finfo(float).eps:
-            k[i] = 1
-        else:
-            k[i] = c[i] / np.sin(c[i])
+    k = np.ones_like(c)
+    np.divide(c, np.sin(c), out=k, where=np.abs(c) >= np.finfo(dtype).eps)
 
     CONSTANTS_RADIUS_OF_EARTH = 6371000
     x = k * (cos_anchor_lat * sin_lat - sin_anchor_lat * cos_lat * cos_d_lon) * \
-        CONSTANTS_RADIUS_OF_EARTH
-    y = k * cos_lat * np.sin(lon - anchor_lon) * CONSTANTS_RADIUS_OF_EARTH
+        dtype(CONSTANTS_RADIUS_OF_EARTH)
+    y = k * cos_lat * np.sin(d_lon) * dtype(CONSTANTS_RADIUS_OF_EARTH)
 
     return x, y
 
@@ -284,6 +344,21 @@ class ULogException(Exception):
     """
     pass
 
+# topics loaded by load_ulog_file (the ones we really need)
+ULOG_CACHED_TOPICS = ['battery_status', 'distance_sensor', 'estimator_status',
+                      'sensor_combined', 'cpuload',
+                      'vehicle_gps_position', 'vehicle_local_position',
+                      'vehicle_local_position_setpoint',
+                      'vehicle_global_position', 'actuator_controls_0',
+                      'actuator_controls_1', 'actuator_outputs',
+                      'vehicle_attitude', 'vehicle_attitude_setpoint',
+                      'vehicle_rates_setpoint', 'rc_channels', 'input_rc',
+                      'position_setpoint_triplet', 'vehicle_attitude_groundtruth',
+                      'vehicle_local_position_groundtruth', 'vehicle_visual_odometry',
+                      'vehicle_status', 'airspeed', 'manual_control_setpoint',
+                      'rate_ctrl_status', 'vehicle_air_data',
+                      'vehicle_magnetometer', 'system_power', 'camera_capture']
+
 @lru_cache(maxsize=get_log_cache_size())
 def load_ulog_file(file_name):
     """ load an ULog file
@@ -292,22 +367,8 @@ def load_ulog_file(file_name):
     # The reason to put this method into helper is that the main module gets
     # (re)loaded on each page request. Thus the caching would not work there.
 
-    # load only the messages we really need
-    msg_filter = ['battery_status', 'distance_sensor', 'estimator_status',
-                  'sensor_combined', 'cpuload',
-                  'vehicle_gps_position', 'vehicle_local_position',
-                  'vehicle_local_position_setpoint',
-                  'vehicle_global_position', 'actuator_controls_0',
-                  'actuator_controls_1', 'actuator_outputs',
-                  'vehicle_attitude', 'vehicle_attitude_setpoint',
-                  'vehicle_rates_setpoint', 'rc_channels', 'input_rc',
-                  'position_setpoint_triplet', 'vehicle_attitude_groundtruth',
-                  'vehicle_local_position_groundtruth', 'vehicle_visual_odometry',
-                  'vehicle_status', 'airspeed', 'manual_control_setpoint',
-                  'rate_ctrl_status', 'vehicle_air_data',
-                  'vehicle_magnetometer', 'system_power']
     try:
-        ulog = ULog(file_name, msg_filter, disable_str_exceptions=False)
+        ulog = ULog(file_name, ULOG_CACHED_TOPICS, disable_str_exceptions=False)
     except FileNotFoundError:
         print("Error: file %s not found" % file_name)
         raise
@@ -385,6 +446,31 @@ def get_flight_mode_changes(ulog):
         flight_mode_changes = []
     return flight_mode_changes
 
+def load_ulog_topic(file_name, topic_name):
+    """ load a single topic of an ULog file (e.g. for the data export). Topics
+    of load_ulog_file are taken from there. Each other topic name takes an
+    entry of the cache, so validate user input first (e.g. against the
+    message_formats of the log).
+    :return: ULog object
+    """
+    if topic_name in ULOG_CACHED_TOPICS:
+        return load_ulog_file(file_name)
+    return __load_ulog_single_topic(file_name, topic_name)
+
+@lru_cache(maxsize=get_log_cache_size())
+def __load_ulog_single_topic(file_name, topic_name):
+    """ cached part of load_ulog_topic(): only the ULog objects with a single
+    topic are cached here (the others are owned by the load_ulog_file cache)
+    """
+    try:
+        return ULog(file_name, [topic_name], disable_str_exceptions=False)
+    except FileNotFoundError:
+        print("Error: file %s not found" % file_name)
+        raise
+    except Exception as error:
+        traceback.print_exception(*sys.exc_info())
+        raise ULogException()
+
 def print_cache_info():
     """ print information about the ulog cache """
     print(load_ulog_file.cache_info())
@@ -392,6 +478,7 @@ def print_cache_info():
 def clear_ulog_cache():
     """ clear/invalidate the ulog cache """
     load_ulog_file.cache_clear()
+    __load_ulog_single_topic.cache_clear()
 
 def validate_error_ids(err_ids):
     """
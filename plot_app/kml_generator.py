@@ -0,0 +1,242 @@
+"""
+Module for generating the KML track of a log (and the on-disk KMZ cache)
+"""
+
+import os
+import threading
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from xml.sax.saxutils import escape
+import numpy as np
+
+from config import get_kml_filepath, get_kml_cache_size
+from helper import flight_modes_table, get_flight_mode_changes, get_kml_cache_filename
+
+#pylint: disable=invalid-name
+
+KML_POSITION_TOPIC = 'vehicle_global_position'
+KML_CAMERA_TRIGGER_TOPIC = 'camera_capture'
+KML_MIN_INTERVAL_S = 0.1 # minimum time between two track points
+KML_LINE_WIDTH = 2
+KMZ_DOC_NAME = 'doc.kml' # name of the KML file within the KMZ archive
+
+_KML_HEADER = ('<?xml version="1.0" encoding="UTF-8"?>\n'
+               '<kml xmlns="http://www.opengis.net/kml/2.2">\n'
+               '<Document>\n')
+_KML_FOOTER = '</Document>\n</kml>\n'
+
+
+def kml_color(flight_mode):
+    """ flight mode color for KML files, in the form 'aabbggrr' """
+    if not flight_mode in flight_modes_table: flight_mode = 0
+
+    color_str = flight_modes_table[flight_mode][1][1:] # color in form 'ff00aa'
+
+    # increase brightness to match colors with template
+    rgb = [min(int(color_str[2*x:2*x+2], 16) + 40, 255) for x in range(3)]
+    return 'ff{:02x}{:02x}{:02x}'.format(rgb[2], rgb[1], rgb[0])
+
+
+def _get_position(data, field_data):
+    """ get lon, lat [deg] and alt [m] from a position topic (supporting the
+    old integer and the newer *_deg field names) """
+    lon = data['lon'] if 'lon' in data else data['longitude_deg']
+    lat = data['lat'] if 'lat' in data else data['latitude_deg']
+    alt = data['alt'] if 'alt' in data else data['altitude_msl_m']
+    lon_type = [f.type_str for f in field_data if f.field_name == 'lon']
+    if len(lon_type) > 0 and lon_type[0] == 'int32_t':
+        return lon / 1e7, lat / 1e7, alt / 1e3
+    return lon, lat, alt
+
+
+def _format_coordinates(lon, lat, alt):
+    """ format the coordinates of a track as KML string. All values are
+    formatted in a single operation, which is much faster than per point """
+    coordinates = np.empty((len(lon), 3))
+    coordinates[:, 0] = lon
+    coordinates[:, 1] = lat
+    coordinates[:, 2] = alt
+    return ('%.8f,%.8f,%.2f\n' * len(lon)) % tuple(coordinates.ravel().tolist())
+
+
+def generate_kml(ulog):
+    """ create the KML track of a log: one line per flight mode segment, and
+    the camera trigger points (if any)
+    :param ulog: ULog object (with vehicle_global_position and vehicle_status)
+    :return: KML document (str), or None if there is no position data
+    """
+    try:
+        cur_dataset = ulog.get_dataset(KML_POSITION_TOPIC)
+    except (KeyError, IndexError, ValueError):
+        return None
+    lon, lat, alt = _get_position(cur_dataset.data, cur_dataset.field_data)
+    timestamps = cur_dataset.data['timestamp']
+    if len(timestamps) == 0:
+        return None
+
+    # use at most one point per interval
+    time_bins = (timestamps - timestamps[0]).astype(np.int64) // int(KML_MIN_INTERVAL_S * 1e6)
+    keep = np.ones(len(timestamps), dtype=bool)
+    keep[1:] = np.diff(time_bins) != 0
+    lon, lat, alt, timestamps = lon[keep], lat[keep], alt[keep], timestamps[keep]
+
+    # flight mode segment of each point (points before the first change
+    # belong to the first mode). The last change marks the end of the log.
+    flight_mode_changes = get_flight_mode_changes(ulog)[:-1]
+    if len(flight_mode_changes) > 0:
+        change_times = np.array([t for t, _ in flight_mode_changes])
+        modes = [mode for _, mode in flight_mode_changes]
+        segment_index = np.clip(np.searchsorted(change_times, timestamps, side='right') - 1,
+                                0, len(modes) - 1)
+    else:
+        modes = [0]
+        segment_index = np.zeros(len(timestamps), dtype=np.int64)
+
+    kml = [_KML_HEADER]
+    # a new segment also starts with the last point of the previous one, so
+    # that the track is continuous
+    segment_starts = np.concatenate(([0], np.flatnonzero(np.diff(segment_index)) + 1))
+    segment_ends = np.concatenate((segment_starts[1:] + 1, [len(timestamps)]))
+    for start, end in zip(segment_starts, segment_ends):
+        flight_mode = modes[segment_index[start]]
+        kml.append('<Placemark>\n<name>{:}:{:}</name>\n'
+                   '<Style><LineStyle><color>{:}</color><width>{:}</width></LineStyle></Style>\n'
+                   '<LineString>\n<altitudeMode>absolute</altitudeMode>\n<coordinates>\n'
+                   .format(KML_POSITION_TOPIC, flight_mode, kml_color(flight_mode),
+                           KML_LINE_WIDTH))
+        kml.append(_format_coordinates(lon[start:end], lat[start:end], alt[start:end]))
+        kml.append('</coordinates>\n</LineString>\n</Placemark>\n')
+
+    # camera triggers
+    try:
+        cur_dataset = ulog.get_dataset(KML_CAMERA_TRIGGER_TOPIC)
+        lon, lat, alt = _get_position(cur_dataset.data, cur_dataset.field_data)
+        for sequence, coordinates in zip(
+                cur_dataset.data['seq'], _format_coordinates(lon, lat, alt).split()):
+            kml.append('<Placemark>\n<name>{:}</name>\n<Point>\n<coordinates>{:}</coordinates>\n'
+                       '</Point>\n</Placemark>\n'
+                       .format(escape('Camera Trigger '+str(sequence)), coordinates))
+    except (KeyError, IndexError, ValueError):
+        pass
+
+    kml.append(_KML_FOOTER)
+    return ''.join(kml)
+
+
+def kml_to_kmz(kml):
+    """ compress a KML document into a KMZ archive
+    :return: bytes
+    """
+    output = BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as kmz_file:
+        kmz_file.writestr(KMZ_DOC_NAME, kml)
+    return output.getvalue()
+
+
+def kmz_to_kml(kmz):
+    """ extract the KML document from a KMZ archive
+    :return: bytes
+    """
+    with zipfile.ZipFile(BytesIO(kmz)) as kmz_file:
+        return kmz_file.read(KMZ_DOC_NAME)
+
+
+def load_kmz(log_id):
+    """ load the cached KML track of a log
+    :return: KMZ data (bytes) or None if not cached
+    """
+    cache_file_name = get_kml_cache_filename(log_id)
+    try:
+        with open(cache_file_name, 'rb') as cache_file:
+            data = cache_file.read()
+        os.utime(cache_file_name) # mark as recently used
+        return data
+    except OSError:
+        return None
+
+
+__kml_cache_size = {'size': None, 'lock': threading.Lock()}
+def save_kmz(log_id, kmz):
+    """ store the KML track of a log on disk, and remove the least recently
+    used tracks if the cache gets too large """
+    cache_file_name = get_kml_cache_filename(log_id)
+    # write to a random temporary file, then move it (to avoid races)
+    temp_file_name = cache_file_name+'.'+str(uuid.uuid4())
+    try:
+        with open(temp_file_name, 'wb') as cache_file:
+            cache_file.write(kmz)
+        os.replace(temp_file_name, cache_file_name)
+    except OSError as e:
+        print('Failed to store KML cache file', cache_file_name, e)
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+        return
+
+    with __kml_cache_size['lock']:
+        if __kml_cache_size['size'] is None:
+            __kml_cache_size['size'] = sum(size for _, _, size in _list_kml_cache())
+        else:
+            __kml_cache_size['size'] += len(kmz)
+        if __kml_cache_size['size'] > get_kml_cache_size():
+            # remove down to 90% of the maximum size, to avoid doing it on every insertion
+            files = sorted(_list_kml_cache(), key=lambda file: file[1])
+            __kml_cache_size['size'] = sum(size for _, _, size in files)
+            target_size = get_kml_cache_size() * 0.9
+            for file_name, _, size in files:
+                if __kml_cache_size['size'] <= target_size:
+                    break
+                try:
+                    os.unlink(file_name)
+                except OSError:
+                    pass
+                __kml_cache_size['size'] -= size
+
+
+def _list_kml_cache():
+    """ get all cached tracks as list of (file name, mtime, size) """
+    files = []
+    kml_path = get_kml_filepath()
+    for file_name in os.listdir(kml_path):
+        full_file_name = os.path.join(kml_path, file_name)
+        try:
+            stat = os.stat(full_file_name)
+        except OSError: # removed in the meantime
+            continue
+        files.append((full_file_name, stat.st_mtime, stat.st_size))
+    return files
+
+
+def get_kmz(log_id, ulog):
+    """ get the KML track of a log from the cache, or generate (and cache) it
+    :param ulog: ULog object, or a callable that returns it (only called if
+                 the track is not cached)
+    :return: KMZ data (bytes), or None if the log has no position data
+    """
+    kmz = load_kmz(log_id)
+    if kmz is not None:
+        return kmz
+    if callable(ulog):
+        ulog = ulog()
+    kml = generate_kml(ulog)
+    if kml is None:
+        return None
+    kmz = kml_to_kmz(kml)
+    save_kmz(log_id, kmz)
+    return kmz
+
+
+__kml_executor = {'executor': None}
+def precompute_kml(log_id, ulog):
+    """ generate the KML track of a (loaded) log in a background thread, so
+    that the download does not have to wait for it """
+    if __kml_executor['executor'] is None:
+        __kml_executor['executor'] = ThreadPoolExecutor(max_workers=1)
+
+    def generate():
+        try:
+            get_kmz(log_id, ulog)
+        except Exception as e:
+            print('Failed to generate the KML track of', log_id, e)
+    __kml_executor['executor'].submit(generate)
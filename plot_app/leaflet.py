@@ -1,14 +1,21 @@
 """ Data extraction/conversion methods to get the flight path that is passed to
 a Leaflet map via jinja arguments """
 
+import numpy as np
+
 from colors import HTML_color_to_RGB
+from config import get_map_polyline_tolerance
 from config_tables import flight_modes_table
+from helper import map_projection
 
-#pylint: disable=consider-using-enumerate
 
 def ulog_to_polyline(ulog, flight_mode_changes):
-    """ extract flight mode colors and position data from the log
-        :return: tuple(position data list, flight modes)
+    """ extract flight mode colors and position data from the log.
+        The path is simplified (Douglas-Peucker with the configured tolerance)
+        and split into one polyline per flight mode.
+        :return: list of [color, encoded polyline] (Google encoded polyline
+                 format, with a precision of 1e-5 degrees). Consecutive
+                 polylines share their boundary point.
     """
     def rgb_colors(flight_mode):
         """ flight mode color from a flight mode """
@@ -25,14 +32,12 @@ def ulog_to_polyline(ulog, flight_mode_changes):
     cur_data = ulog.get_dataset('vehicle_gps_position')
     pos_lon = cur_data.data['lon']
     pos_lat = cur_data.data['lat']
-    pos_alt = cur_data.data['alt']
     pos_t = cur_data.data['timestamp']
 
     if 'fix_type' in cur_data.data:
         indices = cur_data.data['fix_type'] > 2  # use only data with a fix
         pos_lon = pos_lon[indices]
         pos_lat = pos_lat[indices]
-        pos_alt = pos_alt[indices]
         pos_t = pos_t[indices]
 
     # scale if it's an integer type
@@ -40,22 +45,107 @@ def ulog_to_polyline(ulog, flight_mode_changes):
     if len(lon_type) > 0 and lon_type[0] == 'int32_t':
         pos_lon = pos_lon / 1e7  # to degrees
         pos_lat = pos_lat / 1e7
-        pos_alt = pos_alt / 1e3  # to meters
 
-    pos_datas = []
-    flight_modes = []
-    last_t = 0
+    if len(pos_t) == 0:
+        return []
+
+    # use at most one sample per minimum interval
     minimum_interval_s = 0.1
-    current_flight_mode_idx = 0
-    for i in range(len(pos_lon)):
-        curr_t = pos_t[i]
-        if (curr_t - last_t) / 1e6 > minimum_interval_s:
-            pos_datas.append([pos_lat[i], pos_lon[i]])
-            last_t = curr_t
-            while current_flight_mode_idx < len(flight_mode_changes) - 1 and \
-                    flight_mode_changes[current_flight_mode_idx][0] <= curr_t:
-                current_flight_mode = flight_mode_changes[current_flight_mode_idx][1]
-                current_flight_mode_idx += 1
-                flight_modes.append([rgb_colors(current_flight_mode), i])
-    flight_modes.append(['', len(pos_lon)])
-    return (pos_datas, flight_modes)
+    intervals = (pos_t - pos_t[0]).astype(np.int64) // int(minimum_interval_s * 1e6)
+    _, indices = np.unique(intervals, return_index=True)
+    pos_lon = pos_lon[indices]
+    pos_lat = pos_lat[indices]
+    pos_t = pos_t[indices]
+
+    # flight mode of each sample (the last change is the end of the log)
+    mode_change_times = np.array([t for t, _ in flight_mode_changes[:-1]], dtype=np.uint64)
+    mode_change_modes = [mode for _, mode in flight_mode_changes[:-1]]
+    if len(mode_change_modes) == 0:
+        mode_change_times = np.zeros(1, dtype=np.uint64)
+        mode_change_modes = [0]
+    mode_idx = np.searchsorted(mode_change_times, pos_t, side='right') - 1
+    np.clip(mode_idx, 0, None, out=mode_idx)
+    # start index of each flight mode run
+    run_starts = np.flatnonzero(np.diff(mode_idx)) + 1
+    run_starts = np.insert(run_starts, 0, 0)
+    run_ends = np.append(run_starts[1:], len(pos_t))
+
+    # simplify in local coordinates [m]
+    lat_rad = np.deg2rad(pos_lat)
+    lon_rad = np.deg2rad(pos_lon)
+    pos_x, pos_y = map_projection(lat_rad, lon_rad, lat_rad[0], lon_rad[0])
+    tolerance = get_map_polyline_tolerance()
+
+    polylines = []
+    for start, end in zip(run_starts, run_ends):
+        # include the first point of the next run to connect the polylines
+        end = min(end + 1, len(pos_t))
+        keep = douglas_peucker(pos_x[start:end], pos_y[start:end], tolerance)
+        polylines.append([rgb_colors(mode_change_modes[mode_idx[start]]),
+                          encode_polyline(pos_lat[start:end][keep],
+                                          pos_lon[start:end][keep])])
+    return polylines
+
+
+def douglas_peucker(x, y, tolerance):
+    """ Douglas-Peucker line simplification
+        :param tolerance: maximum distance of a removed point to the simplified
+                          line (same unit as x, y). 0 or less keeps all points.
+        :return: boolean mask of the points to keep
+    """
+    num_points = len(x)
+    keep = np.zeros(num_points, dtype=bool)
+    if num_points == 0:
+        return keep
+    keep[0] = keep[-1] = True
+    if tolerance <= 0:
+        keep[:] = True
+        return keep
+
+    stack = [(0, num_points - 1)]
+    while len(stack) > 0:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        # distance of the intermediate points to the line first -> last
+        dx = x[last] - x[first]
+        dy = y[last] - y[first]
+        rel_x = x[first+1:last] - x[first]
+        rel_y = y[first+1:last] - y[first]
+        segment_length = np.hypot(dx, dy)
+        if segment_length > 0:
+            distances = np.abs(dx * rel_y - dy * rel_x) / segment_length
+        else:
+            distances = np.hypot(rel_x, rel_y)
+        max_idx = np.argmax(distances)
+        if distances[max_idx] > tolerance:
+            split = first + 1 + max_idx
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+    return keep
+
+
+def encode_polyline(lat, lon, precision=5):
+    """ encode coordinates in [deg] in the (Google) encoded polyline format
+        :return: string
+    """
+    factor = 10 ** precision
+    # interleaved lat, lon deltas of the rounded coordinates
+    values = np.empty(2 * len(lat), dtype=np.int64)
+    values[0::2] = np.round(np.asarray(lat) * factor)
+    values[1::2] = np.round(np.asarray(lon) * factor)
+    values[2:] = values[2:] - values[:-2]
+
+    # zigzag: left shift, invert negative values
+    values = np.where(values < 0, ~(values << 1), values << 1)
+
+    # split into 5 bit chunks (least significant first), where all but the
+    # last chunk of a value have the continuation bit 0x20 set
+    shifts = np.arange(7, dtype=np.int64) * 5
+    chunks = (values[:, np.newaxis] >> shifts) & 0x1f
+    num_chunks = 1 + np.sum((values[:, np.newaxis] >> shifts[1:]) > 0, axis=1)
+    chunk_idx = np.arange(len(shifts))
+    chunks[chunk_idx < (num_chunks[:, np.newaxis] - 1)] |= 0x20
+    chars = (chunks + 63)[chunk_idx < num_chunks[:, np.newaxis]]
+    return chars.astype(np.uint8).tobytes().decode('ascii')
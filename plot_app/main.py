@@ -17,6 +17,7 @@ from config import *
 from colors import HTML_color_to_RGB
 from db_entry import *
 from configured_plots import generate_plots, get_pid_analysis_plots
+from noise_analysis_plots import get_noise_analysis_plots
 from statistics_plots import StatisticsPlots
 
 #pylint: disable=invalid-name, redefined-outer-name
@@ -191,7 +192,21 @@ else:
             try:
                 link_to_main_plots = '?log='+log_id
                 plots = get_pid_analysis_plots(ulog, px4_ulog, db_data,
-                                               link_to_main_plots)
+                                               link_to_main_plots, log_id)
+
+                title = 'Flight Review - '+px4_ulog.get_mav_type()
+
+            except Exception as error:
+                # catch all errors to avoid showing a blank page. Note that if we
+                # get here, there's a bug somewhere that needs to be fixed!
+                traceback.print_exc()
+                title, error_message, plots = show_exception_page()
+
+        elif plots_page == 'noise_analysis':
+            try:
+                link_to_main_plots = '?log='+log_id
+                plots = get_noise_analysis_plots(ulog, px4_ulog, db_data,
+                                                 link_to_main_plots, log_id)
 
                 title = 'Flight Review - '+px4_ulog.get_mav_type()
 
@@ -228,10 +243,12 @@ else:
 
             link_to_3d_page = '3d?log='+log_id
             link_to_pid_analysis_page = '?plots=pid_analysis&log='+log_id
+            link_to_noise_analysis_page = '?plots=noise_analysis&log='+log_id
 
             try:
                 plots = generate_plots(ulog, px4_ulog, db_data, vehicle_data,
-                                       link_to_3d_page, link_to_pid_analysis_page)
+                                       link_to_3d_page, link_to_pid_analysis_page,
+                                       link_to_noise_analysis_page)
 
                 title = 'Flight Review - '+px4_ulog.get_mav_type()
 
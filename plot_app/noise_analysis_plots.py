@@ -0,0 +1,93 @@
+""" Plots of the noise analysis page """
+
+from functools import partial
+
+from bokeh.io import curdoc
+
+from analysis_runner import (
+    get_analysis_message, get_analysis_placeholder, run_analysis_in_background
+    )
+from config import plot_config
+from helper import is_running_locally
+from pid_analysis import (
+    NOISE_ANALYSIS_TOPICS, plot_noise_analysis, run_noise_analysis,
+    get_noise_analysis_inputs, load_noise_analysis_results,
+    save_noise_analysis_results
+    )
+from plotted_tables import get_heading_html
+
+
+def get_noise_analysis_plots(ulog, px4_ulog, db_data, link_to_main_plots, log_id):
+    """
+    get all bokeh plots shown on the noise analysis page
+    :return: list of bokeh plots
+    """
+    page_intro = """
+<p>
+This page shows the noise spectrum of the gyro, the accelerometer and the
+actuator controls against the throttle. Each column is the averaged amplitude
+spectrum over all time windows at the given throttle, summed over the axes.
+Frame resonances and motor noise show up as bright horizontal bands (fixed
+frequency) or as diagonal bands (frequency increasing with throttle).
+</p>
+<p>
+The spectra are computed with the noise analysis of
+<a href="https://github.com/Plasmatree/PID-Analyzer">PID-Analyzer</a>.
+The analysis may take a while...
+</p>
+    """
+    curdoc().template_variables['title_html'] = get_heading_html(
+        ulog, px4_ulog, db_data, None, [('Open Main Plots', link_to_main_plots)],
+        'Noise Analysis') + page_intro
+
+    plots = []
+    data = ulog.data_list
+
+    missing_topics = [topic for topic in NOISE_ANALYSIS_TOPICS
+                      if not any(elem.name == topic for elem in data)]
+    if len(missing_topics) > 0:
+        print('Noise analysis: missing topics', missing_topics)
+        plots.append(get_analysis_message(
+            "<p><b>Error</b>: missing topics or data for the noise analysis "
+            "(required topics: sensor_combined and actuator_controls_0).</p>"))
+        return plots
+
+    def _get_noise_plot(noise, label):
+        """ get the noise plot (or an error) for an analysis result """
+        if noise is not None:
+            try:
+                return plot_noise_analysis(noise, data, plot_config).bokeh_plot
+            except Exception as e:
+                print(type(e), label, ":", e)
+        return get_analysis_message(
+            "<p><b>Error</b>: "+label+" noise analysis failed. Possible "
+            "error causes are: logged data rate is too low, the log is "
+            "too short or simply a bug in the code.</p>")
+
+    labels = [('gyro', 'Gyro'), ('accel', 'Accelerometer'),
+              ('actuator_controls', 'Actuator Controls')]
+    use_cache = not is_running_locally()
+    noise_results = load_noise_analysis_results(log_id) if use_cache else None
+    if noise_results is not None:
+        for key, label in labels:
+            plots.append(_get_noise_plot(noise_results.get(key, None), label))
+        return plots
+
+    placeholders = {} # analysis key: (placeholder layout, label)
+    for key, label in labels:
+        placeholder = get_analysis_placeholder("Computing the "+label+" noise spectrum...")
+        placeholders[key] = (placeholder, label)
+        plots.append(placeholder)
+
+    try:
+        analysis_inputs = get_noise_analysis_inputs(ulog)
+    except (KeyError, IndexError, ValueError) as error:
+        print(type(error), ":", error)
+        analysis_inputs = {}
+    save_results = None
+    if use_cache:
+        save_results = partial(save_noise_analysis_results, log_id)
+    run_analysis_in_background(run_noise_analysis, analysis_inputs, placeholders,
+                               _get_noise_plot, plots, save_results, 'noise analysis')
+
+    return plots
@@ -2,74 +2,414 @@
 Module for generating overview map
 """
 
+import hashlib
+import json
 import os
-#pylint: disable=ungrouped-imports
-import matplotlib
-matplotlib.use('Agg')
-import smopy
-import matplotlib.pyplot as plt
+import signal
+import sqlite3
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from io import BytesIO
+from timeit import default_timer as timer
+import numpy as np
+from PIL import Image, ImageDraw
+from pyulog import ULog
 
-from config import get_log_filepath, get_overview_img_filepath
-from helper import load_ulog_file
+from config import get_log_filepath, get_overview_img_filepath, get_db_filename, \
+    get_overview_sprite_filepath
+from helper import map_projection
+from tile_cache import get_tile_cache, TILE_SIZE
 
-MAXTILES = 16
-def get_zoom(input_box, z=18):
-    """
-    Return acceptable zoom - we take this function from Map to get lover zoom
-    """
-    box_tile = smopy.get_tile_box(input_box, z)
-    box = smopy.correct_box(box_tile, z)
-    sx, sy = smopy.get_box_size(box)
-    if sx * sy >= MAXTILES:
-        z = get_zoom(input_box, z - 1)
-    return z
-
-def generate_overview_img_from_id(log_id):
-    ''' This function will load file and save overview from/into configured directories
+# size of the overview images in pixels (width, height). The browse page shows
+# them with a height of 50 and enlarges them on hover
+OVERVIEW_IMG_SIZE = (200, 150)
+OVERVIEW_IMG_MAX_ZOOM = 18
+OVERVIEW_IMG_MARGIN = 0.1 # relative to the image size, on each side
+OVERVIEW_IMG_BACKGROUND = (240, 240, 240)
+OVERVIEW_IMG_TRACK_COLOR = (255, 0, 0)
+
+# sprites: the overview images of a whole browse page in a single image
+OVERVIEW_SPRITE_QUALITY = 85 # JPEG quality
+OVERVIEW_SPRITE_MAX_FILES = 2000 # the oldest files are removed above that
+OVERVIEW_SPRITE_MIN_AGE_S = 24 * 3600 # files in use are never older than this
+OVERVIEW_SPRITE_REFRESH_S = 3600 # interval to mark a sprite as in use
+
+def get_gps_track(ulog):
+    ''' get the GPS track (with a valid fix) of a log
+        :return: (lat, lon) in degrees, or None if there is no GPS data
+        '''
+    try:
+        cur_dataset = ulog.get_dataset('vehicle_gps_position')
+        indices = cur_dataset.data['fix_type'] > 2 # use only data with a fix
+        lon = cur_dataset.data['lon'][indices] / 1e7 # degrees
+        lat = cur_dataset.data['lat'][indices] / 1e7
+    except (KeyError, IndexError, ValueError):
+        return None
+    if len(lat) == 0:
+        return None
+    return lat, lon
+
+def load_gps_track_from_id(log_id):
+    ''' load only the GPS topic of a log and get the track (see get_gps_track)
         '''
     ulog_file = os.path.join(get_log_filepath(), log_id+'.ulg')
-    ulog = load_ulog_file(ulog_file)
-    generate_overview_img(ulog, log_id)
+    ulog = ULog(ulog_file, ['vehicle_gps_position'], disable_str_exceptions=False)
+    return get_gps_track(ulog)
 
-def generate_overview_img(ulog, log_id):
-    ''' This funciton will generate overwie for loaded ULog data
+def _web_mercator_pixels(lat, lon, z):
+    ''' convert lat, lon in [deg] to global pixel coordinates of the map tiles
+        at zoom level z (Web Mercator, as used by OpenStreetMap)
         '''
-    output_filename = os.path.join(get_overview_img_filepath(), log_id+'.png')
+    num_pixels = TILE_SIZE * 2**z
+    lat_rad = np.deg2rad(lat)
+    x = (np.asarray(lon) + 180) / 360 * num_pixels
+    y = (1 - np.log(np.tan(lat_rad) + 1 / np.cos(lat_rad)) / np.pi) / 2 * num_pixels
+    return x, y
+
+def _get_map_background(lat, lon, size):
+    ''' get the map tiles around the track, cropped to the image size
+        :return: (PIL image, x, y), where x, y are the track in image pixels
+        '''
+    width, height = size
+    # use the highest zoom level at which the track (plus margin) fits
+    x, y = _web_mercator_pixels(lat, lon, 0)
+    usable = 1 - 2 * OVERVIEW_IMG_MARGIN
+    extent = max(np.ptp(x) / (width * usable), np.ptp(y) / (height * usable))
+    z = OVERVIEW_IMG_MAX_ZOOM
+    if extent > 0:
+        z = int(np.clip(np.floor(-np.log2(extent)), 0, OVERVIEW_IMG_MAX_ZOOM))
+    x = x * 2**z
+    y = y * 2**z
 
+    left = int(round((np.min(x) + np.max(x) - width) / 2))
+    top = int(round((np.min(y) + np.max(y) - height) / 2))
+    num_tiles = 2**z
+    tile_x0 = int(np.clip(left // TILE_SIZE, 0, num_tiles - 1))
+    tile_y0 = int(np.clip(top // TILE_SIZE, 0, num_tiles - 1))
+    tile_x1 = int(np.clip((left + width - 1) // TILE_SIZE, 0, num_tiles - 1))
+    tile_y1 = int(np.clip((top + height - 1) // TILE_SIZE, 0, num_tiles - 1))
+    tiles_img = get_tile_cache().get_map_image((tile_x0, tile_y0, tile_x1, tile_y1), z)
+    crop_left = left - tile_x0 * TILE_SIZE
+    crop_top = top - tile_y0 * TILE_SIZE
+    img = tiles_img.crop((crop_left, crop_top, crop_left + width, crop_top + height))
+    return img, x - left, y - top
+
+def render_overview_img(lat, lon, output_filename, size=OVERVIEW_IMG_SIZE, with_tiles=True):
+    ''' render the track (optionally on top of map tiles) and save it as small
+        image. The format is determined by the file extension (e.g. .png or
+        .webp). Raises on errors (e.g. if the tiles cannot be downloaded)
+        :param size: (width, height) in pixels
+        '''
+    width, height = size
+    if with_tiles:
+        img, x, y = _get_map_background(lat, lon, size)
+    else:
+        # local coordinates: x points north, y east
+        lat_rad = np.deg2rad(lat)
+        lon_rad = np.deg2rad(lon)
+        north, east = map_projection(lat_rad, lon_rad, lat_rad[0], lon_rad[0],
+                                     dtype=np.float32)
+        usable = 1 - 2 * OVERVIEW_IMG_MARGIN
+        extent = max(np.ptp(east) / (width * usable), np.ptp(north) / (height * usable))
+        scale = 1 / extent if extent > 0 else 1
+        x = (east - (np.min(east) + np.max(east)) / 2) * scale + width / 2
+        y = ((np.min(north) + np.max(north)) / 2 - north) * scale + height / 2
+        img = Image.new('RGB', size, OVERVIEW_IMG_BACKGROUND)
+
+    # drop points that map to the same (sub-)pixel as their predecessor
+    points = np.round(np.column_stack((x, y)) * 2) / 2
+    keep = np.ones(len(points), dtype=bool)
+    keep[1:] = np.any(points[1:] != points[:-1], axis=1)
+    points = points[keep]
+
+    draw = ImageDraw.Draw(img)
+    if len(points) > 1:
+        draw.line(points.flatten().tolist(), fill=OVERVIEW_IMG_TRACK_COLOR, width=2)
+    else:
+        draw.ellipse([points[0][0] - 2, points[0][1] - 2, points[0][0] + 2, points[0][1] + 2],
+                     fill=OVERVIEW_IMG_TRACK_COLOR)
+    img.save(output_filename, optimize=True)
+
+
+class OverviewImageError(Exception):
+    """ overview image generation failed """
+
+class OverviewImageTimeout(OverviewImageError):
+    """ overview image generation took too long """
+
+
+def set_overview_img_flag(log_id, has_overview):
+    ''' store in the DB whether a log has an overview image (Logs.OverviewImage
+        is 1) or no GPS data (0). The browse page uses the flag instead of
+        checking the file system.
+        '''
+    con = sqlite3.connect(get_db_filename())
+    with con:
+        con.execute('UPDATE Logs SET OverviewImage = ? WHERE Id = ?',
+                    (1 if has_overview else 0, log_id))
+    con.close()
+
+
+def _raise_timeout(signum, frame):
+    raise OverviewImageTimeout()
+
+def generate_overview_img_job(log_id, timeout_s, with_tiles=True):
+    ''' generate the overview image of a log. This is meant to be executed in
+        a worker process (e.g. of the OverviewImageQueue), as it uses SIGALRM
+        for the timeout.
+        :return: tuple of (has_gps, render time [s]). has_gps is True if the
+                 image was generated (or exists already), False if the log has
+                 no GPS data. Raises on (retryable) errors.
+        '''
+    start_time = timer()
+    output_filename = os.path.join(get_overview_img_filepath(), log_id+'.png')
     if os.path.exists(output_filename):
-        return
+        return True, timer() - start_time
 
+    # limit the time of the whole job (tile requests have their own timeout)
+    has_alarm = hasattr(signal, 'SIGALRM')
+    if has_alarm:
+        signal.signal(signal.SIGALRM, _raise_timeout)
+        signal.alarm(timeout_s)
     try:
-        cur_dataset = ulog.get_dataset('vehicle_gps_position')
-        t = cur_dataset.data['timestamp']
-        indices = cur_dataset.data['fix_type'] > 2 # use only data with a fix
-        lon = cur_dataset.data['lon'][indices] / 1e7 # degrees
-        lat = cur_dataset.data['lat'][indices] / 1e7
+        gps_track = load_gps_track_from_id(log_id)
+        if gps_track is None:
+            return False, timer() - start_time
+        # write to a temporary file first, so that no partial image is served
+        temp_filename = output_filename+'.'+str(os.getpid())+'.png'
+        try:
+            render_overview_img(gps_track[0], gps_track[1], temp_filename,
+                                with_tiles=with_tiles)
+            os.replace(temp_filename, output_filename)
+        except OverviewImageError:
+            raise
+        except Exception as error:
+            # the error is passed to the main process, so make sure it can be pickled
+            raise OverviewImageError(repr(error))
+        finally:
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+    finally:
+        if has_alarm:
+            signal.alarm(0)
+    return True, timer() - start_time
+
 
-        min_lat = min(lat)
-        max_lat = max(lat)
+class OverviewImageQueue:
+    """
+    Background queue for overview image generation. Images are rendered in
+    worker processes (so that rendering and tile downloads do not block the
+    server). Duplicate requests for a log are ignored while it's pending, and
+    failed jobs are retried after a delay.
+    """
+
+    def __init__(self, num_workers=2, timeout_s=60, max_attempts=3, retry_delay_s=30):
+        self._num_workers = num_workers
+        self._timeout_s = timeout_s
+        self._max_attempts = max_attempts
+        self._retry_delay_s = retry_delay_s
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = set() # log ids that are queued, running or waiting for a retry
+        self._stats = {'done': 0, 'no_gps': 0, 'failed': 0, 'retries': 0,
+                       'render_time_total_s': 0., 'render_time_max_s': 0.,
+                       'wait_time_total_s': 0.}
+
+    def add(self, log_id):
+        """ queue a log for overview image generation (thread-safe)
+        :return: False if the log is already queued
+        """
+        with self._lock:
+            if log_id in self._pending:
+                return False
+            self._pending.add(log_id)
+        self._submit(log_id, 1)
+        return True
 
-        min_lon = min(lon)
-        max_lon = max(lon)
+    def get_stats(self):
+        """ get the queue statistics (counters and render times)
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['queue_depth'] = len(self._pending)
+        num_rendered = max(1, stats['done'] + stats['no_gps'])
+        stats['render_time_avg_s'] = stats['render_time_total_s'] / num_rendered
+        stats['wait_time_avg_s'] = stats['wait_time_total_s'] / num_rendered
+        return stats
 
-        z = get_zoom((min_lat, min_lon, max_lat, max_lon)) - 2
-        if z < 0:
-            z = 0
+    def _submit(self, log_id, attempt):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self._num_workers)
+            executor = self._executor
+        future = executor.submit(generate_overview_img_job, log_id, self._timeout_s)
+        # the callback is called from a background thread of the executor
+        future.add_done_callback(partial(self._job_done, log_id, attempt, timer()))
 
-        render_map = smopy.Map((min_lat, min_lon, max_lat, max_lon), z=z)
-        fig, axes = plt.subplots(nrows=1, ncols=1)
-        render_map.show_mpl(figsize=(8, 6), ax=axes)
+    def _job_done(self, log_id, attempt, start_time, future):
+        elapsed = timer() - start_time
+        try:
+            has_gps, render_time = future.result()
+        except Exception as error:
+            if attempt < self._max_attempts:
+                print('Overview image generation for {:} failed ({:}), retrying'
+                      .format(log_id, repr(error)))
+                with self._lock:
+                    self._stats['retries'] += 1
+                retry_timer = threading.Timer(self._retry_delay_s, self._submit,
+                                              (log_id, attempt + 1))
+                retry_timer.daemon = True
+                retry_timer.start()
+                return
+            print('Overview image generation for {:} failed ({:})'
+                  .format(log_id, repr(error)))
+            with self._lock:
+                self._stats['failed'] += 1
+                self._pending.discard(log_id)
+            return
 
-        x, y = render_map.to_pixels(lat, lon)
-        axes.plot(x, y, 'r')
+        with self._lock:
+            self._stats['done' if has_gps else 'no_gps'] += 1
+            self._stats['render_time_total_s'] += render_time
+            self._stats['render_time_max_s'] = max(self._stats['render_time_max_s'],
+                                                   render_time)
+            self._stats['wait_time_total_s'] += max(0., elapsed - render_time)
+            self._pending.discard(log_id)
+            queue_depth = len(self._pending)
+        print('Overview image for {:}: {:} in {:.2f} s, waited {:.2f} s (queue depth: {:})'
+              .format(log_id, 'generated' if has_gps else 'no GPS', render_time,
+                      max(0., elapsed - render_time), queue_depth))
+        try:
+            set_overview_img_flag(log_id, has_gps)
+        except Exception as error:
+            print('Failed to update the overview image flag of {:} ({:})'
+                  .format(log_id, repr(error)))
 
-        axes.set_axis_off()
-        plt.savefig(output_filename, bbox_inches='tight')
-        plt.close(fig)
 
-        print('Saving overview file '+ output_filename)
+__overview_img_queue = {'queue': None}
+def get_overview_img_queue():
+    """ get the (lazily created) overview image queue. It's shared between all
+    requests """
+    if __overview_img_queue['queue'] is None:
+        __overview_img_queue['queue'] = OverviewImageQueue()
+    return __overview_img_queue['queue']
+
+def print_overview_img_queue_stats():
+    """ print the statistics of the overview image queue (if it was used) """
+    queue = __overview_img_queue['queue']
+    if queue is None:
+        return
+    stats = queue.get_stats()
+    print('Overview image queue: depth {queue_depth}, {done} generated, {no_gps} without GPS, '
+          '{failed} failed, {retries} retries, render time avg {render_time_avg_s:.2f} s '
+          'max {render_time_max_s:.2f} s, wait time avg {wait_time_avg_s:.2f} s'
+          .format(**stats))
+
 
-    except:
-        # Ignore. Eg. if topic not found
-        print('Error generating overview file: '+ output_filename+' - No GPS?')
+def _get_overview_sprite_filename(key, extension):
+    return os.path.join(get_overview_sprite_filepath(), key+extension)
 
+__overview_sprites = {} # sprite key -> time when it was last marked as in use
+def register_overview_sprite(log_ids):
+    """ register a sprite for the overview images of a list of logs (e.g. a
+    browse page). Only the list is stored, the image is created on the first
+    request (see create_overview_sprite). The file system is only accessed
+    the first time a list is seen (per process), and then periodically.
+    :param log_ids: logs with an overview image
+    :return: sprite key (hex string)
+    """
+    manifest = json.dumps({'size': OVERVIEW_IMG_SIZE, 'log_ids': log_ids})
+    key = hashlib.sha1(manifest.encode('utf-8')).hexdigest()[:24]
+    now = time.time()
+    if now - __overview_sprites.get(key, 0) < OVERVIEW_SPRITE_REFRESH_S:
+        return key
+    manifest_filename = _get_overview_sprite_filename(key, '.json')
+    try:
+        if os.path.exists(manifest_filename):
+            os.utime(manifest_filename) # mark as in use (see _remove_old_overview_sprites)
+        else:
+            # write to a random temporary file, then move it (to avoid races)
+            temp_filename = manifest_filename+'.'+str(uuid.uuid4())
+            with open(temp_filename, 'w') as manifest_file:
+                manifest_file.write(manifest)
+            os.replace(temp_filename, manifest_filename)
+        __overview_sprites[key] = now
+    except OSError as error:
+        print('Failed to store overview sprite', manifest_filename, error)
+    return key
+
+def create_overview_sprite(key):
+    """ get the sprite image of a registered key (created on first use): the
+    overview images of all logs stacked vertically, in the registered order
+    :return: JPEG data (bytes), or None if the key is unknown
+    """
+    sprite_filename = _get_overview_sprite_filename(key, '.jpg')
+    try:
+        with open(sprite_filename, 'rb') as sprite_file:
+            return sprite_file.read()
+    except OSError:
+        pass
+
+    try:
+        with open(_get_overview_sprite_filename(key, '.json'), 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+
+    width, height = manifest['size']
+    log_ids = manifest['log_ids']
+    sprite = Image.new('RGB', (width, max(1, len(log_ids)) * height), OVERVIEW_IMG_BACKGROUND)
+    for i, log_id in enumerate(log_ids):
+        try:
+            with Image.open(os.path.join(get_overview_img_filepath(), log_id+'.png')) as img:
+                if img.size != (width, height):
+                    img = img.resize((width, height))
+                sprite.paste(img.convert('RGB'), (0, i * height))
+        except OSError as error: # e.g. the log got deleted: leave it blank
+            print('Failed to add the overview image of {:} to a sprite ({:})'
+                  .format(log_id, error))
+    output = BytesIO()
+    sprite.save(output, 'JPEG', quality=OVERVIEW_SPRITE_QUALITY, optimize=True)
+    data = output.getvalue()
+
+    temp_filename = sprite_filename+'.'+str(uuid.uuid4())
+    try:
+        with open(temp_filename, 'wb') as sprite_file:
+            sprite_file.write(data)
+        os.replace(temp_filename, sprite_filename)
+    except OSError as error:
+        print('Failed to store overview sprite', sprite_filename, error)
+        if os.path.exists(temp_filename):
+            os.unlink(temp_filename)
+    _remove_old_overview_sprites()
+    return data
+
+def _remove_old_overview_sprites():
+    """ remove the least recently registered sprites (images and manifests) if
+    there are too many. Manifests of sprites in use are refreshed periodically
+    by register_overview_sprite, so they are never removed.
+    """
+    sprite_dir = get_overview_sprite_filepath()
+    file_names = os.listdir(sprite_dir)
+    if len(file_names) <= OVERVIEW_SPRITE_MAX_FILES:
+        return
+    files = []
+    for file_name in file_names:
+        try:
+            files.append((os.path.getmtime(os.path.join(sprite_dir, file_name)), file_name))
+        except OSError: # removed in the meantime
+            pass
+    files.sort()
+    # remove down to half of the limit, so that this does not run on every request
+    max_mtime = time.time() - OVERVIEW_SPRITE_MIN_AGE_S
+    for mtime, file_name in files[:len(files) - OVERVIEW_SPRITE_MAX_FILES // 2]:
+        if mtime > max_mtime:
+            break
+        try:
+            os.unlink(os.path.join(sprite_dir, file_name))
+        except OSError:
+            pass
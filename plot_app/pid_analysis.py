@@ -1,14 +1,23 @@
 """ PID response analysis """
 
 import colorsys
+import os
+import pickle
+import shutil
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 import numpy as np
+from numpy.lib.stride_tricks import as_strided
 
 from bokeh.models import Range1d, Span, LinearColorMapper, ColumnDataSource, LabelSet
+from bokeh.palettes import viridis
 from scipy.interpolate import interp1d
 from scipy.ndimage.filters import gaussian_filter1d
 
-from config import colors3
+from config import colors3, get_pid_analysis_filepath
+from helper import get_analysis_cache_filename
 from plotting import DataPlot
 
 # keep the same formatting as the original code
@@ -80,13 +89,6 @@ class Trace:
         self.low_mask, self.high_mask = self.low_high_mask(self.max_in, self.threshold)       #calcs masks for high and low inputs according to threshold
         self.toolow_mask = self.low_high_mask(self.max_in, 20)[1]          #mask for ignoring noisy low input
 
-# commented, because it's unused
-#        self.resp_sm = self.weighted_mode_avr(self.spec_sm, self.toolow_mask, [-1.5,3.5], 1000)
-#        self.resp_quality = -self.to_mask((np.abs(self.spec_sm -self.resp_sm[0]).mean(axis=1)).clip(0.5-1e-9,0.5))+1.
-#        # masking by setting trottle of unwanted traces to neg
-#        self.thr_response = self.hist2d(self.max_thr * (2. * (self.toolow_mask*self.resp_quality) - 1.), self.time_resp,
-#                                        (self.spec_sm.transpose() * self.toolow_mask).transpose(), [101, self.rlen])
-
         self.resp_low = self.weighted_mode_avr(self.spec_sm, self.low_mask*self.toolow_mask, [-1.5,3.5], 1000)
         if self.high_mask.sum()>0:
             self.resp_high = self.weighted_mode_avr(self.spec_sm, self.high_mask*self.toolow_mask, [-1.5,3.5], 1000)
@@ -97,9 +99,9 @@ class Trace:
                                                self.noise_winlen, Trace.noise_superpos)
             self.noise_win = np.hanning(self.noise_winlen)
 
-            self.noise_gyro = self.stackspectrum(self.noise_stack['time'],self.noise_stack['throttle'],self.noise_stack['gyro'], self.noise_win)
-            self.noise_d = self.stackspectrum(self.noise_stack['time'], self.noise_stack['throttle'], self.noise_stack['d_err'], self.noise_win)
-            self.noise_debug = self.stackspectrum(self.noise_stack['time'], self.noise_stack['throttle'], self.noise_stack['debug'], self.noise_win)
+            self.noise_gyro = self.stackspectrum(self.noise_stack['time'],self.noise_stack['throttle'],[self.noise_stack['gyro']], self.noise_win)
+            self.noise_d = self.stackspectrum(self.noise_stack['time'], self.noise_stack['throttle'], [self.noise_stack['d_err']], self.noise_win)
+            self.noise_debug = self.stackspectrum(self.noise_stack['time'], self.noise_stack['throttle'], [self.noise_stack['debug']], self.noise_win)
             if self.noise_debug['hist2d'].sum()>0:
                 ## mask 0 entries
                 thr_mask = self.noise_gyro['throt_hist_avr'].clip(0,1)
@@ -121,7 +123,8 @@ class Trace:
 
         return low, high
 
-    def to_mask(self, clipped):
+    @staticmethod
+    def to_mask(clipped):
         clipped-=clipped.min()
         clipped_max = clipped.max()
         if clipped_max > 1e-10: # avoid division by zero
@@ -198,7 +201,8 @@ class Trace:
         return (newtime, output)
 
 
-    def stepcalc(self, time, duration):
+    @staticmethod
+    def stepcalc(time, duration):
         ### calculates frequency and resulting windowlength
         tstep = (time[-1]-time[0])/len(time)
         freq = 1./tstep
@@ -206,40 +210,52 @@ class Trace:
         return int(arr_len)
 
     def winstacker(self, stackdict, flen, superpos):
-        ### makes stack of windows for deconvolution
-        tlen = len(self.time)
-        shift = int(flen/superpos)
-        wins = int((tlen-flen)/shift)
-        for i in np.arange(wins):
-            for key in stackdict.keys():
-                stackdict[key].append(self.data[key][i * shift:i * shift + flen])
-        for k in stackdict.keys():
-            #print('key',k)
-            #print(len(stackdict[k]))
-            stackdict[k]=np.array(stackdict[k], dtype=np.float64)
+        ### makes stack of windows for deconvolution.
+        ### returns read-only strided views into the data (no copies)
+        for key in stackdict.keys():
+            stackdict[key] = self.stack_windows(self.data[key], flen, superpos)
         return stackdict
 
-    def wiener_deconvolution(self, input, output, cutfreq):      # input/output are two-dimensional
-        pad = 1024 - (len(input[0]) % 1024)                     # padding to power of 2, increases transform speed
-        input = np.pad(input, [[0,0],[0,pad]], mode='constant')
-        output = np.pad(output, [[0, 0], [0, pad]], mode='constant')
-        H = np.fft.fft(input, axis=-1)
-        G = np.fft.fft(output,axis=-1)
+    @staticmethod
+    def stack_windows(data, flen, superpos):
+        ### stack of windows of length flen, overlapping superpos times, as a read-only strided view
+        tlen = len(data)
+        shift = int(flen/superpos)
+        wins = max(int((tlen-flen)/shift), 0)
+        data = np.ascontiguousarray(data, dtype=np.float64)
+        stride = data.strides[0]
+        return as_strided(data, shape=(wins, flen), strides=(shift * stride, stride), writeable=False)
+
+    @staticmethod
+    def padded_windows(stack, window):
+        ### multiplies a stack of windows with window, zero-padded to a multiple of 1024
+        ### in a single allocation. returns (padded stack, view without padding)
+        flen = stack.shape[1]
+        pad = 1024 - (flen % 1024)                              # padding to power of 2, increases transform speed
+        padded = np.zeros((stack.shape[0], flen + pad), dtype=np.float64)
+        windowed = padded[:, :flen]
+        np.multiply(stack, window, out=windowed)
+        return padded, windowed
+
+    def wiener_deconvolution(self, input, output, cutfreq):      # input/output are two-dimensional and zero-padded
+        H = np.fft.rfft(input, axis=-1)
+        G = np.fft.rfft(output, axis=-1)
         freq = np.abs(np.fft.fftfreq(len(input[0]), self.dt))
         sn = self.to_mask(np.clip(np.abs(freq), cutfreq-1e-9, cutfreq))
         len_lpf=np.sum(np.ones_like(sn)-sn)
         sn=self.to_mask(gaussian_filter1d(sn,len_lpf/6.))
         sn= 10.*(-sn+1.+1e-9)       # +1e-9 to prohibit 0/0 situations
+        sn = sn[:H.shape[-1]]       # sn is symmetric, keep the non-negative frequencies (rfft)
         Hcon = np.conj(H)
-        deconvolved_sm = np.real(np.fft.ifft(G * Hcon / (H * Hcon + 1./sn),axis=-1))
+        deconvolved_sm = np.fft.irfft(G * Hcon / (H * Hcon + 1./sn), n=len(input[0]), axis=-1)
         return deconvolved_sm
 
     def stack_response(self, stacks, window):
-        inp = stacks['input'] * window
-        outp = stacks['gyro'] * window
+        inp_padded, inp = self.padded_windows(stacks['input'], window)
+        outp_padded, outp = self.padded_windows(stacks['gyro'], window)
         thr = stacks['throttle'] * window
 
-        deconvolved_sm = self.wiener_deconvolution(inp, outp, self.cutfreq)[:, :self.rlen]
+        deconvolved_sm = self.wiener_deconvolution(inp_padded, outp_padded, self.cutfreq)[:, :self.rlen]
         delta_resp = deconvolved_sm.cumsum(axis=1)
 
         max_thr = np.abs(np.abs(thr)).max(axis=1)
@@ -249,7 +265,8 @@ class Trace:
 
         return delta_resp, avr_t, avr_in, max_in, max_thr
 
-    def spectrum(self, time, traces):
+    @staticmethod
+    def spectrum(time, traces):
         ### fouriertransform for noise analysis. returns frequencies and spectrum.
         pad = 1024 - (len(traces[0]) % 1024)  # padding to power of 2, increases transform speed
         traces = np.pad(traces, [[0, 0], [0, pad]], mode='constant')
@@ -271,48 +288,60 @@ class Trace:
         f_amp_freq, f_amp_hist =np.histogram(full_freq_f, weights=np.abs(full_spec_f.real).flatten(), bins=int(full_freq_f[-1]))
         r_amp_freq, r_amp_hist = np.histogram(full_freq_r, weights=np.abs(full_spec_r.real).flatten(), bins=int(full_freq_r[-1]))
 
-    def hist2d(self, x, y, weights, bins):   #bins[nx,ny]
-        ### generates a 2d hist from input 1d axis for x,y. repeats them to match shape of weights X*Y (data points)
-        ### x will be 0-100%
-        freqs = np.repeat(np.array([y], dtype=np.float64), len(x), axis=0)
-        throts = np.repeat(np.array([x], dtype=np.float64), len(y), axis=0).transpose()
-        throt_hist_avr, throt_scale_avr = np.histogram(x, 101, [0, 100])
-
-        hist2d = np.histogram2d(throts.flatten(), freqs.flatten(),
-                                range=[[0, 100], [y[0], y[-1]]],
-                                bins=bins, weights=weights.flatten(), normed=False)[0].transpose()
-
-        hist2d = np.array(abs(hist2d), dtype=np.float64)
-        hist2d_norm = np.copy(hist2d)
-        hist2d_norm /=  (throt_hist_avr + 1e-9)
-
-        return {'hist2d_norm':hist2d_norm, 'hist2d':hist2d, 'throt_hist':throt_hist_avr,'throt_scale':throt_scale_avr}
-
+    @staticmethod
+    def hist2d_sum(x, y, weights, bins):
+        ### weighted 2d histogram over the range [0, 100] x [y[0], y[-1]] (same binning as np.histogram2d),
+        ### where weights[i, j] belongs to (x[i], y[j]). returns an array of shape (bins[1], bins[0]).
+        ### computed as a product of one-hot bin matrices instead of repeating x and y for every data point.
+        def one_hot(edges, values):
+            index = Trace.histogram_bin_index(edges, np.asarray(values, dtype=np.float64))
+            one_hot = np.zeros((len(values), len(edges) + 1), dtype=np.float64)
+            one_hot[np.arange(len(values)), index] = 1.
+            return one_hot[:, 1:-1]     # drop the outlier bins
+        x_one_hot = one_hot(np.linspace(0, 100, int(bins[0]) + 1), x)
+        y_one_hot = one_hot(np.linspace(y[0], y[-1], int(bins[1]) + 1), y)
+        return x_one_hot.T.dot(weights).dot(y_one_hot).transpose()
 
-    def stackspectrum(self, time, throttle, trace, window):
-        ### calculates spectrogram from stack of windows against throttle.
+    @staticmethod
+    def stackspectrum(time, throttle, traces, window, chunk_size=1000):
+        ### calculates spectrogram from stack of windows against throttle, summed over all traces (list of
+        ### window stacks of the same shape). the windows are processed in chunks, to limit the memory needed
+        ### for the zero-padded spectra of long logs.
         # slicing off last 2s to get rid of landing
-        gyro = trace[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:] * window
-        thr = throttle[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:] * window
-        time = time[:-int(Trace.noise_superpos*2./Trace.noise_framelen),:]
-
-        freq, spec = self.spectrum(time[0], gyro)
-
-        weights = abs(spec.real)
-        avr_thr = np.abs(thr).max(axis=1)
-
-        hist2d=self.hist2d(avr_thr, freq,weights,[101,len(freq)/4])
+        wins = max(len(throttle) - int(Trace.noise_superpos*2./Trace.noise_framelen), 0)
+        if wins == 0:
+            raise ValueError('not enough data for the noise analysis')
+
+        hist2d = 0.
+        throt_hist_avr = 0
+        for start in range(0, wins, chunk_size):
+            end = min(start + chunk_size, wins)
+            avr_thr = np.abs(throttle[start:end] * window).max(axis=1)
+            throt_hist_avr += np.histogram(avr_thr, 101, [0, 100])[0]
+            for trace in traces:
+                freq, spec = Trace.spectrum(time[0], trace[start:end] * window)
+                hist2d += Trace.hist2d_sum(avr_thr, freq, np.abs(spec), [101, len(freq)//4])
+        throt_scale_avr = np.linspace(0, 100, 102)
+        hist2d_norm = hist2d / (throt_hist_avr + 1e-9)
 
         filt_width = 3  # width of gaussian smoothing for hist data
-        hist2d_sm = gaussian_filter1d(hist2d['hist2d_norm'], filt_width, axis=1, mode='constant')
+        hist2d_sm = gaussian_filter1d(hist2d_norm, filt_width, axis=1, mode='constant')
 
         # get max value in histogram >100hz
         thresh = 100.
-        mask = self.to_mask(freq[:-1:4].clip(thresh-1e-9,thresh))
+        mask = Trace.to_mask(freq[:-1:4].clip(thresh-1e-9,thresh))
         maxval = np.max(hist2d_sm.transpose()*mask)
 
-        return {'throt_hist_avr':hist2d['throt_hist'],'throt_axis':hist2d['throt_scale'],'freq_axis':freq[::4],
-                'hist2d_norm':hist2d['hist2d_norm'], 'hist2d_sm':hist2d_sm, 'hist2d':hist2d['hist2d'], 'max':maxval}
+        return {'throt_hist_avr':throt_hist_avr,'throt_axis':throt_scale_avr,'freq_axis':freq[::4],
+                'hist2d_norm':hist2d_norm, 'hist2d_sm':hist2d_sm, 'hist2d':hist2d, 'max':maxval}
+
+    @staticmethod
+    def histogram_bin_index(edges, values):
+        ### bin index of values as computed by np.histogramdd: values equal to the last edge go
+        ### into the last bin, 0 and len(edges) are the outlier bins (also used for NaN)
+        index = np.searchsorted(edges, values, side='right')
+        index[values == edges[-1]] -= 1
+        return index
 
     def weighted_mode_avr(self, values, weights, vertrange, vertbins):
         ### finds the most common trace and std
@@ -320,12 +349,32 @@ class Trace:
         filt_width = 7  # width of gaussian smoothing for hist data
 
         resp_y = np.linspace(vertrange[0], vertrange[-1], vertbins, dtype=np.float64)
-        times = np.repeat(np.array([self.time_resp],dtype=np.float64), len(values), axis=0)
-        weights = np.repeat(weights, len(values[0]))
-
-        hist2d = np.histogram2d(times.flatten(), values.flatten(),
-                                range=[[self.time_resp[0], self.time_resp[-1]], vertrange],
-                                bins=[len(times[0]), vertbins], weights=weights.flatten())[0].transpose()
+        time_bins = len(self.time_resp)
+
+        ### same binning as np.histogram2d(times, values, weights), with times and weights repeated
+        ### for every window, but without creating these (windows x response length) copies:
+        ### all samples of a response column share the same time bin, so the histogram is accumulated
+        ### per time bin with bincount over the windows.
+        time_edges = np.linspace(self.time_resp[0], self.time_resp[-1], time_bins + 1)
+        value_edges = np.linspace(vertrange[0], vertrange[-1], vertbins + 1)
+        time_index = self.histogram_bin_index(time_edges, np.asarray(self.time_resp, dtype=np.float64))
+        weights = np.asarray(weights, dtype=np.float64)
+        hist2d = np.zeros((time_bins, vertbins), dtype=np.float64)
+        for time_bin in np.unique(time_index):
+            if time_bin == 0 or time_bin > time_bins:
+                continue    # outside of the time range
+            columns = np.flatnonzero(time_index == time_bin)
+            if len(columns) == 1:
+                column_values = values[:, columns[0]]
+                column_weights = weights
+            else:
+                # keep the summation order of histogram2d (window by window)
+                column_values = values[:, columns].ravel()
+                column_weights = np.repeat(weights, len(columns))
+            value_index = self.histogram_bin_index(value_edges, column_values)
+            hist2d[time_bin - 1] = np.bincount(value_index, column_weights,
+                                               minlength=vertbins + 2)[1:-1]
+        hist2d = hist2d.transpose()
         ### shift outer edges by +-1e-5 (10us) bacause of dtype32. Otherwise different precisions lead to artefacting.
         ### solution to this --> somethings strage here. In outer most edges some bins are doubled, some are empty.
         ### Hence sometimes produces "divide by 0 error" in "/=" operation.
@@ -335,7 +384,7 @@ class Trace:
             hist2d_sm /= np.max(hist2d_sm, 0)
 
 
-            pixelpos = np.repeat(resp_y.reshape(len(resp_y), 1), len(times[0]), axis=1)
+            pixelpos = np.repeat(resp_y.reshape(len(resp_y), 1), time_bins, axis=1)
             avr = np.average(pixelpos, 0, weights=hist2d_sm * hist2d_sm)
         else:
             hist2d_sm = hist2d
@@ -355,10 +404,294 @@ class Trace:
         return (average, np.sqrt(variance))
 
 
+class TraceResult:
+    """ The numeric results of a Trace that are needed for plotting (response
+    curves & histograms). It is much smaller than a Trace object, so that it can
+    be passed between processes and cached on disk.
+    """
+    def __init__(self, trace):
+        self.name = trace.name
+        self.resplen = trace.resplen
+        self.time_resp = trace.time_resp
+        self.high_mask = trace.high_mask
+        self.resp_low = trace.resp_low
+        if self.high_mask.sum() > 0:
+            self.resp_high = trace.resp_high
+
+
+def run_pid_analysis(name, time, gyro_rate, gyro_setpoint, throttle):
+    """ run the analysis for a single axis (see Trace for the arguments).
+    This is executed in a worker process.
+
+    :return: TraceResult
+    """
+    return TraceResult(Trace(name, time, gyro_rate, gyro_setpoint, throttle))
+
+
+# topics that are required for the analysis
+PID_ANALYSIS_TOPICS = ['rate_ctrl_status', 'vehicle_rates_setpoint', 'vehicle_attitude',
+                       'vehicle_attitude_setpoint', 'actuator_controls_0']
+
+def get_pid_analysis_inputs(ulog):
+    """ get the arguments for run_pid_analysis() for all analyzed axes: roll,
+    pitch & yaw rate and roll & pitch angle (yaw is mostly controlled directly
+    by rate).
+    Raises a KeyError, IndexError or ValueError if a required topic is missing.
+
+    :return: dict of analysis key (e.g. 'rate_roll', 'angle_pitch'): arguments
+             tuple (None if the data for the axis is missing)
+    """
+    def _resample(time_array, data, desired_time):
+        """ resample data at a given time to a vector of desired_time """
+        data_f = interp1d(time_array, data, fill_value='extrapolate')
+        return data_f(desired_time)
+
+    rate_ctrl_status = ulog.get_dataset('rate_ctrl_status')
+    gyro_time = rate_ctrl_status.data['timestamp']
+    vehicle_attitude = ulog.get_dataset('vehicle_attitude')
+    attitude_time = vehicle_attitude.data['timestamp']
+    vehicle_rates_setpoint = ulog.get_dataset('vehicle_rates_setpoint')
+    vehicle_attitude_setpoint = ulog.get_dataset('vehicle_attitude_setpoint')
+    actuator_controls_0 = ulog.get_dataset('actuator_controls_0')
+
+    analysis_inputs = {}
+    throttle = _resample(actuator_controls_0.data['timestamp'],
+                         actuator_controls_0.data['control[3]'] * 100, gyro_time)
+    for axis in ['roll', 'pitch', 'yaw']:
+        try:
+            gyro_rate = np.rad2deg(rate_ctrl_status.data[axis+'speed'])
+            setpoint = _resample(vehicle_rates_setpoint.data['timestamp'],
+                                 np.rad2deg(vehicle_rates_setpoint.data[axis]),
+                                 gyro_time)
+            analysis_inputs['rate_'+axis] = (axis, gyro_time / 1e6, gyro_rate,
+                                             setpoint, throttle)
+        except (KeyError, IndexError, ValueError) as error:
+            print(type(error), axis, ":", error)
+            analysis_inputs['rate_'+axis] = None
+
+    throttle = _resample(actuator_controls_0.data['timestamp'],
+                         actuator_controls_0.data['control[3]'] * 100, attitude_time)
+    for axis in ['roll', 'pitch']:
+        try:
+            attitude_estimated = np.rad2deg(vehicle_attitude.data[axis])
+            setpoint = _resample(vehicle_attitude_setpoint.data['timestamp'],
+                                 np.rad2deg(vehicle_attitude_setpoint.data[axis+'_d']),
+                                 attitude_time)
+            analysis_inputs['angle_'+axis] = (axis, attitude_time / 1e6,
+                                              attitude_estimated, setpoint, throttle)
+        except (KeyError, IndexError, ValueError) as error:
+            print(type(error), axis, ":", error)
+            analysis_inputs['angle_'+axis] = None
+    return analysis_inputs
+
+
+def get_step_response_metrics(time_resp, response, settling_band=0.05):
+    """ get the standard metrics of a (normalized) step response. The final
+    value is the mean over the last 20% of the response.
+
+    :param time_resp: response time axis [s]
+    :param response: step response (e.g. TraceResult.resp_low[0])
+    :param settling_band: relative band around the final value for the
+                          settling time
+    :return: tuple of (rise time (10%-90%) [s], overshoot [%], settling time [s]).
+             Metrics that cannot be determined are None.
+    """
+    final_value = np.mean(response[int(len(response) * 0.8):])
+    if not final_value > 0:
+        return None, None, None
+
+    rise_time = None
+    rise_start = np.flatnonzero(response >= 0.1 * final_value)
+    rise_end = np.flatnonzero(response >= 0.9 * final_value)
+    if len(rise_start) > 0 and len(rise_end) > 0:
+        rise_time = float(time_resp[rise_end[0]] - time_resp[rise_start[0]])
+
+    overshoot = float(max(0., (np.max(response) - final_value) / final_value * 100.))
+
+    settling_time = None
+    outside = np.flatnonzero(np.abs(response - final_value) > settling_band * final_value)
+    if len(outside) == 0:
+        settling_time = 0.
+    elif outside[-1] < len(response) - 1:
+        settling_time = float(time_resp[outside[-1] + 1])
+    return rise_time, overshoot, settling_time
+
+
+# topics that are required for the noise analysis
+NOISE_ANALYSIS_TOPICS = ['sensor_combined', 'actuator_controls_0']
+
+def get_noise_analysis_inputs(ulog):
+    """ get the arguments for run_noise_analysis() for the gyro, accelerometer
+    and actuator controls (each summed over the x, y, z or roll, pitch, yaw axes)
+    Raises a KeyError, IndexError or ValueError if a required topic is missing.
+
+    :return: dict of analysis key: arguments tuple (None if the data is missing)
+    """
+    actuator_controls_0 = ulog.get_dataset('actuator_controls_0')
+    throttle_f = interp1d(actuator_controls_0.data['timestamp'],
+                          actuator_controls_0.data['control[3]'] * 100,
+                          fill_value='extrapolate')
+
+    analysis_inputs = {}
+    for key, name, topic, field_names in [
+            ('gyro', 'Gyro', 'sensor_combined',
+             ['gyro_rad[0]', 'gyro_rad[1]', 'gyro_rad[2]']),
+            ('accel', 'Accelerometer', 'sensor_combined',
+             ['accelerometer_m_s2[0]', 'accelerometer_m_s2[1]', 'accelerometer_m_s2[2]']),
+            ('actuator_controls', 'Actuator Controls', 'actuator_controls_0',
+             ['control[0]', 'control[1]', 'control[2]'])]:
+        try:
+            dataset = ulog.get_dataset(topic)
+            timestamp = dataset.data['timestamp']
+            signals = [dataset.data[field_name] for field_name in field_names]
+            analysis_inputs[key] = (name, timestamp / 1e6, throttle_f(timestamp), signals)
+        except (KeyError, IndexError, ValueError) as error:
+            print(type(error), key, ":", error)
+            analysis_inputs[key] = None
+    return analysis_inputs
+
+
+def run_noise_analysis(name, time, throttle, signals):
+    """ compute the noise spectrum of one or more signals against the throttle
+    (a 2D histogram, see Trace.stackspectrum), summed over all signals.
+    This is executed in a worker process.
+
+    :param time: np array with sampling times [s]
+    :param throttle: np array with the throttle [0, 100]
+    :param signals: list of np arrays with the same length as time
+    :return: dict with the name, axes and the smoothed histogram
+    """
+    data = {'throttle': throttle}
+    for i, signal in enumerate(signals):
+        data[i] = signal
+    time, data = Trace.equalize_data(time, data)
+    winlen = Trace.stepcalc(time, Trace.noise_framelen)
+    if winlen < 2 * Trace.noise_superpos:
+        raise ValueError('logging rate too low for the noise analysis')
+    window = np.hanning(winlen)
+    time_stack = Trace.stack_windows(time, winlen, Trace.noise_superpos)
+    throttle_stack = Trace.stack_windows(data['throttle'], winlen, Trace.noise_superpos)
+    traces = [Trace.stack_windows(data[i], winlen, Trace.noise_superpos)
+              for i in range(len(signals))]
+    noise = Trace.stackspectrum(time_stack, throttle_stack, traces, window)
+    return {'name': name, 'throt_axis': noise['throt_axis'], 'freq_axis': noise['freq_axis'],
+            'throt_hist_avr': noise['throt_hist_avr'], 'hist2d_sm': noise['hist2d_sm'],
+            'max': noise['max']}
+
+
+__process_pool = {'executor': None}
+def get_pid_analysis_process_pool():
+    """ get the (lazily created) process pool for the PID analysis. It's shared
+    between all sessions """
+    if __process_pool['executor'] is None:
+        num_workers = min(5, os.cpu_count() or 1)
+        __process_pool['executor'] = ProcessPoolExecutor(max_workers=num_workers)
+    return __process_pool['executor']
+
+def reset_pid_analysis_process_pool(executor):
+    """ drop a broken process pool (a worker crashed, e.g. ran out of memory),
+    so that the next get_pid_analysis_process_pool() call creates a new one.
+    A broken pool already terminated its workers, so no shutdown is needed
+    (it would deadlock when called from a future's done callback). """
+    if __process_pool['executor'] is executor:
+        __process_pool['executor'] = None
+
+def submit_pid_analysis_job(function, *args):
+    """ run function(*args) in the PID analysis process pool. A broken pool is
+    recreated: if the returned future fails with BrokenProcessPool, the pool is
+    reset (and the result must not be cached).
+
+    :return: Future
+    """
+    executor = get_pid_analysis_process_pool()
+    try:
+        future = executor.submit(function, *args)
+    except BrokenProcessPool:
+        reset_pid_analysis_process_pool(executor)
+        executor = get_pid_analysis_process_pool()
+        future = executor.submit(function, *args)
+
+    def _reset_if_broken(future):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            reset_pid_analysis_process_pool(executor)
+    future.add_done_callback(_reset_if_broken)
+    return future
+
+
+# increase these when the analysis or its results change, to invalidate the cache
+PID_ANALYSIS_CACHE_VERSION = 1
+NOISE_ANALYSIS_CACHE_VERSION = 1
+
+def _load_cached_results(log_id, analysis, version):
+    """ load cached analysis results for a log
+
+    :param analysis: 'pid' or 'noise'
+    :return: results or None if not cached
+    """
+    cache_file_name = get_analysis_cache_filename(log_id, analysis)
+    if not os.path.exists(cache_file_name):
+        return None
+    try:
+        with open(cache_file_name, 'rb') as cache_file:
+            cached = pickle.load(cache_file)
+        if cached.get('version', None) == version:
+            return cached['results']
+    except Exception as e:
+        print('Failed to load analysis cache file', cache_file_name, e)
+    return None
+
+def _save_cached_results(log_id, analysis, version, results):
+    """ store analysis results of a log on disk """
+    cache_file_name = get_analysis_cache_filename(log_id, analysis)
+    # write to a random temporary file, then move it (to avoid races)
+    temp_file_name = cache_file_name+'.'+str(uuid.uuid4())
+    try:
+        if not os.path.exists(get_pid_analysis_filepath()):
+            os.makedirs(get_pid_analysis_filepath())
+        with open(temp_file_name, 'wb') as cache_file:
+            pickle.dump({'version': version, 'results': results},
+                        cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        shutil.move(temp_file_name, cache_file_name)
+    except Exception as e:
+        print('Failed to store analysis cache file', cache_file_name, e)
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+
+def load_pid_analysis_results(log_id):
+    """ load the cached PID analysis results for a log
+
+    :return: dict of analysis key: TraceResult (or None if it failed), or None
+             if not cached
+    """
+    return _load_cached_results(log_id, 'pid', PID_ANALYSIS_CACHE_VERSION)
+
+def save_pid_analysis_results(log_id, results):
+    """ store the PID analysis results of a log on disk
+
+    :param results: dict of analysis key: TraceResult (or None if it failed)
+    """
+    _save_cached_results(log_id, 'pid', PID_ANALYSIS_CACHE_VERSION, results)
+
+def load_noise_analysis_results(log_id):
+    """ load the cached noise analysis results for a log
+
+    :return: dict of analysis key: result dict (or None if it failed), or None
+             if not cached
+    """
+    return _load_cached_results(log_id, 'noise', NOISE_ANALYSIS_CACHE_VERSION)
+
+def save_noise_analysis_results(log_id, results):
+    """ store the noise analysis results of a log on disk
+
+    :param results: dict of analysis key: result dict (or None if it failed)
+    """
+    _save_cached_results(log_id, 'noise', NOISE_ANALYSIS_CACHE_VERSION, results)
+
+
 def plot_pid_response(trace, data, plot_config, label='Rate'):
     """Plot PID response for one axis
 
-    :param trace: Trace object
+    :param trace: Trace or TraceResult object
     :param data: ULog.data_list
     """
 
@@ -455,3 +788,30 @@ def plot_pid_response(trace, data, plot_config, label='Rate'):
     data_plot.finalize()
     return data_plot
 
+
+
+def plot_noise_analysis(noise, data, plot_config):
+    """Plot the noise spectrum against the throttle (2D histogram)
+
+    :param noise: result of run_noise_analysis()
+    :param data: ULog.data_list
+    """
+    freq_axis = noise['freq_axis']
+    data_plot = DataPlot(data, plot_config, 'actuator_controls_0',
+                         y_axis_label='[Hz]', x_axis_label='Throttle [%]',
+                         title='{:} Noise vs Throttle'.format(noise['name']),
+                         x_range=Range1d(0, 100),
+                         y_range=Range1d(freq_axis[0], freq_axis[-1]))
+    p = data_plot.bokeh_plot
+
+    image = noise['hist2d_sm']
+    max_value = noise['max']
+    if not max_value > 0: # no data above 100 Hz (low logging rate)
+        max_value = max(np.max(image), 1e-9)
+    color_mapper = LinearColorMapper(palette=viridis(256), low=0, high=max_value)
+    p.image([image], x=0, y=freq_axis[0], dw=100, dh=freq_axis[-1]-freq_axis[0],
+            color_mapper=color_mapper)
+
+    data_plot.set_use_time_formatter(False)
+    data_plot.finalize()
+    return data_plot
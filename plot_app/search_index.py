@@ -0,0 +1,123 @@
+""" Full-text search index of the public logs (SQLite FTS5 table LogsSearch),
+used for the search on the browse page """
+
+import sqlite3
+
+from config_tables import error_labels_table
+from db_entry import DBData
+
+# the indexed columns (as displayed, except for the log id, UUID and software)
+SEARCH_INDEX_COLUMNS = ['LogId', 'Date', 'Description', 'Rating', 'MavType', 'Airframe',
+                        'Hardware', 'Software', 'SoftwareVersion', 'UUID',
+                        'VehicleName', 'FlightModes', 'ErrorLabels']
+
+# an index entry is identified by the (not indexed) Id column, the Logs.Id.
+# The rowid of Logs cannot be used, as it is not stable (e.g. VACUUM may
+# change it, because the primary key of Logs is not an integer)
+_SEARCH_INDEX_TABLE_COLUMNS = ['Id'] + SEARCH_INDEX_COLUMNS
+
+_SEARCH_INDEX_QUERY = (
+    'SELECT Logs.Id, Logs.Date, Logs.Description, Logs.Rating, '
+    '       LogsGenerated.MavType, LogsGenerated.AutostartId, LogsGenerated.AirframeName, '
+    '       LogsGenerated.Hardware, LogsGenerated.Software, LogsGenerated.SoftwareVersion, '
+    '       LogsGenerated.UUID, Vehicle.Name, LogsGenerated.FlightModeNames, Logs.ErrorLabels '
+    'FROM Logs '
+    '   JOIN LogsGenerated ON Logs.Id = LogsGenerated.Id '
+    '   LEFT JOIN Vehicle ON LogsGenerated.UUID = Vehicle.UUID '
+    'WHERE Logs.Public = 1')
+
+_SEARCH_INDEX_INSERT = (
+    'INSERT INTO LogsSearch ('+', '.join(_SEARCH_INDEX_TABLE_COLUMNS)+') '
+    'VALUES ('+', '.join(['?'] * len(_SEARCH_INDEX_TABLE_COLUMNS))+')')
+
+
+def create_search_index(cur):
+    """ create the (empty) search index table
+    :return: False if FTS5 is not supported by SQLite
+    """
+    try:
+        cur.execute('CREATE VIRTUAL TABLE LogsSearch USING fts5(Id UNINDEXED, '
+                    +', '.join(SEARCH_INDEX_COLUMNS)+", prefix='2 3')")
+    except sqlite3.OperationalError as e: # no such module: fts5
+        print('Failed to create the search index: '+str(e))
+        return False
+    return True
+
+
+def has_search_index(cur):
+    """ check if the search index table exists """
+    cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'LogsSearch'")
+    return cur.fetchone() is not None
+
+
+def is_search_index_outdated(cur):
+    """ check if the existing search index table has different columns (it
+    then needs to be dropped and created again) """
+    cur.execute('PRAGMA table_info(LogsSearch)')
+    return [column[1] for column in cur.fetchall()] != _SEARCH_INDEX_TABLE_COLUMNS
+
+
+def _search_index_row(db_tuple):
+    """ convert a row of _SEARCH_INDEX_QUERY into the indexed text """
+    log_id, log_date, description, rating, mav_type, autostart_id, airframe_name, \
+        hardware, software, software_version, vehicle_uuid, vehicle_name, flight_modes, \
+        error_labels = db_tuple
+    airframe = (airframe_name+' ' if airframe_name else '')+str(autostart_id)
+    error_labels = ' '.join(error_labels_table[int(x)] for x in (error_labels or '').split(',')
+                            if len(x) > 0 and int(x) in error_labels_table)
+    return (log_id, log_id, str(log_date)[:10], description, DBData.rating_str_static(rating),
+            mav_type, airframe, hardware, software, software_version, vehicle_uuid,
+            vehicle_name or '', flight_modes, error_labels)
+
+
+def build_search_index(cur):
+    """ (re-)index all logs
+    :return: number of indexed logs
+    """
+    cur.execute('DELETE FROM LogsSearch')
+    cur.execute(_SEARCH_INDEX_QUERY)
+    rows = [_search_index_row(db_tuple) for db_tuple in cur.fetchall()]
+    cur.executemany(_SEARCH_INDEX_INSERT, rows)
+    return len(rows)
+
+
+def update_search_index(cur, log_ids):
+    """ update the index entries of logs, after their DB data changed (within
+    the same transaction). Logs that are not public or do not have generated
+    data (yet) are not indexed.
+    """
+    if not has_search_index(cur):
+        return
+    for log_id in log_ids:
+        cur.execute('DELETE FROM LogsSearch WHERE Id = ?', (log_id,))
+        cur.execute(_SEARCH_INDEX_QUERY+' AND Logs.Id = ?', (log_id,))
+        db_tuple = cur.fetchone()
+        if db_tuple is not None:
+            cur.execute(_SEARCH_INDEX_INSERT, _search_index_row(db_tuple))
+
+
+def update_vehicle_search_index(cur, vehicle_uuid):
+    """ update the index entries of all logs of a vehicle (e.g. after the name
+    changed) """
+    cur.execute('SELECT Id FROM LogsGenerated WHERE UUID = ?', (vehicle_uuid,))
+    update_search_index(cur, [log_id for (log_id,) in cur.fetchall()])
+
+
+def remove_from_search_index(cur, log_id):
+    """ remove the index entry of a log (when it gets deleted) """
+    if not has_search_index(cur):
+        return
+    cur.execute('DELETE FROM LogsSearch WHERE Id = ?', (log_id,))
+
+
+def get_search_index_query(search_str):
+    """ get the FTS5 query (for MATCH) of a search string: each word has to
+    match (the beginning of) a word in one of the columns, e.g. 'quad' matches
+    'Quadrotor' and 'v1.9' matches 'v1.9.0'.
+    :return: query string or None if the search string has no words
+    """
+    words = search_str.split()
+    if len(words) == 0:
+        return None
+    # each word is a (quoted) phrase, so that special characters are ignored
+    return ' '.join('"'+word.replace('"', '""')+'"*' for word in words)
@@ -0,0 +1,272 @@
+""" Welch-averaged amplitude spectrum of logged data, taking logging dropouts
+into account, and the FFT plot """
+
+from timeit import default_timer as timer
+
+from bokeh.io import curdoc
+from bokeh.models import ColumnDataSource, Range1d, Span, Label
+
+import numpy as np
+import scipy
+import scipy.signal
+
+from helper import print_timing
+from plotting import DataPlot
+
+#pylint: disable=line-too-long, arguments-differ
+
+# minimum interval between FFT updates while the visible time range changes
+FFT_UPDATE_DELAY_MS = 300
+
+
+def get_contiguous_segments(timestamps, dropouts):
+    """ split a (sorted) timestamp array into segments of contiguous logging,
+    separated by logging dropouts
+
+    :param dropouts: list of ULog dropout messages (ulog.dropouts)
+    :return: list of (start index, end index) tuples (end index excluded)
+    """
+    split_timestamps = [dropout.timestamp for dropout in dropouts]
+    split_indices = np.unique(np.searchsorted(timestamps, split_timestamps, side='right'))
+    boundaries = np.concatenate(([0], split_indices, [len(timestamps)]))
+    return [(int(start), int(end)) for start, end in zip(boundaries[:-1], boundaries[1:])
+            if end > start]
+
+
+def compute_amplitude_spectrum(data_set, field_names, dropouts, window_length,
+                               t_start=None, t_end=None):
+    """ compute the Welch-averaged amplitude spectrum over all contiguous
+    segments within [t_start, t_end]
+
+    :param data_set: dict with 'timestamp' and the fields in field_names
+    :param dropouts: list of ULog dropout messages (ulog.dropouts)
+    :return: tuple (freqs, dict of field name: amplitude values), or None
+             if there is not enough data or the sampling frequency is too low
+    """
+    timestamps = data_set['timestamp']
+    segments = get_contiguous_segments(timestamps, dropouts)
+    if t_start is not None and t_end is not None:
+        range_indices = np.searchsorted(timestamps, [t_start, t_end])
+        segments = [(max(start, range_indices[0]), min(end, range_indices[1]))
+                    for start, end in segments]
+        segments = [(start, end) for start, end in segments if end - start > 1]
+    if len(segments) == 0:
+        return None
+
+    # use the longest segment to limit the window length
+    nperseg = min(window_length, max(end - start for start, end in segments))
+    if nperseg < 16:
+        return None
+    noverlap = nperseg // 2
+    segments = [(start, end) for start, end in segments if end - start >= nperseg]
+
+    # calculate the sampling frequency from the contiguous segments only
+    num_intervals = sum(end - start - 1 for start, end in segments)
+    duration = sum(timestamps[end - 1] - timestamps[start] for start, end in segments) * 1.0e-6
+    if duration <= 0:
+        return None
+    sampling_frequency = num_intervals / duration
+    if sampling_frequency < 100: # require min sampling freq
+        return None
+
+    freqs = None
+    fft_values_dict = {}
+    for field_name in field_names:
+        values = data_set[field_name]
+        power_sum = None
+        total_weight = 0
+        for start, end in segments:
+            # psd scaling with fs=1, since fs is only needed for the
+            # frequency axis (and may vary slightly between segments)
+            freqs_norm, power = scipy.signal.welch(
+                values[start:end], fs=1.0, window='hann', nperseg=nperseg,
+                noverlap=noverlap, scaling='spectrum')
+            # weight with the number of windows in the segment
+            weight = 1 + (end - start - nperseg) // (nperseg - noverlap)
+            if power_sum is None:
+                power_sum = power * weight
+            else:
+                power_sum += power * weight
+            total_weight += weight
+        freqs = freqs_norm * sampling_frequency
+        # amplitude spectrum (scaled the same way as a single-sided FFT)
+        fft_values_dict[field_name] = 1000 * np.sqrt(2 * power_sum / total_weight)
+
+    return freqs, fft_values_dict
+
+
+class DataPlotFFT(DataPlot):
+    """
+    An FFT plot: Welch-averaged amplitude spectrum.
+    This does not downsample dynamically.
+
+    The spectrum is averaged over all contiguous logging segments (separated by
+    logging dropouts), so that dropouts do not affect the frequency axis.
+    Optionally the spectrum can be recomputed for the visible time range of a
+    time series plot: pass the x_range of its bokeh plot as time_range (each
+    DataPlot has its own copy of the x range), and enable it with
+    set_follow_time_range() (e.g. from a button). Range changes are throttled,
+    so that panning does not recompute the spectrum on every step.
+
+    An FFT plot is only added to the plotting page if the sampling frequency of
+    the dataset is higher than 100Hz.
+    """
+
+    def __init__(self, data, config, data_name,
+                 title=None, plot_height='small',
+                 x_range=None, y_range=None, topic_instance=0,
+                 dropouts=None, time_range=None):
+
+        super(DataPlotFFT, self).__init__(data, config, data_name, x_axis_label='Hz',
+                                          y_axis_label='Amplitude * 1000', title=title, plot_height=plot_height,
+                                          x_range=x_range, y_range=y_range, topic_instance=topic_instance)
+        self._use_time_formatter = False
+        self._dropouts = dropouts if dropouts is not None else []
+        self._time_range = time_range
+        self._follow_time_range = False
+        self._update_spectrum = None
+
+    def add_graph(self, field_names, colors, legends, window_length=1024):
+        """ add an FFT plot to the graph
+
+        field_names: can be a list of fields from the data set, or a list of
+        functions with the data set as argument and returning a tuple of
+        (field_name, data)
+        legends: description for the field_names that will appear in the title of the plot
+        window_length: length of a single Welch window in samples (determines
+        the frequency resolution)
+        """
+
+        if self._had_error: return
+        try:
+            data_set = {}
+            data_set['timestamp'] = self._cur_dataset.data['timestamp']
+
+            field_names_expanded = self._expand_field_names(field_names, data_set)
+
+            spectrum = compute_amplitude_spectrum(data_set, field_names_expanded,
+                                                  self._dropouts, window_length)
+            if spectrum is None:
+                self._had_error = True
+                return
+
+            # the data & legend labels are set by set_spectrum() below. Each
+            # fft line and its mean line share a legend item.
+            mean_start_freq = 40
+            sources = {}
+            mean_sources = {}
+            renderers = {}
+            for field_name, color, legend in zip(field_names_expanded, colors, legends):
+                sources[field_name] = ColumnDataSource(data=dict(x=[], y=[]))
+                renderers[field_name] = self._p.line(
+                    x='x', y='y', source=sources[field_name],
+                    line_color=color, line_width=2, legend=legend,
+                    alpha=0.8)
+            # plot the mean lines above the fft graphs
+            for field_name, color, legend in zip(field_names_expanded, colors, legends):
+                mean_sources[field_name] = ColumnDataSource(data=dict(x=[], y=[]))
+                self._p.line(x='x', y='y', source=mean_sources[field_name],
+                             line_color=color, line_width=2, legend=legend)
+            legend_items = {}
+            for field_name, legend in zip(field_names_expanded, legends):
+                for item in self._p.legend[0].items:
+                    if renderers[field_name] in item.renderers:
+                        legend_items[field_name] = (item, legend)
+
+            def set_spectrum(spectrum):
+                """ update the plot with a (freqs, fft_values_dict) tuple """
+                freqs, fft_values_dict = spectrum
+                for field_name in field_names_expanded:
+                    fft_values = fft_values_dict[field_name]
+                    mean_fft_value = self._mean_above(freqs, fft_values, mean_start_freq)
+                    sources[field_name].data = dict(x=freqs, y=fft_values)
+                    mean_sources[field_name].data = dict(
+                        x=[mean_start_freq, np.max(freqs)], y=[mean_fft_value, mean_fft_value])
+                    if field_name in legend_items:
+                        item, legend = legend_items[field_name]
+                        item.label = dict(value=legend + " (mean above {:} Hz: {:.2f})".format(
+                            mean_start_freq, mean_fft_value))
+            set_spectrum(spectrum)
+
+            self._p.y_range = Range1d(0, 5)
+
+            if self._time_range is not None:
+                def update_spectrum(t_start, t_end):
+                    """ recompute the spectrum for a time range (the whole
+                    log if t_start or t_end is None) """
+                    cb_start_time = timer()
+                    spectrum = compute_amplitude_spectrum(
+                        data_set, field_names_expanded, self._dropouts, window_length,
+                        t_start, t_end)
+                    if spectrum is not None: # None: not enough data in the range
+                        set_spectrum(spectrum)
+                    print_timing("FFT update", cb_start_time)
+                self._update_spectrum = update_spectrum
+
+                doc = curdoc()
+                update_pending = [False]
+                def deferred_update():
+                    """ update for the latest range (called after a delay) """
+                    update_pending[0] = False
+                    if self._follow_time_range:
+                        update_spectrum(self._time_range.start, self._time_range.end)
+
+                def time_range_change_cb(attr, old, new):
+                    """ a pan or zoom changes start and end in quick succession:
+                    recompute the spectrum at most once per FFT_UPDATE_DELAY_MS """
+                    if not self._follow_time_range or update_pending[0]:
+                        return
+                    update_pending[0] = True
+                    doc.add_timeout_callback(deferred_update, FFT_UPDATE_DELAY_MS)
+
+                self._time_range.on_change('start', time_range_change_cb)
+                self._time_range.on_change('end', time_range_change_cb)
+
+        except (KeyError, IndexError, ValueError, ZeroDivisionError) as error:
+            print(type(error), "(" + self._data_name + "):", error)
+            self._had_error = True
+
+    @property
+    def follow_time_range(self):
+        """ True if the spectrum follows the visible time range """
+        return self._follow_time_range
+
+    def set_follow_time_range(self, enabled):
+        """ enable or disable recomputing the spectrum for the visible time
+        range (only possible if a time_range was passed). When disabled, the
+        spectrum of the whole log is shown again. """
+        if self._update_spectrum is None:
+            return
+        self._follow_time_range = enabled
+        if enabled:
+            self._update_spectrum(self._time_range.start, self._time_range.end)
+        else:
+            self._update_spectrum(None, None)
+
+    @staticmethod
+    def _mean_above(freqs, fft_values, start_freq):
+        """ mean amplitude for frequencies >= start_freq """
+        values = fft_values[freqs >= start_freq]
+        if len(values) == 0:
+            return 0.
+        return np.mean(values)
+
+    def mark_frequency(self, frequency, label, y_screen_offset=0):
+        """
+        Add a vertical line with a label to mark a certain frequency
+        """
+        p = self._p
+        mark_color = 'black'
+        mark_line = Span(location=frequency,
+                         dimension='height', line_color=mark_color,
+                         line_width=1)
+        p.add_layout(mark_line)
+        # label: add a space to separate it from the line
+        label = ' ' + label
+        # plot as text with a fixed screen-space y offset
+        label = Label(x=frequency, y=self.plot_height/2-10-y_screen_offset,
+                      text=label, y_units='screen', level='glyph',
+                      text_font_size='8pt', text_color=mark_color,
+                      render_mode='canvas')
+        p.add_layout(label)
+
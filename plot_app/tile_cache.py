@@ -0,0 +1,160 @@
+"""
+On-disk cache for map tiles (used for the overview images)
+"""
+
+import os
+import threading
+import uuid
+from io import BytesIO
+from urllib.request import urlopen, Request
+
+from PIL import Image
+
+from config import get_tile_cache_filepath, get_tile_cache_size, \
+    get_overview_tile_server, get_overview_tiles_offline, get_overview_tile_directory
+
+#pylint: disable=invalid-name
+
+TILE_SIZE = 256
+
+
+class TileNotAvailable(Exception):
+    """ a tile is not cached and cannot be downloaded (offline mode) """
+
+
+class TileCache:
+    """
+    Size-bounded cache for map tiles, stored as <cache_dir>/<z>/<x>/<y>.png.
+    The file modification time is updated on every access, and the least
+    recently used tiles are removed when the cache gets too large.
+    The cache directory can be shared between processes.
+    """
+
+    def __init__(self, cache_dir, max_size, tile_server, offline=False,
+                 tile_directory='', timeout_s=10):
+        """
+        :param max_size: maximum cache size in bytes
+        :param tile_server: URL template with {z}, {x} and {y}
+        :param offline: do not download tiles
+        :param tile_directory: optional directory with tiles (same layout as
+                               the cache), used before downloading
+        """
+        self._cache_dir = cache_dir
+        self._max_size = max_size
+        self._tile_server = tile_server
+        self._offline = offline
+        self._tile_directory = tile_directory
+        self._timeout_s = timeout_s
+        self._lock = threading.Lock()
+        self._size = None # estimated cache size (lazily initialized)
+
+    def get_tile(self, z, x, y):
+        """ get a tile
+        :return: PNG data (bytes)
+        """
+        tile_path = os.path.join(str(z), str(x), str(y)+'.png')
+        cache_file_name = os.path.join(self._cache_dir, tile_path)
+        try:
+            with open(cache_file_name, 'rb') as tile_file:
+                data = tile_file.read()
+            os.utime(cache_file_name) # mark as recently used
+            return data
+        except OSError:
+            pass
+
+        if self._tile_directory:
+            local_file_name = os.path.join(self._tile_directory, tile_path)
+            if os.path.exists(local_file_name):
+                with open(local_file_name, 'rb') as tile_file:
+                    return tile_file.read()
+
+        if self._offline:
+            raise TileNotAvailable('tile {:}/{:}/{:} not available offline'.format(z, x, y))
+
+        url = self._tile_server.format(z=z, x=x, y=y)
+        request = Request(url, headers={'User-Agent': 'Flight Review'})
+        with urlopen(request, timeout=self._timeout_s) as response:
+            data = response.read()
+        self._store(cache_file_name, data)
+        return data
+
+    def get_tile_image(self, z, x, y):
+        """ get a tile as PIL image """
+        img = Image.open(BytesIO(self.get_tile(z, x, y)))
+        img.load()
+        return img
+
+    def get_map_image(self, box_tile, z):
+        """ assemble the tiles of a box (x0, y0, x1, y1) in tile coordinates
+        :return: PIL image
+        """
+        x0, y0, x1, y1 = box_tile
+        x0, x1 = max(0, min(x0, x1)), min(2**z - 1, max(x0, x1))
+        y0, y1 = max(0, min(y0, y1)), min(2**z - 1, max(y0, y1))
+        img = Image.new('RGB', ((x1 - x0 + 1) * TILE_SIZE, (y1 - y0 + 1) * TILE_SIZE))
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                img.paste(self.get_tile_image(z, x, y),
+                          ((x - x0) * TILE_SIZE, (y - y0) * TILE_SIZE))
+        return img
+
+    def _store(self, cache_file_name, data):
+        """ add a tile to the cache, and remove old tiles if necessary """
+        try:
+            os.makedirs(os.path.dirname(cache_file_name), exist_ok=True)
+            # write to a random temporary file, then move it (to avoid races)
+            temp_file_name = cache_file_name+'.'+str(uuid.uuid4())
+            with open(temp_file_name, 'wb') as tile_file:
+                tile_file.write(data)
+            os.replace(temp_file_name, cache_file_name)
+        except OSError as e:
+            print('Failed to store tile', cache_file_name, e)
+            return
+
+        with self._lock:
+            if self._size is None:
+                self._size = sum(size for _, _, size in self._list_tiles())
+            else:
+                self._size += len(data)
+            if self._size > self._max_size:
+                self._evict()
+
+    def _list_tiles(self):
+        """ get all cached tiles as list of (file name, mtime, size) """
+        tiles = []
+        for dir_path, _, file_names in os.walk(self._cache_dir):
+            for file_name in file_names:
+                full_file_name = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(full_file_name)
+                except OSError: # removed in the meantime
+                    continue
+                tiles.append((full_file_name, stat.st_mtime, stat.st_size))
+        return tiles
+
+    def _evict(self):
+        """ remove the least recently used tiles, down to 90% of the maximum
+        size (to avoid evicting on every insertion) """
+        tiles = self._list_tiles()
+        tiles.sort(key=lambda tile: tile[1])
+        self._size = sum(size for _, _, size in tiles)
+        target_size = self._max_size * 0.9
+        for file_name, _, size in tiles:
+            if self._size <= target_size:
+                break
+            try:
+                os.unlink(file_name)
+            except OSError:
+                pass
+            self._size -= size
+
+
+__tile_cache = {'cache': None}
+def get_tile_cache():
+    """ get the (lazily created) tile cache, configured via the config file """
+    if __tile_cache['cache'] is None:
+        __tile_cache['cache'] = TileCache(
+            get_tile_cache_filepath(), get_tile_cache_size(),
+            get_overview_tile_server(), offline=get_overview_tiles_offline(),
+            tile_directory=get_overview_tile_directory())
+    return __tile_cache['cache']
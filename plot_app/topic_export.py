@@ -0,0 +1,111 @@
+"""
+Export of single topics of a log in columnar formats (CSV, Parquet, Arrow)
+"""
+
+from io import BytesIO
+import numpy as np
+
+# Parquet and Arrow are optional
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+#pylint: disable=invalid-name
+
+EXPORT_CSV_CHUNK_ROWS = 10000 # number of CSV rows formatted at once
+
+# supported formats: file extension and content type
+EXPORT_FORMATS = {
+    'csv': ('.csv', 'text/csv'),
+    'parquet': ('.parquet', 'application/vnd.apache.parquet'),
+    'arrow': ('.arrow', 'application/vnd.apache.arrow.file'),
+    }
+
+
+class TopicExportError(Exception):
+    """ invalid export request (e.g. unknown topic or field) """
+
+
+def is_export_format_available(export_format):
+    """ check if a format is supported (Parquet & Arrow need pyarrow) """
+    if export_format == 'csv':
+        return True
+    return export_format in EXPORT_FORMATS and pa is not None
+
+
+def get_topic_columns(ulog, topic_name, multi_id=0, fields=None, start_s=None, end_s=None):
+    """ get the data of a topic, optionally restricted to some fields and to a
+    time range. The arrays are views/slices of the loaded log (no conversion).
+    :param fields: list of field names (timestamp is always added), or None
+                   for all fields
+    :param start_s, end_s: time range in seconds since boot (same as the plots)
+    :return: tuple of (list of field names, list of numpy arrays)
+    """
+    try:
+        data = ulog.get_dataset(topic_name, multi_id).data
+    except (KeyError, IndexError, ValueError):
+        raise TopicExportError('Topic {:} (instance {:}) not found in the log'
+                               .format(topic_name, multi_id))
+    field_names = [field_name for field_name in data if field_name != 'timestamp']
+    if fields:
+        unknown_fields = [field for field in fields if not field in data]
+        if len(unknown_fields) > 0:
+            raise TopicExportError('Unknown fields: {:} (available: {:})'.format(
+                ', '.join(unknown_fields), ', '.join(field_names)))
+        field_names = [field for field in fields if field != 'timestamp']
+    field_names = ['timestamp'] + field_names
+
+    # the timestamps are sorted, so the range is a slice
+    timestamps = data['timestamp']
+    start_index, end_index = 0, len(timestamps)
+    if start_s is not None:
+        start_index = np.searchsorted(timestamps, int(start_s * 1e6), side='left')
+    if end_s is not None:
+        end_index = np.searchsorted(timestamps, int(end_s * 1e6), side='right')
+    return field_names, [data[field][start_index:end_index] for field in field_names]
+
+
+def _csv_format(column):
+    """ printf-style format of a column (shortest round-trip for floats) """
+    if np.issubdtype(column.dtype, np.floating):
+        return '%.9g' if column.dtype.itemsize <= 4 else '%.17g'
+    return '%d'
+
+
+def generate_csv(field_names, columns, chunk_rows=EXPORT_CSV_CHUNK_ROWS):
+    """ generator for CSV data, for streaming. Each chunk of rows is formatted
+    in a single operation.
+    :return: iterator of str
+    """
+    yield ','.join(field_names)+'\n'
+    num_rows = len(columns[0]) if len(columns) > 0 else 0
+    row_format = ','.join(_csv_format(column) for column in columns)+'\n'
+    for start in range(0, num_rows, chunk_rows):
+        end = min(start + chunk_rows, num_rows)
+        # interleave the columns (row-major), as needed for the formatting
+        values = [None] * ((end - start) * len(columns))
+        for i, column in enumerate(columns):
+            values[i::len(columns)] = column[start:end].tolist()
+        yield (row_format * (end - start)) % tuple(values)
+
+
+def generate_arrow_table(field_names, columns):
+    """ create an Arrow table from the columns (numpy arrays) """
+    return pa.Table.from_arrays([pa.array(column) for column in columns], names=field_names)
+
+
+def export_binary(field_names, columns, export_format):
+    """ export in a binary format ('parquet' or 'arrow')
+    :return: bytes
+    """
+    table = generate_arrow_table(field_names, columns)
+    output = BytesIO()
+    if export_format == 'parquet':
+        pq.write_table(table, output)
+    else:
+        with pa.ipc.new_file(output, table.schema) as writer:
+            writer.write_table(table)
+    return output.getvalue()
@@ -11,7 +11,10 @@ import datetime
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename, get_overview_img_filepath
-from plot_app.helper import get_log_filename
+from plot_app.helper import get_log_filename, get_analysis_cache_filename, \
+    get_3d_cache_filename, get_kml_cache_filename, clear_db_info_snapshot, \
+    remove_pid_analysis_results
+from plot_app.search_index import remove_from_search_index
 
 
 parser = argparse.ArgumentParser(description='Remove old log files & DB entries')
@@ -73,6 +76,8 @@ with con:
     for log_id in log_ids_to_remove:
         print('Removing '+log_id)
         # db entry
+        remove_from_search_index(cur, log_id)
+        remove_pid_analysis_results(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         num_deleted = cur.rowcount
@@ -88,5 +93,23 @@ with con:
         if os.path.exists(preview_image_filename):
             os.unlink(preview_image_filename)
 
+        #and cached analysis results if exist
+        for analysis in ['pid', 'noise']:
+            analysis_filename=get_analysis_cache_filename(log_id, analysis)
+            if os.path.exists(analysis_filename):
+                os.unlink(analysis_filename)
+
+        #and cached 3D view data if exist
+        three_d_filename=get_3d_cache_filename(log_id)
+        if os.path.exists(three_d_filename):
+            os.unlink(three_d_filename)
+
+        #and cached KML track if exist
+        kml_filename=get_kml_cache_filename(log_id)
+        if os.path.exists(kml_filename):
+            os.unlink(kml_filename)
+
 con.close()
 
+# the public log list is regenerated on the next request
+clear_db_info_snapshot()
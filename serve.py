@@ -20,14 +20,16 @@ sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_
 from tornado.web import RedirectHandler
 from tornado_handlers.download import DownloadHandler
 from tornado_handlers.upload import UploadHandler
-from tornado_handlers.browse import BrowseHandler, BrowseDataRetrievalHandler
+from tornado_handlers.browse import BrowseHandler, BrowseDataRetrievalHandler, \
+    OverviewSpriteHandler
 from tornado_handlers.edit_entry import EditEntryHandler
 from tornado_handlers.db_info_json import DBInfoHandler
-from tornado_handlers.three_d import ThreeDHandler
+from tornado_handlers.three_d import ThreeDHandler, ThreeDDataHandler
 from tornado_handlers.radio_controller import RadioControllerHandler
 from tornado_handlers.error_labels import UpdateErrorLabelHandler
 
 from helper import set_log_id_is_filename, print_cache_info
+from overview_generator import print_overview_img_queue_stats
 from config import debug_print_timing, get_overview_img_filepath
 
 #pylint: disable=invalid-name
@@ -115,6 +117,7 @@ extra_patterns = [
     (r'/browse', BrowseHandler),
     (r'/browse_data_retrieval', BrowseDataRetrievalHandler),
     (r'/3d', ThreeDHandler),
+    (r'/3d_data', ThreeDDataHandler),
     (r'/radio_controller', RadioControllerHandler),
     (r'/edit_entry', EditEntryHandler),
     (r'/?', UploadHandler), #root should point to upload
@@ -123,6 +126,7 @@ extra_patterns = [
     (r'/error_label', UpdateErrorLabelHandler),
     (r"/stats", RedirectHandler, {"url": "/plot_app?stats=1"}),
     (r'/overview_img/(.*)', StaticFileHandler, {'path': get_overview_img_filepath()}),
+    (r'/overview_sprite/([0-9a-f]+)\.jpg', OverviewSpriteHandler),
 ]
 
 server = None
@@ -155,12 +159,13 @@ if args.show:
     server.io_loop.add_callback(show_callback)
 
 
-if debug_print_timing():
-    def print_statistics():
-        """ print ulog cache info once per hour """
+def print_statistics():
+    """ print the overview image queue statistics (and ulog cache info) once per hour """
+    if debug_print_timing():
         print_cache_info()
-        server.io_loop.call_later(60*60, print_statistics)
-    server.io_loop.call_later(60, print_statistics)
+    print_overview_img_queue_stats()
+    server.io_loop.call_later(60*60, print_statistics)
+server.io_loop.call_later(60, print_statistics)
 
 # run_until_shutdown has been added 0.12.4 and is the preferred start method
 run_op = getattr(server, "run_until_shutdown", None)
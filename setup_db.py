@@ -9,7 +9,12 @@ import os
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_app'))
 from plot_app.config import get_db_filename, get_log_filepath, \
-    get_cache_filepath, get_kml_filepath, get_overview_img_filepath
+    get_cache_filepath, get_kml_filepath, get_overview_img_filepath, \
+    get_pid_analysis_filepath, get_3d_filepath, get_tile_cache_filepath, \
+    get_overview_sprite_filepath, get_db_info_filepath
+from plot_app.search_index import create_search_index, has_search_index, \
+    is_search_index_outdated, build_search_index
+from plot_app.db_entry import DBDataGenerated
 
 log_dir = get_log_filepath()
 if not os.path.exists(log_dir):
@@ -25,12 +30,43 @@ cur_dir = get_kml_filepath()
 if not os.path.exists(cur_dir):
     print('creating kml directory '+cur_dir)
     os.makedirs(cur_dir)
+else:
+    # COMPATIBILITY: tracks were cached as <log id>.kml, they are stored as
+    # <log id>.kmz now and the old files would never be deleted
+    for file_name in os.listdir(cur_dir):
+        if file_name.endswith('.kml'):
+            os.unlink(os.path.join(cur_dir, file_name))
 
 cur_dir = get_overview_img_filepath()
 if not os.path.exists(cur_dir):
     print('creating overview image directory '+cur_dir)
     os.makedirs(cur_dir)
 
+cur_dir = get_overview_sprite_filepath()
+if not os.path.exists(cur_dir):
+    print('creating overview image sprite directory '+cur_dir)
+    os.makedirs(cur_dir)
+
+cur_dir = get_pid_analysis_filepath()
+if not os.path.exists(cur_dir):
+    print('creating PID analysis cache directory '+cur_dir)
+    os.makedirs(cur_dir)
+
+cur_dir = get_3d_filepath()
+if not os.path.exists(cur_dir):
+    print('creating 3D view cache directory '+cur_dir)
+    os.makedirs(cur_dir)
+
+cur_dir = get_tile_cache_filepath()
+if not os.path.exists(cur_dir):
+    print('creating map tile cache directory '+cur_dir)
+    os.makedirs(cur_dir)
+
+cur_dir = get_db_info_filepath()
+if not os.path.exists(cur_dir):
+    print('creating dbinfo snapshot directory '+cur_dir)
+    os.makedirs(cur_dir)
+
 print('creating DB at '+get_db_filename())
 con = lite.connect(get_db_filename())
 with con:
@@ -59,6 +95,7 @@ with con:
                 "ErrorLabels TEXT, " # the type of error (if any) that occurred during flight
                 "Public INT, " # if 1 this log can be publicly listed
                 "Token TEXT, " # Security token (currently used to delete the entry)
+                "OverviewImage INT, " # 1: overview image exists, 0: no GPS, NULL: not generated (yet)
                 "CONSTRAINT Id_PK PRIMARY KEY (Id))")
     else:
         # try to upgrade
@@ -90,6 +127,14 @@ with con:
         if not 'Token' in column_names:
             print('Adding column Token')
             cur.execute("ALTER TABLE Logs ADD COLUMN Token TEXT DEFAULT ''")
+        if not 'OverviewImage' in column_names:
+            print('Adding column OverviewImage')
+            cur.execute("ALTER TABLE Logs ADD COLUMN OverviewImage INT DEFAULT NULL")
+            # initialize from the existing images
+            cur.executemany("UPDATE Logs SET OverviewImage = 1 WHERE Id = ?",
+                            [(file_name[:-4],) for file_name in
+                             os.listdir(get_overview_img_filepath())
+                             if file_name.endswith('.png')])
 
 
     # LogsGenerated table (information from the log file, for faster access)
@@ -112,6 +157,11 @@ with con:
                 "UUID TEXT, " # vehicle UUID (sys_uuid in log)
                 "FlightModeDurations TEXT, " # comma-separated list of <flight_mode_int>:<duration_sec>
                 "StartTime INT, " #UTC Timestap from GPS log (useful when uploading multiple logs)
+                # the following are derived from the above, for displaying & sorting
+                "AirframeName TEXT, " # '' if unknown
+                "AirframeType TEXT, " # '' if unknown
+                "ReleaseTag TEXT, " # e.g. 'v1.9.0', '' if not a release
+                "FlightModeNames TEXT, " # comma-separated flight mode names
                 "CONSTRAINT Id_PK PRIMARY KEY (Id))")
 
     else:
@@ -130,6 +180,25 @@ with con:
         if not 'StartTime' in column_names:
             print('Adding column StartTime')
             cur.execute("ALTER TABLE LogsGenerated ADD COLUMN StartTime INT DEFAULT 0")
+        if not 'FlightModeNames' in column_names:
+            print('Adding columns AirframeName, AirframeType, ReleaseTag, FlightModeNames')
+            for column in ['AirframeName', 'AirframeType', 'ReleaseTag', 'FlightModeNames']:
+                cur.execute("ALTER TABLE LogsGenerated ADD COLUMN "+column+" TEXT DEFAULT ''")
+            # initialize from the existing columns
+            cur.execute("SELECT Id, AutostartId, SoftwareVersion, FlightModes FROM LogsGenerated")
+            display_columns = []
+            for log_id, autostart_id, ver_sw_release, flight_modes in cur.fetchall():
+                db_data_gen = DBDataGenerated()
+                db_data_gen.sys_autostart_id = autostart_id
+                db_data_gen.ver_sw_release = ver_sw_release or ''
+                db_data_gen.flight_modes = \
+                    {int(x) for x in (flight_modes or '').split(',') if len(x) > 0}
+                display_columns.append(db_data_gen.airframe_name_and_type() +
+                                       (db_data_gen.release_tag(),
+                                        db_data_gen.flight_mode_names_str(), log_id))
+            cur.executemany("UPDATE LogsGenerated SET AirframeName = ?, AirframeType = ?, "
+                            "ReleaseTag = ?, FlightModeNames = ? WHERE Id = ?",
+                            display_columns)
 
 
     # Vehicle table (contains information about a vehicle)
@@ -144,5 +213,32 @@ with con:
                 "FlightTime INTEGER, " # latest flight time in seconds
                 "CONSTRAINT UUID_PK PRIMARY KEY (UUID))")
 
+
+    # PIDAnalysis table (step response metrics, generated by batch_pid_analysis.py)
+    cur.execute("PRAGMA table_info('PIDAnalysis')")
+    columns = cur.fetchall()
+
+    if len(columns) == 0:
+        cur.execute("CREATE TABLE PIDAnalysis("
+                "Id TEXT, " # log id
+                "Analysis TEXT, " # analyzed axis: rate_{roll,pitch,yaw} or angle_{roll,pitch}
+                "Version INT, " # analysis version the metrics were generated with
+                "RiseTime REAL, " # 10%-90% rise time in [s] (NULL if undetermined)
+                "Overshoot REAL, " # overshoot in [%] (NULL if undetermined)
+                "SettlingTime REAL, " # 5% settling time in [s] (NULL if undetermined)
+                "Error TEXT, " # error message if the analysis failed, '' otherwise
+                "CONSTRAINT PIDAnalysis_PK PRIMARY KEY (Id, Analysis))")
+
+
+    # LogsSearch table (full-text search index for the browse page, optional as
+    # it requires SQLite with FTS5 support)
+    if has_search_index(cur) and is_search_index_outdated(cur):
+        print('Dropping the outdated search index')
+        cur.execute('DROP TABLE LogsSearch')
+    if not has_search_index(cur) and create_search_index(cur):
+        print('Creating the search index')
+        num_indexed = build_search_index(cur)
+        print('Indexed {:} logs'.format(num_indexed))
+
 con.close()
 
@@ -12,17 +12,102 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_filename, get_overview_img_filepath
+from config import get_db_filename
 from db_entry import DBData, DBDataGenerated
-from helper import flight_modes_table, get_airframe_data, html_long_word_force_break
+from helper import html_long_word_force_break
+from overview_generator import register_overview_sprite, create_overview_sprite
+from search_index import has_search_index, get_search_index_query
 
 #pylint: disable=relative-beyond-top-level,too-many-statements
 from .common import get_jinja_env, get_generated_db_data_from_log
 
 BROWSE_TEMPLATE = 'browse.html'
 
+# the public logs shown on the browse page
+BROWSE_SQL_FROM = ('FROM Logs '
+                   '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
+                   'WHERE Logs.Public = 1 AND NOT Logs.Source = "CI"')
+
+# displayed airframe: the name, or the autostart id if unknown
+BROWSE_AIRFRAME_COLUMN = ("CASE WHEN LogsGenerated.AirframeName = '' "
+                          "THEN LogsGenerated.AutostartId ELSE LogsGenerated.AirframeName END")
+
+# the ratings, ordered from worst to best
+BROWSE_RATING_COLUMN = ('CASE Logs.Rating '+' '.join(
+    "WHEN '{:}' THEN {:}".format(rating, i+1)
+    for i, rating in enumerate(DBData.RATING_STRINGS))+' ELSE 0 END')
+
+# columns (SQL expressions) that are searched with a substring match. They are
+# the same as displayed (except for the rating, which is handled separately)
+BROWSE_SEARCH_COLUMNS = [
+    'Logs.Id',
+    'DATE(Logs.Date)',
+    'Logs.Description',
+    'LogsGenerated.MavType',
+    BROWSE_AIRFRAME_COLUMN,
+    'LogsGenerated.Hardware',
+    'LogsGenerated.Software',
+    'LogsGenerated.SoftwareVersion',
+    'LogsGenerated.UUID',
+    'LogsGenerated.NumLoggedErrors',
+    'LogsGenerated.FlightModeNames',
+    "printf('%d:%02d:%02d', LogsGenerated.Duration / 3600, "
+    "       LogsGenerated.Duration / 60 % 60, LogsGenerated.Duration % 60)",
+    "CASE WHEN LogsGenerated.StartTime = 0 THEN 'N/A' ELSE "
+    "    strftime('%Y-%m-%d  %H:%M', LogsGenerated.StartTime, 'unixepoch', 'localtime') END",
+    ]
+
+# page lengths of the browse page (lengthMenu in browse.html)
+BROWSE_PAGE_LENGTHS = [10, 25, 50, 75, 100]
+
 #pylint: disable=abstract-method
 
+
+def _like_pattern(search_str):
+    """ LIKE pattern (with escape character '\\') for a substring search """
+    return '%'+search_str.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')+'%'
+
+
+def _lower(value):
+    return value.lower() if isinstance(value, str) else value
+
+
+def get_browse_search_condition(con, cur, search_str):
+    """ get the SQL condition for a search on the browse page. This uses the
+    full-text search index if it exists, otherwise a (case-insensitive)
+    substring match over the displayed columns and the log id, software
+    version and vehicle UUID.
+    :param search_str: lower-case search string
+    :return: tuple of (SQL condition, list of parameters)
+    """
+    if has_search_index(cur):
+        search_query = get_search_index_query(search_str)
+        if search_query is None:
+            return '1', []
+        return 'Logs.Id IN (SELECT Id FROM LogsSearch WHERE LogsSearch MATCH ?)', \
+            [search_query]
+
+    pattern = _like_pattern(search_str)
+    if all(ord(c) < 128 for c in search_str):
+        conditions = [column+" LIKE ? ESCAPE '\\'" for column in BROWSE_SEARCH_COLUMNS]
+    else:
+        # LIKE is only case-insensitive for ASCII characters
+        con.create_function('py_lower', 1, _lower)
+        conditions = ['py_lower('+column+") LIKE ? ESCAPE '\\'"
+                      for column in BROWSE_SEARCH_COLUMNS]
+    params = [pattern] * len(BROWSE_SEARCH_COLUMNS)
+
+    # the rating is displayed differently from how it is stored: find the
+    # matching display strings and search for the stored values
+    ratings = [rating for rating, rating_str in DBData.RATING_STRINGS.items()
+               if search_str in rating_str.lower()]
+    if len(ratings) > 0:
+        conditions.append('Logs.Rating IN ('+','.join(['?'] * len(ratings))+')')
+        params.extend(ratings)
+
+    return '('+' OR '.join(conditions)+')', params
+
+
 class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
     """ Ajax data retrieval handler """
 
@@ -38,42 +123,62 @@ class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
         json_output['draw'] = draw_counter
 
 
-        # get the logs (but only the public ones)
+        # get the logs (but only the public ones). Filtering, ordering and
+        # pagination is done in SQL, so that only the requested page is loaded
         con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
         cur = con.cursor()
 
-        sql_order = ' ORDER BY Date DESC'
+        sql_order = ' ORDER BY Logs.Date DESC'
+        is_default_order = True
 
         ordering_col = ['',#table row number
                         'Logs.Date',
-                        '',#Overview - img
+                        'Logs.OverviewImage',
                         'Logs.Description',
                         'LogsGenerated.MavType',
-                        '',#Airframe - not from DB
+                        BROWSE_AIRFRAME_COLUMN,
                         'LogsGenerated.Hardware',
                         'LogsGenerated.Software',
                         'LogsGenerated.Duration',
                         'LogsGenerated.StartTime',
-                        '',#Rating
+                        BROWSE_RATING_COLUMN,
                         'LogsGenerated.NumLoggedErrors',
-                        '' #FlightModes
+                        'LogsGenerated.FlightModeNames'
                         ]
-        if ordering_col[order_ind] != '':
+        if 0 <= order_ind < len(ordering_col) and ordering_col[order_ind] != '':
             sql_order = ' ORDER BY ' + ordering_col[order_ind]
             if order_dir == 'desc':
                 sql_order += ' DESC'
+            is_default_order = order_ind == 1 and order_dir == 'desc'
+            # stable order for the pagination
+            sql_order += ', Logs.Date DESC'
+
+        cur.execute('SELECT COUNT(*) FROM Logs WHERE Public = 1 AND NOT Source = "CI"')
+        json_output['recordsTotal'] = cur.fetchone()[0]
+
+        sql_from = BROWSE_SQL_FROM
+        sql_params = []
+        if search_str == '':
+            json_output['recordsFiltered'] = json_output['recordsTotal']
+        else:
+            search_condition, sql_params = get_browse_search_condition(con, cur, search_str)
+            sql_from += ' AND '+search_condition
+            cur.execute('SELECT COUNT(*) '+sql_from, sql_params)
+            json_output['recordsFiltered'] = cur.fetchone()[0]
 
         cur.execute('SELECT Logs.Id, Logs.Date, '
                     '       Logs.Description, Logs.WindSpeed, '
-                    '       Logs.Rating, Logs.VideoUrl, '
-                    '       LogsGenerated.* '
-                    'FROM Logs '
-                    '   LEFT JOIN LogsGenerated on Logs.Id=LogsGenerated.Id '
-                    'WHERE Logs.Public = 1 AND NOT Logs.Source = "CI" '
-                    +sql_order)
+                    '       Logs.Rating, Logs.VideoUrl, Logs.OverviewImage, '
+                    '       LogsGenerated.Id, LogsGenerated.Duration, LogsGenerated.MavType, '
+                    '       LogsGenerated.AutostartId, LogsGenerated.Hardware, '
+                    '       LogsGenerated.Software, LogsGenerated.NumLoggedErrors, '
+                    '       LogsGenerated.StartTime, LogsGenerated.AirframeName, '
+                    '       LogsGenerated.ReleaseTag, LogsGenerated.FlightModeNames '
+                    +sql_from+sql_order+' LIMIT ? OFFSET ?',
+                    sql_params + [data_length, max(0, data_start)])
 
         # pylint: disable=invalid-name
-        Columns = collections.namedtuple("Columns", "columns search_only_columns")
+        Columns = collections.namedtuple("Columns", "columns overview_log_id")
 
         def get_columns_from_tuple(db_tuple, counter):
             """ load the columns (list of strings) from a db_tuple
@@ -88,51 +193,39 @@ class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
             db_data.wind_speed = db_tuple[3]
             db_data.rating = db_tuple[4]
             db_data.video_url = db_tuple[5]
-            generateddata_log_id = db_tuple[6]
+            overview_log_id = log_id if db_tuple[6] == 1 else None
+            generateddata_log_id = db_tuple[7]
             if log_id != generateddata_log_id:
                 print('Join failed, loading and updating data')
                 db_data_gen = get_generated_db_data_from_log(log_id, con, cur)
                 if db_data_gen is None:
                     return None
                 db_data.add_generated_db_data_from_log(db_data_gen)
+                airframe_name = db_data.airframe_name_and_type()[0]
+                release_tag = db_data.release_tag()
+                flight_modes = db_data.flight_mode_names_str()
             else:
-                db_data.duration_s = db_tuple[7]
-                db_data.mav_type = db_tuple[8]
-                db_data.estimator = db_tuple[9]
+                db_data.duration_s = db_tuple[8]
+                db_data.mav_type = db_tuple[9]
                 db_data.sys_autostart_id = db_tuple[10]
                 db_data.sys_hw = db_tuple[11]
                 db_data.ver_sw = db_tuple[12]
                 db_data.num_logged_errors = db_tuple[13]
-                db_data.num_logged_warnings = db_tuple[14]
-                db_data.flight_modes = \
-                    {int(x) for x in db_tuple[15].split(',') if len(x) > 0}
-                db_data.ver_sw_release = db_tuple[16]
-                db_data.vehicle_uuid = db_tuple[17]
-                db_data.flight_mode_durations = \
-                   [tuple(map(int, x.split(':'))) for x in db_tuple[18].split(',') if len(x) > 0]
-                db_data.start_time_utc = db_tuple[19]
+                db_data.start_time_utc = db_tuple[14]
+                # the display columns are stored in the DB
+                airframe_name = db_tuple[15]
+                release_tag = db_tuple[16]
+                flight_modes = db_tuple[17]
 
             # bring it into displayable form
             ver_sw = db_data.ver_sw
             if len(ver_sw) > 10:
                 ver_sw = ver_sw[:6]
-            if len(db_data.ver_sw_release) > 0:
-                try:
-                    release_split = db_data.ver_sw_release.split()
-                    release_type = int(release_split[1])
-                    if release_type == 255: # it's a release
-                        ver_sw = release_split[0]
-                except:
-                    pass
-            airframe_data = get_airframe_data(db_data.sys_autostart_id)
-            if airframe_data is None:
+            if len(release_tag) > 0:
+                ver_sw = release_tag
+            airframe = airframe_name
+            if len(airframe) == 0:
                 airframe = db_data.sys_autostart_id
-            else:
-                airframe = airframe_data['name']
-
-            flight_modes = ', '.join([flight_modes_table[x][0]
-                                      for x in db_data.flight_modes if x in
-                                      flight_modes_table])
 
             m, s = divmod(db_data.duration_s, 60)
             h, m = divmod(m, 60)
@@ -147,22 +240,8 @@ class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
             # mess up the layout)
             description = html_long_word_force_break(db_data.description)
 
-            search_only_columns = []
-
-            if db_data.ver_sw is not None:
-                search_only_columns.append(db_data.ver_sw)
-
-            if db_data.ver_sw_release is not None:
-                search_only_columns.append(db_data.ver_sw_release)
-
-            if db_data.vehicle_uuid is not None:
-                search_only_columns.append(db_data.vehicle_uuid)
-
+            # the overview image is set later (it's part of the page's sprite)
             image_col = '<div class="no_map_overview"> Not rendered / No GPS </div>'
-            image_filename = os.path.join(get_overview_img_filepath(), log_id+'.png')
-            if os.path.exists(image_filename):
-                image_col = '<img class="map_overview" src="/overview_img/'
-                image_col += log_id+'.png" alt="Overview Image Load Failed" height=50/>'
 
             return Columns([
                 counter,
@@ -178,49 +257,53 @@ class BrowseDataRetrievalHandler(tornado.web.RequestHandler):
                 db_data.rating_str(),
                 db_data.num_logged_errors,
                 flight_modes
-            ], search_only_columns)
+            ], overview_log_id)
 
         # need to fetch all here, because we will do more SQL calls while
         # iterating (having multiple cursor's does not seem to work)
         db_tuples = cur.fetchall()
-        json_output['recordsTotal'] = len(db_tuples)
-        json_output['data'] = []
-        if data_length == -1:
-            data_length = len(db_tuples)
-
-        filtered_counter = 0
-        if search_str == '':
-            # speed-up the request by iterating only over the requested items
-            counter = data_start
-            for i in range(data_start, min(data_start + data_length, len(db_tuples))):
-                counter += 1
-
-                columns = get_columns_from_tuple(db_tuples[i], counter)
-                if columns is None:
-                    continue
-
-                json_output['data'].append(columns.columns)
-            filtered_counter = len(db_tuples)
-        else:
-            counter = 1
-            for db_tuple in db_tuples:
-                counter += 1
-
-                columns = get_columns_from_tuple(db_tuple, counter)
-                if columns is None:
-                    continue
-
-                if any([search_str in str(column).lower() for column in \
-                        (columns.columns, columns.search_only_columns)]):
-                    if data_start <= filtered_counter < data_start + data_length:
-                        json_output['data'].append(columns.columns)
-                    filtered_counter += 1
-
+        page_columns = []
+        for counter, db_tuple in enumerate(db_tuples, max(0, data_start) + 1):
+            columns = get_columns_from_tuple(db_tuple, counter)
+            if columns is None:
+                continue
+            page_columns.append(columns)
 
         cur.close()
         con.close()
 
-        json_output['recordsFiltered'] = filtered_counter
+        # all overview images of the page are loaded as a single image (sprite).
+        # Sprites are only used for the pages of the default listing (newest
+        # first, no search), which are requested by most users. Otherwise
+        # (search, ordering or other pagination) the number of distinct pages
+        # is unbounded, and each would store a sprite
+        overview_log_ids = [columns.overview_log_id for columns in page_columns
+                            if columns.overview_log_id is not None]
+        use_sprite = search_str == '' and is_default_order and \
+            data_length in BROWSE_PAGE_LENGTHS and data_start % data_length == 0
+        if not use_sprite:
+            for columns in page_columns:
+                if columns.overview_log_id is not None:
+                    columns.columns[2] = (
+                        '<img class="map_overview" src="/overview_img/'+columns.overview_log_id+
+                        '.png" alt="Overview Image Load Failed" height=50/>')
+        elif len(overview_log_ids) > 0:
+            sprite_key = register_overview_sprite(overview_log_ids)
+            num_overviews = len(overview_log_ids)
+            sprite_index = 0
+            for columns in page_columns:
+                if columns.overview_log_id is None:
+                    continue
+                position = 0
+                if num_overviews > 1:
+                    position = sprite_index * 100 / (num_overviews - 1)
+                columns.columns[2] = (
+                    '<div class="map_overview map_overview_sprite" style="'
+                    'background-image: url(/overview_sprite/{:}.jpg); '
+                    'background-size: 100% {:}%; background-position: 0 {:.4f}%"></div>'
+                    .format(sprite_key, num_overviews * 100, position))
+                sprite_index += 1
+        json_output['data'] = [columns.columns for columns in page_columns]
 
         self.set_header('Content-Type', 'application/json')
         self.write(json.dumps(json_output))
@@ -233,6 +316,19 @@ class DBDataJoin(DBData, DBDataGenerated):
         self.__dict__.update(source.__dict__)
 
 
+class OverviewSpriteHandler(tornado.web.RequestHandler):
+    """ Overview images of a browse page, combined into a single image """
+
+    def get(self, sprite_key):
+        data = create_overview_sprite(sprite_key)
+        if data is None:
+            raise tornado.web.HTTPError(404, 'Sprite not found')
+        # the key depends on the content, so it can be cached for a long time
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Cache-Control', 'public, max-age=31536000')
+        self.write(data)
+
+
 class BrowseHandler(tornado.web.RequestHandler):
     """ Browse public log file Tornado request handler """
 
@@ -14,6 +14,10 @@ import tornado.web
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
 from db_entry import DBDataGenerated
 from config import get_db_filename
+from search_index import update_search_index
+
+#pylint: disable=relative-beyond-top-level
+from .db_info_json import update_db_info_snapshot
 
 #pylint: disable=abstract-method
 
@@ -67,14 +71,17 @@ def generate_db_data_from_log_file(log_id, db_connection=None):
         db_connection = sqlite3.connect(get_db_filename())
         need_closing = True
 
+    airframe_name, airframe_type = db_data_gen.airframe_name_and_type()
+
     db_cursor = db_connection.cursor()
     try:
         db_cursor.execute(
             'insert into LogsGenerated (Id, Duration, '
             'Mavtype, Estimator, AutostartId, Hardware, '
             'Software, NumLoggedErrors, NumLoggedWarnings, '
-            'FlightModes, SoftwareVersion, UUID, FlightModeDurations, StartTime) values '
-            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            'FlightModes, SoftwareVersion, UUID, FlightModeDurations, StartTime, '
+            'AirframeName, AirframeType, ReleaseTag, FlightModeNames) values '
+            '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
             [log_id, db_data_gen.duration_s, db_data_gen.mav_type,
              db_data_gen.estimator, db_data_gen.sys_autostart_id,
              db_data_gen.sys_hw, db_data_gen.ver_sw,
@@ -83,8 +90,12 @@ def generate_db_data_from_log_file(log_id, db_connection=None):
              ','.join(map(str, db_data_gen.flight_modes)),
              db_data_gen.ver_sw_release, db_data_gen.vehicle_uuid,
              db_data_gen.flight_mode_durations_str(),
-             db_data_gen.start_time_utc])
+             db_data_gen.start_time_utc, airframe_name, airframe_type,
+             db_data_gen.release_tag(), db_data_gen.flight_mode_names_str()])
+        update_search_index(db_cursor, [log_id])
         db_connection.commit()
+        # the log is now complete for the public log list
+        update_db_info_snapshot(log_id)
     except sqlite3.IntegrityError:
         # someone else already inserted it (race). just ignore it
         pass
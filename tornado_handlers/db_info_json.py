@@ -2,80 +2,408 @@
 Tornado handler for the JSON public log list retrieval
 """
 from __future__ import print_function
+import datetime
+import email.utils
 import json
 import sqlite3
 import os
 import sys
+import threading
+import uuid
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import tornado.ioloop
+import tornado.iostream
 import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
 from config import get_db_filename
-from db_entry import DBData
-from helper import get_airframe_data
+from config_tables import flight_modes_table, error_labels_table
+from db_entry import DBData, DBDataGenerated
+from helper import get_db_info_snapshot_filename, \
+    get_db_info_entries_filename, db_info_snapshot_lock
 
 
-#pylint: disable=relative-beyond-top-level
-from .common import get_generated_db_data_from_log
-
 #pylint: disable=abstract-method
 
+DB_INFO_CHUNK_ROWS = 500 # number of logs that are sent at once
+DB_INFO_GZIP_LEVEL = 6
+
+# all logs are joined with the generated data and vehicle name in one query.
+# Logs without generated data are skipped (it's created on upload).
+DB_INFO_QUERY = (
+    'SELECT Logs.Id, Logs.Date, Logs.Description, Logs.WindSpeed, Logs.Rating, '
+    '       Logs.VideoUrl, Logs.ErrorLabels, Logs.Source, Logs.Feedback, Logs.Type, '
+    '       LogsGenerated.Duration, LogsGenerated.MavType, LogsGenerated.Estimator, '
+    '       LogsGenerated.AutostartId, LogsGenerated.Hardware, LogsGenerated.Software, '
+    '       LogsGenerated.NumLoggedErrors, LogsGenerated.NumLoggedWarnings, '
+    '       LogsGenerated.FlightModes, LogsGenerated.SoftwareVersion, '
+    '       LogsGenerated.UUID, LogsGenerated.FlightModeDurations, Vehicle.Name, '
+    '       LogsGenerated.AirframeName, LogsGenerated.AirframeType '
+    'FROM Logs '
+    '   JOIN LogsGenerated ON Logs.Id = LogsGenerated.Id '
+    '   LEFT JOIN Vehicle ON LogsGenerated.UUID = Vehicle.UUID '
+    'WHERE Logs.Public = 1')
+
+
+def db_info_json_dict(db_tuple):
+    """ convert a row of DB_INFO_QUERY into the JSON dict of a log """
+    jsondict = dict()
+    jsondict['log_id'] = db_tuple[0]
+    jsondict['log_date'] = db_tuple[1].strftime('%Y-%m-%d')
+    # full upload time, to be used as 'since' cursor (with 'since_id', the log id)
+    jsondict['upload_time'] = db_tuple[1].isoformat()
+    db_data = DBData()
+    db_data.description = db_tuple[2]
+    db_data.wind_speed = db_tuple[3]
+    db_data.rating = db_tuple[4]
+    db_data.video_url = db_tuple[5]
+    db_data.error_labels = sorted([int(x) for x in db_tuple[6].split(',') if len(x) > 0]) \
+        if db_tuple[6] else []
+    db_data.source = db_tuple[7]
+    db_data.feedback = db_tuple[8]
+    db_data.type = db_tuple[9]
+    jsondict.update(db_data.to_json_dict())
+
+    db_data_gen = DBDataGenerated()
+    db_data_gen.duration_s = db_tuple[10]
+    db_data_gen.mav_type = db_tuple[11]
+    db_data_gen.estimator = db_tuple[12]
+    db_data_gen.sys_autostart_id = db_tuple[13]
+    db_data_gen.sys_hw = db_tuple[14]
+    db_data_gen.ver_sw = db_tuple[15]
+    db_data_gen.num_logged_errors = db_tuple[16]
+    db_data_gen.num_logged_warnings = db_tuple[17]
+    db_data_gen.flight_modes = \
+        {int(x) for x in db_tuple[18].split(',') if len(x) > 0}
+    db_data_gen.ver_sw_release = db_tuple[19]
+    db_data_gen.vehicle_uuid = db_tuple[20]
+    db_data_gen.flight_mode_durations = \
+        [tuple(map(int, x.split(':'))) for x in db_tuple[21].split(',') if len(x) > 0]
+    jsondict.update(db_data_gen.to_json_dict())
+
+    jsondict['vehicle_name'] = db_tuple[22] or ''
+    jsondict['airframe_name'] = db_tuple[23] or ''
+    jsondict['airframe_type'] = db_tuple[24] or jsondict['sys_autostart_id']
+    return jsondict
+
+
+def _load_db_info_entries():
+    """ load the serialized entries of the snapshot
+    :return: dict of log_id: (upload time, JSON str), ordered by upload time,
+             or None if it does not exist
+    """
+    try:
+        with open(get_db_info_entries_filename(), 'r', encoding='utf-8') as entries_file:
+            entries = {}
+            for line in entries_file:
+                log_id, upload_time, entry = line.rstrip('\n').split('\t', 2)
+                entries[log_id] = (upload_time, entry)
+            return entries
+    except FileNotFoundError:
+        return None
+
+
+def _write_db_info_file(file_name, data):
+    """ write to a random temporary file, then move it (so that readers never
+    see a partial file) """
+    temp_file_name = file_name+'.'+str(uuid.uuid4())
+    try:
+        with open(temp_file_name, 'wb') as output_file:
+            output_file.write(data)
+        os.replace(temp_file_name, file_name)
+    finally:
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+
+
+def generate_db_info_snapshot(log_ids=None):
+    """ update the /dbinfo snapshot (gzipped JSON list of all public logs).
+    Only the entries of the given logs are (re-)serialized, or all of them if
+    log_ids is None or the entries do not exist yet.
+    :param log_ids: ids of added, modified or deleted logs
+    """
+    with db_info_snapshot_lock():
+        entries = None if log_ids is None else _load_db_info_entries()
+        con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
+        cur = con.cursor()
+        try:
+            if entries is None:
+                cur.execute(DB_INFO_QUERY+' ORDER BY Logs.Date, Logs.Id')
+                entries = {db_tuple[0]: (db_tuple[1].isoformat(),
+                                         json.dumps(db_info_json_dict(db_tuple)))
+                           for db_tuple in cur}
+            else:
+                is_sorted = True
+                for log_id in log_ids:
+                    cur.execute(DB_INFO_QUERY+' AND Logs.Id = ?', (log_id,))
+                    db_tuple = cur.fetchone()
+                    if db_tuple is None: # deleted or not public
+                        entries.pop(log_id, None)
+                        continue
+                    is_sorted = is_sorted and log_id in entries
+                    entries[log_id] = (db_tuple[1].isoformat(),
+                                       json.dumps(db_info_json_dict(db_tuple)))
+                if not is_sorted: # new logs (usually the most recent ones)
+                    entries = dict(sorted(entries.items(),
+                                          key=lambda item: (item[1][0], item[0])))
+        finally:
+            cur.close()
+            con.close()
+
+        _write_db_info_file(get_db_info_entries_filename(), ''.join(
+            log_id+'\t'+upload_time+'\t'+entry+'\n'
+            for log_id, (upload_time, entry) in entries.items()).encode('utf-8'))
+        compressor = zlib.compressobj(DB_INFO_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        data = '['+','.join(entry for _, entry in entries.values())+']'
+        _write_db_info_file(get_db_info_snapshot_filename(),
+                            compressor.compress(data.encode('utf-8')) + compressor.flush())
+
+
+__db_info_update = {'executor': None, 'log_ids': set(), 'lock': threading.Lock()}
+def _get_db_info_executor():
+    if __db_info_update['executor'] is None:
+        __db_info_update['executor'] = ThreadPoolExecutor(max_workers=1)
+    return __db_info_update['executor']
+
+
+def update_db_info_snapshot(log_id):
+    """ update the /dbinfo snapshot in a background thread, after a log was
+    added, modified or deleted (and the DB change is committed) """
+    with __db_info_update['lock']:
+        __db_info_update['log_ids'].add(log_id)
+
+    def update():
+        # handle all logs changed in the meantime at once
+        with __db_info_update['lock']:
+            log_ids = __db_info_update['log_ids']
+            __db_info_update['log_ids'] = set()
+        if len(log_ids) == 0:
+            return
+        try:
+            generate_db_info_snapshot(log_ids)
+        except Exception as e:
+            print('Failed to update the dbinfo snapshot', e)
+    _get_db_info_executor().submit(update)
+
+
+def _ensure_db_info_snapshot():
+    """ generate the snapshot if it does not exist (checked again in the
+    executor, another request might have generated it in the meantime) """
+    if not os.path.exists(get_db_info_snapshot_filename()):
+        generate_db_info_snapshot()
+
+
+# accepted formats of the 'since' argument (the first is the one of 'upload_time')
+SINCE_FORMATS = ['%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M',
+                 '%Y-%m-%d %H:%M:%S.%f', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M',
+                 '%Y-%m-%d']
+
+def _parse_since(value):
+    """ parse the 'since' argument (see SINCE_FORMATS, an optional trailing 'Z'
+    is ignored)
+    :return: datetime, or None if the format is invalid
+    """
+    value = value.strip()
+    if value.endswith('Z'):
+        value = value[:-1]
+    for since_format in SINCE_FORMATS:
+        try:
+            return datetime.datetime.strptime(value, since_format)
+        except ValueError:
+            pass
+    return None
+
+
+def _to_ids(values, table):
+    """ convert a list of ids or names (values of table) into ids """
+    name_to_id = {name.lower(): table_id for table_id, name in
+                  ((table_id, entry[0] if isinstance(entry, tuple) else entry)
+                   for table_id, entry in table.items())}
+    ids = []
+    for value in values:
+        try:
+            ids.append(int(value))
+        except ValueError:
+            if not value.lower() in name_to_id:
+                raise tornado.web.HTTPError(400, 'Unknown value: '+value)
+            ids.append(name_to_id[value.lower()])
+    return ids
+
+
 class DBInfoHandler(tornado.web.RequestHandler):
-    """ Get database info (JSON list of public logs) Tornado request handler """
+    """ Get database info (JSON list of public logs) Tornado request handler.
+    Without arguments, the complete list is sent from a precomputed snapshot.
+
+    Optional arguments (multiple values can be given as comma-separated list
+    or by repeating the argument):
+    - mav_type, rating, uuid, log_id: match any of the values
+    - flight_modes, error_labels: must contain all (ids or names)
+    - vehicle_name, airframe_name, airframe_type: exact match
+    - since: only logs uploaded at or after this time (e.g. a date YYYY-MM-DD,
+      see SINCE_FORMATS)
+    - since_id: together with since, continue after the log with this id. To
+      fetch new logs incrementally, pass the 'upload_time' and 'log_id' of the
+      last received log (logs with the same upload time are not skipped)
+    - limit, offset: pagination (the logs are ordered by upload time and id)
+    """
+
+    def _get_list_argument(self, name):
+        values = []
+        for argument in self.get_arguments(name):
+            values.extend(value.strip() for value in argument.split(',') if value.strip())
+        return values
+
+    def _get_query(self):
+        """ get the SQL query and its parameters from the request arguments """
+        query = DB_INFO_QUERY
+        params = []
+
+        def add_any_filter(column, values):
+            nonlocal query
+            if len(values) > 0:
+                query += ' AND '+column+' IN ('+','.join(['?'] * len(values))+')'
+                params.extend(values)
+
+        add_any_filter('LOWER(LogsGenerated.MavType)',
+                       [value.lower() for value in self._get_list_argument('mav_type')])
+        add_any_filter('LOWER(Logs.Rating)',
+                       [value.lower() for value in self._get_list_argument('rating')])
+        add_any_filter('LogsGenerated.UUID', self._get_list_argument('uuid'))
+        add_any_filter('Logs.Id', self._get_list_argument('log_id'))
+
+        # comma-separated lists of ids in the DB: must contain all
+        for column, name, table in [
+                ('LogsGenerated.FlightModes', 'flight_modes', flight_modes_table),
+                ('Logs.ErrorLabels', 'error_labels', error_labels_table)]:
+            for value_id in _to_ids(self._get_list_argument(name), table):
+                query += " AND (',' || "+column+" || ',') LIKE ?"
+                params.append('%,{:},%'.format(value_id))
+
+        vehicle_name = self.get_argument('vehicle_name', None)
+        if vehicle_name is not None:
+            query += ' AND Vehicle.Name = ?'
+            params.append(vehicle_name)
+        # the airframe type is the autostart id if unknown
+        for argument, column in [
+                ('airframe_name', 'LogsGenerated.AirframeName'),
+                ('airframe_type', "CASE WHEN LogsGenerated.AirframeType = '' "
+                                  "THEN CAST(LogsGenerated.AutostartId AS TEXT) "
+                                  "ELSE LogsGenerated.AirframeType END")]:
+            value = self.get_argument(argument, None)
+            if value is not None:
+                query += ' AND '+column+' = ?'
+                params.append(value)
+
+        since = self.get_argument('since', None)
+        if since is not None:
+            since = _parse_since(since)
+            if since is None:
+                raise tornado.web.HTTPError(400, 'Invalid Parameter: since')
+            since_id = self.get_argument('since_id', None)
+            if since_id is None:
+                query += ' AND Logs.Date >= ?'
+                params.append(since)
+            else:
+                # (Date, Id) cursor, matching the order below
+                query += ' AND (Logs.Date > ? OR (Logs.Date = ? AND Logs.Id > ?))'
+                params.extend([since, since, since_id])
+
+        query += ' ORDER BY Logs.Date, Logs.Id'
+        try:
+            limit = int(self.get_argument('limit', '-1'))
+            offset = int(self.get_argument('offset', '0'))
+        except ValueError:
+            raise tornado.web.HTTPError(400, 'Invalid Parameter: limit/offset')
+        if limit >= 0 or offset > 0:
+            query += ' LIMIT ? OFFSET ?'
+            params.extend([limit, max(0, offset)])
+        return query, params
+
+    async def send_snapshot(self):
+        """ send the (pre-gzipped) snapshot of the complete list, generating it
+        first if needed. Clients can use conditional requests (ETag or
+        Last-Modified) to poll for changes.
+        :return: False if the snapshot is not available
+        """
+        try:
+            if not os.path.exists(get_db_info_snapshot_filename()):
+                await tornado.ioloop.IOLoop.current().run_in_executor(
+                    _get_db_info_executor(), _ensure_db_info_snapshot)
+            snapshot_file = open(get_db_info_snapshot_filename(), 'rb')
+        except Exception as e:
+            print('Failed to generate the dbinfo snapshot', e)
+            return False
+
+        with snapshot_file:
+            stat = os.fstat(snapshot_file.fileno())
+            modified = datetime.datetime.utcfromtimestamp(int(stat.st_mtime))
+            self.set_header('Etag', '"{:x}-{:x}"'.format(stat.st_mtime_ns, stat.st_size))
+            self.set_header('Last-Modified', modified)
+            self.set_header('Cache-Control', 'no-cache')
+            self.set_header('Vary', 'Accept-Encoding')
+            self.set_header('Content-Type', 'application/json')
+
+            not_modified = self.check_etag_header()
+            if_modified_since = self.request.headers.get('If-Modified-Since')
+            if if_modified_since is not None and \
+                    self.request.headers.get('If-None-Match') is None:
+                date_tuple = email.utils.parsedate(if_modified_since)
+                not_modified = date_tuple is not None and \
+                    datetime.datetime(*date_tuple[:6]) >= modified
+            if not_modified:
+                self.set_status(304)
+                return True
+            data = snapshot_file.read()
+
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+        else:
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        self.write(data)
+        return True
 
-    def get(self, *args, **kwargs):
+    async def get(self, *args, **kwargs):
 
-        jsonlist = list()
+        # the complete list is served from the snapshot
+        if len(self.request.arguments) == 0 and await self.send_snapshot():
+            return
 
         # get the logs (but only the public ones)
         con = sqlite3.connect(get_db_filename(), detect_types=sqlite3.PARSE_DECLTYPES)
         cur = con.cursor()
+        try:
+            query, params = self._get_query()
+            cur.execute(query, params)
 
-        # get vehicle name information from vehicle table
-        cur.execute('select UUID, Name from Vehicle')
-        db_tuples = cur.fetchall()
-        vehicle_table = {db_tuple[0]: db_tuple[1] for db_tuple in db_tuples}
-
-        cur.execute('select Id, Date, Description, WindSpeed, Rating, VideoUrl, ErrorLabels, '
-                    'Source, Feedback, Type from Logs where Public = 1')
-        # need to fetch all here, because we will do more SQL calls while
-        # iterating (having multiple cursor's does not seem to work)
-        db_tuples = cur.fetchall()
-        for db_tuple in db_tuples:
-            jsondict = dict()
-            db_data = DBData()
-            log_id = db_tuple[0]
-            jsondict['log_id'] = log_id
-            jsondict['log_date'] = db_tuple[1].strftime('%Y-%m-%d')
-            db_data.description = db_tuple[2]
-            db_data.wind_speed = db_tuple[3]
-            db_data.rating = db_tuple[4]
-            db_data.video_url = db_tuple[5]
-            db_data.error_labels = sorted([int(x) for x in db_tuple[6].split(',') if len(x) > 0]) \
-                if db_tuple[6] else []
-            db_data.source = db_tuple[7]
-            db_data.feedback = db_tuple[8]
-            db_data.type = db_tuple[9]
-            jsondict.update(db_data.to_json_dict())
-
-            db_data_gen = get_generated_db_data_from_log(log_id, con, cur)
-            if db_data_gen is None:
-                continue
-
-            jsondict.update(db_data_gen.to_json_dict())
-            # add vehicle name
-            jsondict['vehicle_name'] = vehicle_table.get(jsondict['vehicle_uuid'], '')
-            airframe_data = get_airframe_data(jsondict['sys_autostart_id'])
-            jsondict['airframe_name'] = airframe_data.get('name', '') \
-                if airframe_data is not None else ''
-            jsondict['airframe_type'] = airframe_data.get('type', jsondict['sys_autostart_id']) \
-                if airframe_data is not None else jsondict['sys_autostart_id']
-
-            jsonlist.append(jsondict)
-
-        cur.close()
-        con.close()
-
-        self.set_header('Content-Type', 'application/json')
-        self.write(json.dumps(jsonlist))
+            self.set_header('Content-Type', 'application/json')
+            self.set_header('Vary', 'Accept-Encoding')
+            compressor = None
+            if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+                self.set_header('Content-Encoding', 'gzip')
+                compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
 
+            # stream the JSON list in chunks of rows
+            separator = '['
+            while True:
+                db_tuples = cur.fetchmany(DB_INFO_CHUNK_ROWS)
+                if len(db_tuples) == 0:
+                    break
+                data = separator + ','.join(json.dumps(db_info_json_dict(db_tuple))
+                                            for db_tuple in db_tuples)
+                separator = ','
+                data = data.encode('utf-8')
+                if compressor is not None:
+                    data = compressor.compress(data)
+                self.write(data)
+                await self.flush()
+            data = (']' if separator == ',' else '[]').encode('utf-8')
+            if compressor is not None:
+                data = compressor.compress(data) + compressor.flush()
+            self.write(data)
+        except tornado.iostream.StreamClosedError:
+            pass # client disconnected
+        finally:
+            cur.close()
+            con.close()
@@ -3,33 +3,40 @@ Tornado handler for the download page
 """
 
 from __future__ import print_function
+import datetime
 import os
+import re
 from html import escape
 import sys
-import uuid
-import shutil
 import sqlite3
+import tornado.iostream
 import tornado.web
 
-from pyulog.ulog2kml import convert_ulog2kml
-
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
 from helper import get_log_filename, validate_log_id, \
-    flight_modes_table, load_ulog_file, get_default_parameters
+    load_ulog_file, load_ulog_topic, get_default_parameters
+from kml_generator import get_kmz, kmz_to_kml
+from topic_export import EXPORT_FORMATS, TopicExportError, is_export_format_available, \
+    get_topic_columns, generate_csv, export_binary
 
-from config import get_db_filename, get_kml_filepath
+from config import get_db_filename
 
 #pylint: disable=relative-beyond-top-level
 from .common import CustomHTTPError, TornadoRequestHandlerBase
 
 #pylint: disable=abstract-method, unused-argument
 
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024 # log files are sent in chunks of this size [bytes]
+
 class DownloadHandler(TornadoRequestHandlerBase):
     """ Download log file Tornado request handler """
 
-    def get(self, *args, **kwargs):
-        """ GET request callback """
+    async def get(self, *args, **kwargs):
+        """ GET request callback. The type argument selects what is downloaded:
+        '0' (default): the log file, '1': all parameters, '3': the non-default
+        parameters, '2': the GPS track (kml or kmz), 'topic': a single topic
+        (one topic per request, see below) """
         log_id = self.get_argument('log')
         if not validate_log_id(log_id):
             raise tornado.web.HTTPError(400, 'Invalid Parameter')
@@ -76,55 +83,22 @@ class DownloadHandler(TornadoRequestHandlerBase):
                 self.write('\n')
 
         elif download_type == '2': # download the kml file
-            kml_path = get_kml_filepath()
-            kml_file_name = os.path.join(kml_path, log_id.replace('/', '.')+'.kml')
-
-            # check if chached file exists
-            if not os.path.exists(kml_file_name):
-                print('need to create kml file', kml_file_name)
-
-                def kml_colors(flight_mode):
-                    """ flight mode colors for KML file """
-                    if not flight_mode in flight_modes_table: flight_mode = 0
-
-                    color_str = flight_modes_table[flight_mode][1][1:] # color in form 'ff00aa'
-
-                    # increase brightness to match colors with template
-                    rgb = [int(color_str[2*x:2*x+2], 16) for x in range(3)]
-                    for i in range(3):
-                        rgb[i] += 40
-                        if rgb[i] > 255: rgb[i] = 255
-
-                    color_str = "".join(map(lambda x: format(x, '02x'), rgb))
-
-                    return 'ff'+color_str[4:6]+color_str[2:4]+color_str[0:2] # KML uses aabbggrr
-
-                style = {'line_width': 2}
-                # create in random temporary file, then move it (to avoid races)
-                try:
-                    temp_file_name = kml_file_name+'.'+str(uuid.uuid4())
-                    convert_ulog2kml(log_file_name, temp_file_name,
-                                     'vehicle_global_position', kml_colors,
-                                     style=style,
-                                     camera_trigger_topic_name='camera_capture')
-                    shutil.move(temp_file_name, kml_file_name)
-                except:
-                    print('Error creating KML file', sys.exc_info()[0], sys.exc_info()[1])
-                    raise CustomHTTPError(400, 'No Position Data in log')
-
-
-            kml_dl_file_name = get_original_filename('track.kml', '.kml')
-
-            # send the whole KML file
-            self.set_header("Content-Type", "application/vnd.google-earth.kml+xml")
-            self.set_header('Content-Disposition', 'attachment; filename='+kml_dl_file_name)
-            with open(kml_file_name, 'rb') as kml_file:
-                while True:
-                    data = kml_file.read(4096)
-                    if not data:
-                        break
-                    self.write(data)
-                self.finish()
+            # the track is cached as KMZ (zipped KML). It's generated from the
+            # (RAM-cached) log, if it was not already precomputed on upload
+            kmz = get_kmz(log_id, lambda: load_ulog_file(log_file_name))
+            if kmz is None:
+                raise CustomHTTPError(400, 'No Position Data in log')
+
+            if self.get_argument('format', default='kml') == 'kmz':
+                self.set_header("Content-Type", "application/vnd.google-earth.kmz")
+                self.set_header('Content-Disposition', 'attachment; filename='+
+                                get_original_filename('track.kmz', '.kmz'))
+                self.write(kmz)
+            else:
+                self.set_header("Content-Type", "application/vnd.google-earth.kml+xml")
+                self.set_header('Content-Disposition', 'attachment; filename='+
+                                get_original_filename('track.kml', '.kml'))
+                self.write(kmz_to_kml(kmz))
 
         elif download_type == '3': # download the non-default parameters
             ulog = load_ulog_file(log_file_name)
@@ -157,16 +131,135 @@ class DownloadHandler(TornadoRequestHandlerBase):
                 except:
                     pass
 
+        elif download_type == 'topic': # export a single topic
+            # arguments: topic (a single topic name), instance (default 0),
+            # fields (comma-separated, default all), start & end (seconds since
+            # boot), format ('csv', 'parquet' or 'arrow')
+            topic_name = self.get_argument('topic')
+            if not re.match(r'^[0-9a-zA-Z_]+$', topic_name):
+                raise tornado.web.HTTPError(400, 'Invalid Parameter')
+            # check against the message formats of the log (taken from the
+            # cached ULog), so that unknown names do not fill the topic cache
+            if not topic_name in load_ulog_file(log_file_name).message_formats:
+                raise CustomHTTPError(400, 'Unknown topic')
+            export_format = self.get_argument('format', default='csv')
+            if not export_format in EXPORT_FORMATS:
+                raise CustomHTTPError(400, 'Unknown format')
+            if not is_export_format_available(export_format):
+                raise CustomHTTPError(400, 'Format not supported by the server')
+            fields = [field for field in self.get_argument('fields', default='').split(',')
+                      if len(field) > 0]
+            try:
+                multi_id = int(self.get_argument('instance', default='0'))
+                start_s = self.get_argument('start', default=None)
+                start_s = None if start_s is None else float(start_s)
+                end_s = self.get_argument('end', default=None)
+                end_s = None if end_s is None else float(end_s)
+            except ValueError:
+                raise tornado.web.HTTPError(400, 'Invalid Parameter')
+
+            ulog = load_ulog_topic(log_file_name, topic_name)
+            try:
+                field_names, columns = get_topic_columns(
+                    ulog, topic_name, multi_id, fields, start_s, end_s)
+            except TopicExportError as error:
+                raise CustomHTTPError(400, str(error))
+
+            file_extension, content_type = EXPORT_FORMATS[export_format]
+            file_name_suffix = '_'+topic_name+'_'+str(multi_id)+file_extension
+            self.set_header('Content-Type', content_type)
+            self.set_header('Content-Disposition', 'attachment; filename='+
+                            get_original_filename('log'+file_name_suffix, file_name_suffix))
+            if export_format == 'csv':
+                for data in generate_csv(field_names, columns):
+                    self.write(data)
+                    try:
+                        await self.flush()
+                    except tornado.iostream.StreamClosedError:
+                        return # client disconnected
+            else:
+                self.write(export_binary(field_names, columns, export_format))
+
         else: # download the log file
             self.set_header('Content-Type', 'application/octet-stream')
             self.set_header("Content-Description", "File Transfer")
             self.set_header('Content-Disposition', 'attachment; filename={}'.format(
                 os.path.basename(log_file_name)))
-            with open(log_file_name, 'rb') as log_file:
-                while True:
-                    data = log_file.read(4096)
-                    if not data:
-                        break
-                    self.write(data)
-                self.finish()
+            await self.send_log_file(log_file_name)
+
+    async def send_log_file(self, log_file_name):
+        """ stream a log file, with support for conditional (ETag) and Range
+        requests. Log files do not change after the upload, so the size and
+        modification time identify the content.
+        """
+        stat = os.stat(log_file_name)
+        file_size = stat.st_size
+        etag = '"{:x}-{:x}"'.format(int(stat.st_mtime), file_size)
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(stat.st_mtime))
+        self.set_header('Accept-Ranges', 'bytes')
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        start, end = 0, file_size
+        range_header = self.request.headers.get('Range')
+        if_range = self.request.headers.get('If-Range')
+        if range_header and (if_range is None or if_range == etag):
+            byte_range = parse_byte_range(range_header, file_size)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header('Content-Type', 'text/plain')
+                self.set_header('Content-Range', 'bytes */{:}'.format(file_size))
+                return
+            if byte_range != (0, file_size):
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header('Content-Range', 'bytes {:}-{:}/{:}'.format(
+                    start, end - 1, file_size))
+        self.set_header('Content-Length', end - start)
+
+        # flush every chunk, so that neither the file is buffered in memory,
+        # nor the IOLoop is blocked for slow clients
+        with open(log_file_name, 'rb') as log_file:
+            log_file.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                data = log_file.read(min(DOWNLOAD_CHUNK_SIZE, remaining))
+                if not data:
+                    break
+                remaining -= len(data)
+                self.write(data)
+                try:
+                    await self.flush()
+                except tornado.iostream.StreamClosedError:
+                    return # client disconnected
+
+
+def parse_byte_range(range_header, file_size):
+    """ parse a single byte range of a Range header (multiple ranges are not
+    supported, in which case the whole file is sent)
+    :return: (start, end) with end exclusive, or None if the range cannot be
+             satisfied
+    """
+    unit, _, byte_range = range_header.partition('=')
+    if unit.strip() != 'bytes' or ',' in byte_range:
+        return 0, file_size
+    start_str, _, end_str = byte_range.strip().partition('-')
+    try:
+        if start_str == '': # suffix range: the last N bytes
+            start = max(0, file_size - int(end_str))
+            end = file_size
+        else:
+            start = int(start_str)
+            end = file_size
+            if end_str != '':
+                end = int(end_str) + 1
+                if end <= start:
+                    raise ValueError('invalid range')
+    except ValueError:
+        return 0, file_size # ignore invalid headers
+    if start >= file_size or start >= end:
+        return None
+    return start, min(end, file_size)
 
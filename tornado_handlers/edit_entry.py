@@ -10,11 +10,14 @@ import tornado.web
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_db_filename, get_kml_filepath, get_overview_img_filepath
-from helper import clear_ulog_cache, get_log_filename
+from config import get_db_filename, get_overview_img_filepath
+from helper import clear_ulog_cache, get_log_filename, get_analysis_cache_filename, \
+    get_3d_cache_filename, get_kml_cache_filename, remove_pid_analysis_results
+from search_index import remove_from_search_index
 
 #pylint: disable=relative-beyond-top-level
 from .common import get_jinja_env
+from .db_info_json import update_db_info_snapshot
 
 EDIT_TEMPLATE = 'edit.html'
 
@@ -80,8 +83,7 @@ Click <a href="{delete_url}">here</a> to confirm and delete the log {log_id}.
             return False
 
         # kml file
-        kml_path = get_kml_filepath()
-        kml_file_name = os.path.join(kml_path, log_id.replace('/', '.')+'.kml')
+        kml_file_name = get_kml_cache_filename(log_id)
         if os.path.exists(kml_file_name):
             os.unlink(kml_file_name)
 
@@ -90,15 +92,30 @@ Click <a href="{delete_url}">here</a> to confirm and delete the log {log_id}.
         if os.path.exists(preview_image_filename):
             os.unlink(preview_image_filename)
 
+        # cached analysis results
+        for analysis in ['pid', 'noise']:
+            analysis_filename = get_analysis_cache_filename(log_id, analysis)
+            if os.path.exists(analysis_filename):
+                os.unlink(analysis_filename)
+
+        # cached 3D view data
+        three_d_filename = get_3d_cache_filename(log_id)
+        if os.path.exists(three_d_filename):
+            os.unlink(three_d_filename)
+
         log_file_name = get_log_filename(log_id)
         print('deleting log entry {} and file {}'.format(log_id, log_file_name))
         os.unlink(log_file_name)
+        remove_from_search_index(cur, log_id)
+        remove_pid_analysis_results(cur, log_id)
         cur.execute("DELETE FROM LogsGenerated WHERE Id = ?", (log_id,))
         cur.execute("DELETE FROM Logs WHERE Id = ?", (log_id,))
         con.commit()
         cur.close()
         con.close()
 
+        update_db_info_snapshot(log_id)
+
         # need to clear the cache as well
         clear_ulog_cache()
 
@@ -13,6 +13,10 @@ sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'plot_
 from config import *
 from db_entry import *
 from helper import validate_log_id, validate_error_ids
+from search_index import update_search_index
+
+#pylint: disable=relative-beyond-top-level
+from .db_info_json import update_db_info_snapshot
 
 class UpdateErrorLabelHandler(tornado.web.RequestHandler):
     """ Update the error label of a flight log."""
@@ -41,11 +45,14 @@ class UpdateErrorLabelHandler(tornado.web.RequestHandler):
         cur.execute(
             'UPDATE Logs SET ErrorLabels = ? WHERE Id = ?',
             (error_id_str, log_id))
+        update_search_index(cur, [log_id])
 
         con.commit()
         cur.close()
         con.close()
 
+        update_db_info_snapshot(log_id)
+
         self.write('OK')
 
     def data_received(self, chunk):
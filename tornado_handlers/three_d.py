@@ -1,187 +1,293 @@
 """
-Tornado handler for the 3D page
+Tornado handlers for the 3D page
 """
 from __future__ import print_function
 import datetime
+import gzip
+import json
 import os
+import shutil
 import sys
+import uuid
+import zlib
 import tornado.web
 import numpy as np
 
 # this is needed for the following imports
 sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '../plot_app'))
-from config import get_bing_maps_api_key, get_cesium_api_key
+from config import get_bing_maps_api_key, get_cesium_api_key, get_3d_filepath
 from helper import validate_log_id, get_log_filename, load_ulog_file, \
-    get_flight_mode_changes, flight_modes_table
+    get_flight_mode_changes, flight_modes_table, get_3d_cache_filename
 
 #pylint: disable=relative-beyond-top-level
 from .common import get_jinja_env, CustomHTTPError, TornadoRequestHandlerBase
 
 THREED_TEMPLATE = '3d.html'
 
+# increase when the format of the cached data changes
+THREED_CACHE_VERSION = 2
+
+# adaptive attitude downsampling: a new sample is used whenever the vehicle
+# rotated by more than the angle since the last one, but at least every interval
+ATTITUDE_SAMPLING_ANGLE_DEG = 1.0
+ATTITUDE_SAMPLING_MAX_INTERVAL_S = 0.5
+
+
+def _samples_to_list(timestamps, columns, decimals):
+    """ convert samples to a list of [time, column values...] rows, where the
+    time is in seconds since boot. The rounding keeps the JSON output small.
+    """
+    rows = np.empty((len(timestamps), len(columns) + 1))
+    rows[:, 0] = np.round(timestamps.astype(np.float64) * 1.e-6, 6)
+    for i, (column, column_decimals) in enumerate(zip(columns, decimals)):
+        rows[:, i + 1] = np.round(column.astype(np.float64), column_decimals)
+    return rows.tolist()
+
+
+def _attitude_sample_indices(timestamps, q):
+    """ select attitude samples adaptively: densely where the angular rate is
+    high and sparsely in steady flight.
+    :param q: quaternion samples, shape (4, N)
+    :return: indices of the selected samples
+    """
+    num_samples = len(timestamps)
+    if num_samples < 3:
+        return np.arange(num_samples)
+    # rotation angle between consecutive samples, integrated over time
+    q = q.astype(np.float64)
+    q_dot = np.abs(np.sum(q[:, 1:] * q[:, :-1], axis=0))
+    q_norm = np.linalg.norm(q[:, 1:], axis=0) * np.linalg.norm(q[:, :-1], axis=0)
+    q_dot = np.divide(q_dot, q_norm, out=np.ones_like(q_dot), where=q_norm > 0)
+    delta_angle = 2 * np.arccos(np.clip(q_dot, 0, 1))
+    total_angle = np.concatenate(([0], np.cumsum(delta_angle)))
+
+    # keep the first sample of each angle and time bin
+    angle_bins = (total_angle / np.deg2rad(ATTITUDE_SAMPLING_ANGLE_DEG)).astype(np.int64)
+    time_bins = (timestamps - timestamps[0]).astype(np.int64) // \
+        int(ATTITUDE_SAMPLING_MAX_INTERVAL_S * 1e6)
+    keep = np.zeros(num_samples, dtype=bool)
+    keep[0] = keep[-1] = True
+    keep[1:] |= np.diff(angle_bins) != 0
+    keep[1:] |= np.diff(time_bins) != 0
+    return np.flatnonzero(keep)
+
+
+def _get_model(mav_type):
+    """ get the 3D model for a vehicle type
+    :return: tuple of (model uri, model scale factor)
+    """
+    # the model_scale_factor should scale the different models to make them
+    # equal in size (in proportion)
+    if mav_type == 1: # fixed wing
+        return 'plot_app/static/cesium/SampleData/models/CesiumAir/Cesium_Air.glb', 0.06
+    if mav_type == 2: # quad
+        return 'plot_app/static/cesium/models/iris/iris.glb', 1
+    if mav_type == 22: # delta-quad
+        # TODO: use the delta-quad model
+        return 'plot_app/static/cesium/SampleData/models/CesiumAir/Cesium_Air.glb', 0.06
+    # TODO: handle more types
+    return 'plot_app/static/cesium/models/iris/iris.glb', 1
+
+
+def get_3d_view_data(ulog):
+    """ extract the data needed by the 3D view from a log
+
+    Timestamps are passed in seconds since boot, and converted to UTC by the
+    client using boot_timestamp.
+    :return: dict (JSON-serializable)
+    """
+
+    try:
+        # required topics: none of these are optional
+        gps_pos = ulog.get_dataset('vehicle_gps_position').data
+        vehicle_global_position = ulog.get_dataset('vehicle_global_position').data
+        attitude = ulog.get_dataset('vehicle_attitude').data
+    except (KeyError, IndexError, ValueError) as error:
+        raise CustomHTTPError(
+            400,
+            'The log does not contain all required topics<br />'
+            '(vehicle_gps_position, vehicle_global_position, '
+            'vehicle_attitude)')
+
+    # manual control setpoint is optional
+    manual_control_setpoint = None
+    try:
+        manual_control_setpoint = ulog.get_dataset('manual_control_setpoint').data
+    except (KeyError, IndexError, ValueError) as error:
+        pass
+
+
+    # Get the takeoff location. We use the first position with a valid fix,
+    # and assume that the vehicle is not in the air already at that point
+    takeoff_index = 0
+    gps_indices = np.nonzero(gps_pos['fix_type'] > 2)
+    if len(gps_indices[0]) > 0:
+        takeoff_index = gps_indices[0][0]
+    takeoff_altitude = round(gps_pos['alt'][takeoff_index] * 1.e-3, 3)
+    takeoff_latitude = round(gps_pos['lat'][takeoff_index] * 1.e-7, 10)
+    takeoff_longitude = round(gps_pos['lon'][takeoff_index] * 1.e-7, 10)
+
+
+    # calculate UTC time offset (assume there's no drift over the entire log)
+    utc_offset = int(gps_pos['time_utc_usec'][takeoff_index]) - \
+            int(gps_pos['timestamp'][takeoff_index])
+    boot_timestamp = datetime.datetime.utcfromtimestamp(utc_offset/1.e6).replace(
+        tzinfo=datetime.timezone.utc)
+
+    # flight modes
+    flight_modes = []
+    for t, mode in get_flight_mode_changes(ulog):
+        mode_name = ''
+        if mode in flight_modes_table:
+            mode_name = flight_modes_table[mode][0]
+        flight_modes.append([round(t * 1.e-6, 6), mode_name])
+
+    # manual control setpoints (stick input). The client does not interpolate,
+    # so repeated values can be dropped.
+    manual_control_setpoints = []
+    if manual_control_setpoint:
+        sticks = np.array([manual_control_setpoint[axis] for axis in ['x', 'y', 'z', 'r']])
+        sticks = np.round(sticks.astype(np.float64), 3)
+        changed = np.ones(sticks.shape[1], dtype=bool)
+        changed[1:] = np.any(sticks[:, 1:] != sticks[:, :-1], axis=0)
+        changed[-1] = True
+        manual_control_setpoints = _samples_to_list(
+            manual_control_setpoint['timestamp'][changed], sticks[:, changed], [3] * 4)
+
+
+    # position
+    # Note: alt_ellipsoid from gps_pos would be the better match for
+    # altitude, but it's not always available. And since we add an offset
+    # (to match the takeoff location with the ground altitude) it does not
+    # matter as much.
+    # TODO: use vehicle_global_position? If so, then:
+    # - altitude requires an offset (to match the GPS data)
+    # - it's worse for some logs where the estimation is bad -> acro flights
+    #   (-> add both: user-selectable between GPS & estimated trajectory?)
+    position_data = _samples_to_list(
+        gps_pos['timestamp'],
+        [gps_pos['lon'] * 1.e-7, gps_pos['lat'] * 1.e-7, gps_pos['alt'] * 1.e-3],
+        [10, 10, 3])
+
+    # orientation as quaternion. Cesium uses (x, y, z, w)
+    q = np.array([attitude['q[1]'], attitude['q[2]'], attitude['q[3]'], attitude['q[0]']])
+    indices = _attitude_sample_indices(attitude['timestamp'], q)
+    attitude_data = _samples_to_list(attitude['timestamp'][indices], q[:, indices], [6] * 4)
+
+    model_uri, model_scale_factor = _get_model(
+        ulog.initial_parameters.get('MAV_TYPE', None))
+
+    return {
+        'flight_modes': flight_modes,
+        'manual_control_setpoints': manual_control_setpoints,
+        'takeoff_altitude': takeoff_altitude,
+        'takeoff_latitude': takeoff_latitude,
+        'takeoff_longitude': takeoff_longitude,
+        'position_data': position_data,
+        'start_time': position_data[0][0],
+        'end_time': position_data[-1][0],
+        'boot_timestamp': boot_timestamp.isoformat(),
+        'attitude_data': attitude_data,
+        'model_uri': model_uri,
+        'model_scale_factor': model_scale_factor,
+        }
+
+
+def _cache_header():
+    """ start of the (uncompressed) cache file content, used to check the version """
+    return '{{"version": {:}, '.format(THREED_CACHE_VERSION).encode('utf-8')
+
+
+def load_3d_view_data(log_id):
+    """ load the cached 3D view data of a log
+    :return: gzip-compressed JSON (bytes) or None if not cached
+    """
+    cache_file_name = get_3d_cache_filename(log_id)
+    if not os.path.exists(cache_file_name):
+        return None
+    try:
+        with open(cache_file_name, 'rb') as cache_file:
+            compressed = cache_file.read()
+        # only decompress the beginning to check the version
+        header = _cache_header()
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decompressor.decompress(compressed, len(header)) == header:
+            return compressed
+    except Exception as e:
+        print('Failed to load 3D cache file', cache_file_name, e)
+    return None
+
+
+def save_3d_view_data(log_id, data):
+    """ store the 3D view data of a log on disk
+    :return: gzip-compressed JSON (bytes)
+    """
+    content = json.dumps({'version': THREED_CACHE_VERSION, 'data': data})
+    compressed = gzip.compress(content.encode('utf-8'))
+    cache_file_name = get_3d_cache_filename(log_id)
+    # write to a random temporary file, then move it (to avoid races)
+    temp_file_name = cache_file_name+'.'+str(uuid.uuid4())
+    try:
+        if not os.path.exists(get_3d_filepath()):
+            os.makedirs(get_3d_filepath())
+        with open(temp_file_name, 'wb') as cache_file:
+            cache_file.write(compressed)
+        shutil.move(temp_file_name, cache_file_name)
+    except Exception as e:
+        print('Failed to store 3D cache file', cache_file_name, e)
+        if os.path.exists(temp_file_name):
+            os.unlink(temp_file_name)
+    return compressed
+
+
 #pylint: disable=abstract-method, unused-argument
 
 class ThreeDHandler(TornadoRequestHandlerBase):
-    """ Tornado Request Handler to render the 3D Cesium.js page """
+    """ Tornado Request Handler to render the 3D Cesium.js page. The flight
+    data is loaded asynchronously by the page (see ThreeDDataHandler) """
 
     def get(self, *args, **kwargs):
         """ GET request callback """
 
-        # load the log file
         log_id = self.get_argument('log')
         if not validate_log_id(log_id):
             raise tornado.web.HTTPError(400, 'Invalid Parameter')
-        log_file_name = get_log_filename(log_id)
-        ulog = load_ulog_file(log_file_name)
-
-        # extract the necessary information from the log
-
-        try:
-            # required topics: none of these are optional
-            gps_pos = ulog.get_dataset('vehicle_gps_position').data
-            vehicle_global_position = ulog.get_dataset('vehicle_global_position').data
-            attitude = ulog.get_dataset('vehicle_attitude').data
-        except (KeyError, IndexError, ValueError) as error:
-            raise CustomHTTPError(
-                400,
-                'The log does not contain all required topics<br />'
-                '(vehicle_gps_position, vehicle_global_position, '
-                'vehicle_attitude)')
-
-        # manual control setpoint is optional
-        manual_control_setpoint = None
-        try:
-            manual_control_setpoint = ulog.get_dataset('manual_control_setpoint').data
-        except (KeyError, IndexError, ValueError) as error:
-            pass
-
-
-        # Get the takeoff location. We use the first position with a valid fix,
-        # and assume that the vehicle is not in the air already at that point
-        takeoff_index = 0
-        gps_indices = np.nonzero(gps_pos['fix_type'] > 2)
-        if len(gps_indices[0]) > 0:
-            takeoff_index = gps_indices[0][0]
-        takeoff_altitude = '{:.3f}' \
-            .format(gps_pos['alt'][takeoff_index] * 1.e-3)
-        takeoff_latitude = '{:.10f}'.format(gps_pos['lat'][takeoff_index] * 1.e-7)
-        takeoff_longitude = '{:.10f}'.format(gps_pos['lon'][takeoff_index] * 1.e-7)
-
-
-        # calculate UTC time offset (assume there's no drift over the entire log)
-        utc_offset = int(gps_pos['time_utc_usec'][takeoff_index]) - \
-                int(gps_pos['timestamp'][takeoff_index])
-
-        # flight modes
-        flight_mode_changes = get_flight_mode_changes(ulog)
-        flight_modes_str = '[ '
-        for t, mode in flight_mode_changes:
-            t += utc_offset
-            utctimestamp = datetime.datetime.utcfromtimestamp(t/1.e6).replace(
-                tzinfo=datetime.timezone.utc)
-            if mode in flight_modes_table:
-                mode_name, color = flight_modes_table[mode]
-            else:
-                mode_name = ''
-                color = '#ffffff'
-            flight_modes_str += '["{:}", "{:}"], ' \
-                .format(utctimestamp.isoformat(), mode_name)
-        flight_modes_str += ' ]'
-
-        # manual control setpoints (stick input)
-        manual_control_setpoints_str = '[ '
-        if manual_control_setpoint:
-            for i in range(len(manual_control_setpoint['timestamp'])):
-                manual_x = manual_control_setpoint['x'][i]
-                manual_y = manual_control_setpoint['y'][i]
-                manual_z = manual_control_setpoint['z'][i]
-                manual_r = manual_control_setpoint['r'][i]
-                t = manual_control_setpoint['timestamp'][i] + utc_offset
-                utctimestamp = datetime.datetime.utcfromtimestamp(t/1.e6).replace(
-                    tzinfo=datetime.timezone.utc)
-                manual_control_setpoints_str += '["{:}", {:.3f}, {:.3f}, {:.3f}, {:.3f}], ' \
-                    .format(utctimestamp.isoformat(), manual_x, manual_y, manual_z, manual_r)
-        manual_control_setpoints_str += ' ]'
-
-
-        # position
-        # Note: alt_ellipsoid from gps_pos would be the better match for
-        # altitude, but it's not always available. And since we add an offset
-        # (to match the takeoff location with the ground altitude) it does not
-        # matter as much.
-        position_data = '[ '
-        # TODO: use vehicle_global_position? If so, then:
-        # - altitude requires an offset (to match the GPS data)
-        # - it's worse for some logs where the estimation is bad -> acro flights
-        #   (-> add both: user-selectable between GPS & estimated trajectory?)
-        for i in range(len(gps_pos['timestamp'])):
-            lon = gps_pos['lon'][i] * 1.e-7
-            lat = gps_pos['lat'][i] * 1.e-7
-            alt = gps_pos['alt'][i] * 1.e-3
-            t = gps_pos['timestamp'][i] + utc_offset
-            utctimestamp = datetime.datetime.utcfromtimestamp(t/1.e6).replace(
-                tzinfo=datetime.timezone.utc)
-            if i == 0:
-                start_timestamp = utctimestamp
-            end_timestamp = utctimestamp
-            position_data += '["{:}", {:.10f}, {:.10f}, {:.3f}], ' \
-                .format(utctimestamp.isoformat(), lon, lat, alt)
-        position_data += ' ]'
-
-        start_timestamp_str = '"{:}"'.format(start_timestamp.isoformat())
-        boot_timestamp = datetime.datetime.utcfromtimestamp(utc_offset/1.e6).replace(
-            tzinfo=datetime.timezone.utc)
-        boot_timestamp_str = '"{:}"'.format(boot_timestamp.isoformat())
-        end_timestamp_str = '"{:}"'.format(end_timestamp.isoformat())
-
-        # orientation as quaternion
-        attitude_data = '[ '
-        for i in range(len(attitude['timestamp'])):
-            att_qw = attitude['q[0]'][i]
-            att_qx = attitude['q[1]'][i]
-            att_qy = attitude['q[2]'][i]
-            att_qz = attitude['q[3]'][i]
-            t = attitude['timestamp'][i] + utc_offset
-            utctimestamp = datetime.datetime.utcfromtimestamp(t/1.e6).replace(
-                tzinfo=datetime.timezone.utc)
-            # Cesium uses (x, y, z, w)
-            attitude_data += '["{:}", {:.6f}, {:.6f}, {:.6f}, {:.6f}], ' \
-                .format(utctimestamp.isoformat(), att_qx, att_qy, att_qz, att_qw)
-        attitude_data += ' ]'
-
-        # handle different vehicle types
-        # the model_scale_factor should scale the different models to make them
-        # equal in size (in proportion)
-        mav_type = ulog.initial_parameters.get('MAV_TYPE', None)
-        if mav_type == 1: # fixed wing
-            model_scale_factor = 0.06
-            model_uri = 'plot_app/static/cesium/SampleData/models/CesiumAir/Cesium_Air.glb'
-        elif mav_type == 2: # quad
-            model_scale_factor = 1
-            model_uri = 'plot_app/static/cesium/models/iris/iris.glb'
-        elif mav_type == 22: # delta-quad
-            # TODO: use the delta-quad model
-            model_scale_factor = 0.06
-            model_uri = 'plot_app/static/cesium/SampleData/models/CesiumAir/Cesium_Air.glb'
-        else: # TODO: handle more types
-            model_scale_factor = 1
-            model_uri = 'plot_app/static/cesium/models/iris/iris.glb'
+        if not os.path.exists(get_log_filename(log_id)):
+            raise tornado.web.HTTPError(404, 'Log not found')
 
         template = get_jinja_env().get_template(THREED_TEMPLATE)
         self.write(template.render(
-            flight_modes=flight_modes_str,
-            manual_control_setpoints=manual_control_setpoints_str,
-            takeoff_altitude=takeoff_altitude,
-            takeoff_longitude=takeoff_longitude,
-            takeoff_latitude=takeoff_latitude,
-            position_data=position_data,
-            start_timestamp=start_timestamp_str,
-            boot_timestamp=boot_timestamp_str,
-            end_timestamp=end_timestamp_str,
-            attitude_data=attitude_data,
-            model_scale_factor=model_scale_factor,
-            model_uri=model_uri,
             log_id=log_id,
             bing_api_key=get_bing_maps_api_key(),
             cesium_api_key=get_cesium_api_key()))
 
+
+class ThreeDDataHandler(TornadoRequestHandlerBase):
+    """ Tornado Request Handler for the flight data of the 3D page (JSON,
+    gzip-compressed) """
+
+    def get(self, *args, **kwargs):
+        """ GET request callback """
+
+        log_id = self.get_argument('log')
+        if not validate_log_id(log_id):
+            raise tornado.web.HTTPError(400, 'Invalid Parameter')
+        log_file_name = get_log_filename(log_id)
+        if not os.path.exists(log_file_name):
+            raise tornado.web.HTTPError(404, 'Log not found')
+
+        # the log files do not change, so the extracted data can be cached
+        compressed = load_3d_view_data(log_id)
+        if compressed is None:
+            ulog = load_ulog_file(log_file_name)
+            compressed = save_3d_view_data(log_id, get_3d_view_data(ulog))
+
+        # the ETag is added by tornado (and a matching If-None-Match gets a 304)
+        self.set_header('Content-Type', 'application/json')
+        self.set_header('Cache-Control', 'public, max-age=86400')
+        self.set_header('Vary', 'Accept-Encoding')
+        if 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            self.set_header('Content-Encoding', 'gzip')
+            self.write(compressed)
+        else:
+            self.write(gzip.decompress(compressed))
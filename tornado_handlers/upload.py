@@ -11,7 +11,6 @@ import uuid
 import binascii
 import sqlite3
 import tornado.web
-from tornado.ioloop import IOLoop
 
 from pyulog import ULog
 from pyulog.px4 import PX4ULog
@@ -23,7 +22,9 @@ from config import get_db_filename, get_http_protocol, get_domain_name, \
     email_notifications_config
 from helper import get_total_flight_time, validate_url, get_log_filename, \
     load_ulog_file, get_airframe_name, ULogException
-from overview_generator import generate_overview_img_from_id
+from overview_generator import get_overview_img_queue
+from kml_generator import precompute_kml
+from search_index import update_vehicle_search_index
 
 #pylint: disable=relative-beyond-top-level
 from .common import get_jinja_env, CustomHTTPError, generate_db_data_from_log_file, \
@@ -72,6 +73,9 @@ def update_vehicle_db_entry(cur, ulog, log_id, vehicle_name):
                     'values (?, ?, ?, ?)',
                     [vehicle_data.uuid, vehicle_data.log_id, vehicle_data.name,
                      vehicle_data.flight_time])
+        if vehicle_name != '':
+            # the name is part of the search index of all logs of the vehicle
+            update_vehicle_search_index(cur, vehicle_data.uuid)
     return vehicle_data
 
 
@@ -285,13 +289,17 @@ class UploadHandler(TornadoRequestHandlerBase):
                     # (we may have the log already loaded in 'ulog', however the
                     # lru cache will make it very quick to load it again)
                     generate_db_data_from_log_file(log_id, con)
-                    # also generate the preview image
-                    IOLoop.instance().add_callback(generate_overview_img_from_id, log_id)
+                    # also generate the preview image (in the background)
+                    get_overview_img_queue().add(log_id)
 
                 con.commit()
                 cur.close()
                 con.close()
 
+                # the log is loaded already: create the KML track (in the background)
+                if ulog is not None:
+                    precompute_kml(log_id, ulog)
+
                 # send notification emails
                 send_notification_email(email, full_plot_url, delete_url, info)
 